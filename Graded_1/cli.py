@@ -0,0 +1,427 @@
+"""
+Run the experiments of the run_*.py scripts without plotting, with the parameters in JSON configs.
+
+    python cli.py list                                   # the experiments
+    python cli.py config imm_pda > imm_pda.json          # the default config, to edit
+    python cli.py run imm_pda --config imm_pda.json      # estimate, results to results/imm_pda
+    python cli.py run imm_pda --set sigma_z=2.5 --set pda.PD=0.9
+    python cli.py plot results/imm_pda --show            # plots of a run, saved as .png
+
+run only imports the filters, so it starts fast and works on machines without a display. A config
+file only needs the parameters it changes from the defaults of the experiment. The results
+directory gets
+    config.json:  the full config of the run,
+    summary.json: ANEES, ANIS, RMSE and peak errors with the confidence intervals,
+    steps/:       a resultstore.ResultStore with the estimate, its covariance, the truth, NEES,
+                  NIS, the errors and the mode probabilities of every time step.
+plot is a separate stage reading that directory, and the only one importing matplotlib.
+
+A config has the dataset, the measurement noise, a list of dynamic models ("CV" with sigma_a or
+"CT" with sigma_a and sigma_omega), the Markov chain PI when there are several models (an IMM),
+the PDA parameters when the data has clutter, and the initialization. init.method is one of
+    given:        init.mean and init.std,
+    ground_truth: init.mean with the first true state put in, and init.std, as run_joyride.py,
+    association:  the first true measurement, zero velocity and init.std, as run_pda.py,
+    two_point:    position and velocity from the first two measurements, as run_ekf.py.
+"""
+# %% Imports
+# types
+from typing import Any, Dict, List, Optional, Tuple
+
+# packages
+import argparse
+import copy
+import json
+import os
+import shutil
+import sys
+
+import numpy as np
+
+from resultstore import ResultStore, ResultWriter
+from tuning import load_mat_dataset
+
+Config = Dict[str, Any]
+
+# %% Experiments
+# the parameters of the run_*.py scripts
+EXPERIMENTS: Dict[str, Config] = {
+    "ekf": dict(
+        data="data_for_ekf.mat",
+        sigma_z=3.1,
+        models=[dict(model="CV", sigma_a=2.6)],
+        init=dict(method="two_point"),
+        confidence=0.9,
+    ),
+    "imm": dict(
+        data="data_for_imm.mat",
+        sigma_z=3,
+        models=[
+            dict(model="CV", sigma_a=0.2),
+            dict(model="CT", sigma_a=0.1, sigma_omega=0.002 * np.pi),
+        ],
+        PI=[[0.95, 0.05], [0.05, 0.95]],
+        init=dict(
+            method="ground_truth",
+            mean=[0, 0, 0, 0, 0],
+            std=[25, 25, 3, 3, 0.0005],
+            mode_probabilities=[0.5, 0.5],
+        ),
+        confidence=0.9,
+    ),
+    "pda": dict(
+        data="data_for_pda.mat",
+        sigma_z=3.2,
+        models=[dict(model="CV", sigma_a=2.2)],
+        pda=dict(clutter_intensity=1e-3, PD=0.8, gate_size=5),
+        init=dict(method="association", std=[4.5, 4.5, 10, 10]),
+        confidence=0.9,
+    ),
+    "imm_pda": dict(
+        data="data_for_imm_pda.mat",
+        sigma_z=1.9,
+        models=[
+            dict(model="CV", sigma_a=0.14),
+            dict(model="CT", sigma_a=0.06, sigma_omega=0.02),
+        ],
+        PI=[[0.9, 0.1], [0.1, 0.9]],
+        pda=dict(clutter_intensity=1e-4, PD=0.85, gate_size=3),
+        init=dict(
+            method="given",
+            mean=[0, 20, 0, 0, 0],
+            std=[5, 5, 3, 3, 1],
+            mode_probabilities=[0.9, 0.1],
+        ),
+        confidence=0.9,
+    ),
+    "joyride": dict(
+        data="data_joyride.mat",
+        sigma_z=15,
+        models=[
+            dict(model="CV", sigma_a=0.9),
+            dict(model="CT", sigma_a=1.3, sigma_omega=0.04),
+        ],
+        PI=[[0.9, 0.1], [0.1, 0.9]],
+        pda=dict(clutter_intensity=1e-4, PD=0.9, gate_size=5),
+        init=dict(
+            method="ground_truth",
+            mean=[0, 0, 0, 0, 0.1],
+            std=[30, 30, 1, 1, 0.5],
+            mode_probabilities=[0.9, 0.1],
+        ),
+        confidence=0.9,
+    ),
+    "joyride_cv_high": dict(
+        data="data_joyride.mat",
+        sigma_z=8,
+        models=[
+            dict(model="CV", sigma_a=0.2),
+            dict(model="CV", sigma_a=0.2),
+            dict(model="CT", sigma_a=0.1, sigma_omega=0.9),
+        ],
+        PI=[[0.75, 0.15, 0.10], [0.10, 0.70, 0.20], [0.20, 0.20, 0.60]],
+        pda=dict(clutter_intensity=1e-5, PD=0.9, gate_size=2),
+        init=dict(
+            method="ground_truth",
+            mean=[0, 0, 0, 0, 0.1],
+            std=[20, 20, 2, 2, 1],
+            mode_probabilities=[0.9, 0.05, 0.05],
+        ),
+        confidence=0.9,
+    ),
+}
+
+
+# %% Configs
+def merge(config: Config, changes: Config) -> Config:
+    """A copy of config with the values in changes, merging dictionaries recursively."""
+    merged = copy.deepcopy(config)
+    for key, value in changes.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = merge(merged[key], value)
+        else:
+            merged[key] = copy.deepcopy(value)
+    return merged
+
+
+def parse_setting(setting: str) -> Config:
+    """Turn "pda.PD=0.9" into {"pda": {"PD": 0.9}}. The value is JSON, or else a string."""
+    assert "=" in setting, f"parse_setting: {setting} is not on the form key=value"
+    path, value = setting.split("=", 1)
+    try:
+        parsed: Any = json.loads(value)
+    except json.JSONDecodeError:
+        parsed = value
+    for key in reversed(path.split(".")):
+        parsed = {key: parsed}
+    return parsed
+
+
+def load_config(experiment: str, filename: Optional[str] = None, settings: List[str] = ()) -> Config:
+    """The config of experiment with the changes in the file filename and the settings applied."""
+    assert experiment in EXPERIMENTS, f"load_config: unknown experiment {experiment}, see cli.py list"
+    config = EXPERIMENTS[experiment]
+    if filename is not None:
+        with open(filename) as file:
+            config = merge(config, json.load(file))
+    for setting in settings:
+        config = merge(config, parse_setting(setting))
+    return merge(config, dict(experiment=experiment))
+
+
+# %% Estimation
+def make_estimator(config: Config):
+    """The EKF, IMM, or a PDA of one of these, of a config."""
+    import dynamicmodels
+    import measurementmodels
+    import ekf
+    import imm
+    import pda
+
+    models = config["models"]
+    n = 5 if len(models) > 1 or any(model["model"] == "CT" for model in models) else 4
+    dynamic_models = []
+    for model in models:
+        if model["model"] == "CV":
+            dynamic_models.append(dynamicmodels.WhitenoiseAccelleration(model["sigma_a"], n=n))
+        elif model["model"] == "CT":
+            dynamic_models.append(dynamicmodels.ConstantTurnrate(model["sigma_a"], model["sigma_omega"]))
+        else:
+            raise ValueError(f"make_estimator: unknown model {model['model']}, must be CV or CT")
+
+    measurement_model = measurementmodels.CartesianPosition(config["sigma_z"], state_dim=n)
+    filters = [ekf.EKF(dynamic_model, measurement_model) for dynamic_model in dynamic_models]
+    if len(filters) == 1:
+        estimator = filters[0]
+    else:
+        PI = np.array(config["PI"])
+        assert PI.shape == (len(filters),) * 2, "make_estimator: PI must be (models, models)"
+        assert np.allclose(PI.sum(axis=1), 1), "make_estimator: rows of PI must sum to 1"
+        estimator = imm.IMM(filters, PI)
+
+    if "pda" in config:
+        estimator = pda.PDA(estimator, config["pda"]["clutter_intensity"], config["pda"]["PD"], config["pda"]["gate_size"])
+    return estimator, n
+
+
+def initial_state(config: Config, data: Dict[str, Any], n: int) -> Tuple[Any, int]:
+    """The initial state of a config, and the first time step to run from."""
+    from gaussparams import GaussParams
+    from mixturedata import MixtureParameters
+
+    init = config["init"]
+    method = init["method"]
+    Z, Ts = data["Z"], data["Ts"]
+    start = 0
+    if method == "two_point":
+        # as run_ekf.py
+        assert n == 4 and len(config["models"]) == 1, "initial_state: two_point is for a single CV model"
+        assert not isinstance(Z, list), "initial_state: two_point needs single measurements"
+        sigma_z, sigma_a, T = config["sigma_z"], config["models"][0]["sigma_a"], Ts[1]
+        mean = np.array([*Z[1], *(Z[1] - Z[0]) / T])
+        cov11 = sigma_z ** 2 * np.eye(2)
+        cov12 = sigma_z ** 2 * np.eye(2) / T
+        cov22 = (2 * sigma_z ** 2 / T ** 2 + sigma_a ** 2 * T / 3) * np.eye(2)
+        cov = np.block([[cov11, cov12], [cov12.T, cov22]])
+        start = 2
+    else:
+        if method == "given":
+            mean = np.array(init["mean"], dtype=float)
+        elif method == "ground_truth":
+            mean = np.array(init["mean"], dtype=float)
+            m = min(n, data["Xgt"].shape[1])
+            mean[:m] = data["Xgt"][0, :m]
+        elif method == "association":
+            # as run_pda.py, a is 1 indexed
+            assert "a" in data, "initial_state: association needs the true associations a in the data"
+            mean = np.zeros(n)
+            mean[:2] = Z[0][data["a"][0] - 1]
+        else:
+            raise ValueError(f"initial_state: unknown init method {method}")
+        cov = np.diag(np.array(init["std"], dtype=float)) ** 2
+    assert mean.shape == (n,) and cov.shape == (n, n), f"initial_state: the initial state must have {n} dimensions"
+
+    state = GaussParams(mean, cov)
+    if len(config["models"]) > 1:
+        weights = np.array(init["mode_probabilities"], dtype=float)
+        assert np.isclose(weights.sum(), 1), "initial_state: mode probabilities must sum to 1"
+        state = MixtureParameters(weights, [state] * len(weights))
+    return state, start
+
+
+def run(config: Config, output: str) -> Dict[str, float]:
+    """Run the estimator of config over its dataset, storing the steps and summary in output."""
+    import estimationstatistics as estats
+
+    data = load_mat_dataset(config["data"])
+    estimator, n = make_estimator(config)
+    state, start = initial_state(config, data, n)
+    Z, Xgt, Ts = data["Z"], data["Xgt"], data["Ts"]
+    has_modes = len(config["models"]) > 1
+    has_NIS = "pda" not in config
+    idxs = np.arange(4)
+    t = np.cumsum(Ts) - Ts[0]
+
+    NEES = []
+    NIS = []
+    os.makedirs(output, exist_ok=True)
+    with open(os.path.join(output, "config.json"), "w") as file:
+        json.dump(config, file, indent=1)
+
+    with ResultWriter(os.path.join(output, "steps"), packed=["cov"]) as writer:
+        for k in range(start, len(Z)):
+            predicted = estimator.predict(state, Ts[k])
+            columns = {}
+            if has_NIS:
+                columns["NIS"] = estimator.NISes(Z[k], predicted)[0] if has_modes else estimator.NIS(Z[k], predicted)
+                NIS.append(columns["NIS"])
+            state = estimator.update(Z[k], predicted)
+
+            estimate = estimator.estimate(state)
+            x_true = Xgt[k, :4]
+            columns["NEES"] = estats.NEES(estimate.mean[idxs], estimate.cov[np.ix_(idxs, idxs)], x_true)
+            NEES.append(columns["NEES"])
+            if has_modes:
+                columns["mode_probabilities"] = state.weights
+            writer.append(
+                t[k],
+                mean=estimate.mean,
+                cov=estimate.cov,
+                truth=Xgt[k],
+                pos_err=np.linalg.norm(estimate.mean[:2] - x_true[:2]),
+                vel_err=np.linalg.norm(estimate.mean[2:4] - x_true[2:4]),
+                **columns,
+            )
+
+    steps = ResultStore(os.path.join(output, "steps")).read(["pos_err", "vel_err"])
+    K = len(NEES)
+    summary = dict(
+        steps=K,
+        ANEES=float(np.mean(NEES)),
+        pos_RMSE=float(np.sqrt(np.mean(steps["pos_err"] ** 2))),
+        vel_RMSE=float(np.sqrt(np.mean(steps["vel_err"] ** 2))),
+        peak_pos_err=float(steps["pos_err"].max()),
+        peak_vel_err=float(steps["vel_err"].max()),
+    )
+    summary["ANEES_lower"], summary["ANEES_upper"] = estats.chi2_average_interval(4, K, config["confidence"])
+    if NIS:
+        summary["ANIS"] = float(np.mean(NIS))
+        summary["ANIS_lower"], summary["ANIS_upper"] = estats.chi2_average_interval(2, K, config["confidence"])
+    with open(os.path.join(output, "summary.json"), "w") as file:
+        json.dump(summary, file, indent=1)
+    return summary
+
+
+# %% Plotting
+def plot(output: str, show: bool = False) -> List[str]:
+    """Plot a run in output: the trajectory, NEES, NIS, errors and mode probabilities, as .png files
+    in output. Returns the files written."""
+    import matplotlib
+
+    if not show:
+        matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    import scipy.stats
+
+    with open(os.path.join(output, "config.json")) as file:
+        config = json.load(file)
+    with open(os.path.join(output, "summary.json")) as file:
+        summary = json.load(file)
+    steps = ResultStore(os.path.join(output, "steps")).read()
+    t = steps["t"]
+    CI4 = np.array(scipy.stats.chi2.interval(config["confidence"], 4))
+    CI2 = np.array(scipy.stats.chi2.interval(config["confidence"], 2))
+
+    figures = {}
+    fig, ax = plt.subplots()
+    ax.plot(*steps["truth"][:, :2].T, label="true")
+    ax.plot(*steps["mean"][:, :2].T, label="estimate")
+    ax.set_title(
+        f"{config['experiment']}: RMSE(pos, vel) = "
+        f"({summary['pos_RMSE']:.3f}, {summary['vel_RMSE']:.3f})"
+    )
+    ax.axis("equal")
+    ax.legend()
+    figures["trajectory"] = fig
+
+    fig, axs = plt.subplots(2 if "NIS" in steps else 1, squeeze=False)
+    axs[0, 0].plot(t, steps["NEES"])
+    axs[0, 0].plot([t[0], t[-1]], np.repeat(CI4[None], 2, axis=0), "--r")
+    axs[0, 0].set_title(
+        f"NEES, ANEES = {summary['ANEES']:.2f} in "
+        f"[{summary['ANEES_lower']:.2f}, {summary['ANEES_upper']:.2f}]"
+    )
+    if "NIS" in steps:
+        axs[1, 0].plot(t, steps["NIS"])
+        axs[1, 0].plot([t[0], t[-1]], np.repeat(CI2[None], 2, axis=0), "--r")
+        axs[1, 0].set_title(
+            f"NIS, ANIS = {summary['ANIS']:.2f} in "
+            f"[{summary['ANIS_lower']:.2f}, {summary['ANIS_upper']:.2f}]"
+        )
+    figures["consistency"] = fig
+
+    fig, axs = plt.subplots(2, sharex=True)
+    axs[0].plot(t, steps["pos_err"])
+    axs[0].set_ylabel("position error")
+    axs[1].plot(t, steps["vel_err"])
+    axs[1].set_ylabel("velocity error")
+    figures["errors"] = fig
+
+    if "mode_probabilities" in steps:
+        fig, ax = plt.subplots()
+        ax.plot(t, steps["mode_probabilities"])
+        ax.legend([model["model"] for model in config["models"]])
+        ax.set_ylabel("mode probability")
+        ax.set_ylim([0, 1])
+        figures["modes"] = fig
+
+    filenames = []
+    for name, fig in figures.items():
+        filenames.append(os.path.join(output, f"{name}.png"))
+        fig.savefig(filenames[-1])
+    if show:
+        plt.show()
+    return filenames
+
+
+# %% Command line
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("list", help="list the experiments")
+    config_parser = commands.add_parser("config", help="print the default config of an experiment")
+    config_parser.add_argument("experiment", choices=list(EXPERIMENTS))
+    run_parser = commands.add_parser("run", help="run an experiment without plotting")
+    run_parser.add_argument("experiment", choices=list(EXPERIMENTS))
+    run_parser.add_argument("--config", help="JSON file with the parameters to change")
+    run_parser.add_argument("--set", action="append", default=[], metavar="KEY=VALUE", help="change a parameter, eg. pda.PD=0.9")
+    run_parser.add_argument("--output", help="results directory, default results/<experiment>")
+    run_parser.add_argument("--overwrite", action="store_true", help="replace an existing results directory")
+    plot_parser = commands.add_parser("plot", help="plot the results of a run")
+    plot_parser.add_argument("output", help="results directory of a run")
+    plot_parser.add_argument("--show", action="store_true", help="show the figures as well")
+    args = parser.parse_args(argv)
+
+    if args.command == "list":
+        for name, config in EXPERIMENTS.items():
+            models = "+".join(model["model"] for model in config["models"])
+            print(f"{name:<16} {models}{' PDA' if 'pda' in config else ''} on {config['data']}")
+    elif args.command == "config":
+        print(json.dumps(EXPERIMENTS[args.experiment], indent=1))
+    elif args.command == "run":
+        output = args.output or os.path.join("results", args.experiment)
+        if os.path.exists(output):
+            if not args.overwrite:
+                print(f"{output} exists, use --overwrite to replace it", file=sys.stderr)
+                return 1
+            shutil.rmtree(output)
+        summary = run(load_config(args.experiment, args.config, args.set), output)
+        print(json.dumps(summary, indent=1))
+    else:
+        for filename in plot(args.output, args.show):
+            print(filename)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,94 @@
+"""
+Online estimation of the spatial clutter intensity from the returns not associated to any track.
+
+The surveillance region [lower, upper] is divided into a grid of cells (a single cell gives a global
+estimate). The expected number of clutter returns per scan in every cell is tracked with exponential
+forgetting,
+    c_k = forgetting_factor * c_(k-1) + (1 - forgetting_factor) * (returns in the cell at scan k),
+and the intensity in a cell is c_k divided by the cell volume.
+
+Typical use with a PDA per scan:
+    gated = pda.gate(Z, filter_state)
+    filter_state = pda.update(Z, filter_state, clutter_intensity=estimator.intensity(Z))
+    estimator.update(Z[~gated])
+"""
+from typing import Optional, Sequence
+from dataclasses import dataclass, field
+import numpy as np
+
+
+@dataclass
+class ClutterEstimator:
+    # the lower corner of the surveillance region: shape=(m,)
+    lower: np.ndarray
+    # the upper corner of the surveillance region: shape=(m,)
+    upper: np.ndarray
+    # the number of cells along every axis, None for a single global cell
+    cells: Optional[Sequence[int]] = None
+    # the weight of the past scans in the running average
+    forgetting_factor: float = 0.9
+    # the intensity before any scans are seen
+    initial_intensity: float = 1e-4
+    # lower bound on the returned intensity, so empty cells still allow clutter
+    min_intensity: float = 1e-12
+
+    # the running average of clutter returns per scan in each cell: shape=cells
+    counts: np.ndarray = field(init=False, repr=False)
+    _cell_volume: float = field(init=False, repr=False)
+
+    def __post_init__(self):
+        self.lower = np.asarray(self.lower, dtype=float)
+        self.upper = np.asarray(self.upper, dtype=float)
+        m = self.lower.shape[0]
+        self.cells = np.asarray(
+            self.cells if self.cells is not None else np.ones(m), dtype=int
+        )
+
+        assert self.upper.shape == (m,), "ClutterEstimator: lower and upper must have the same shape"
+        assert np.all(self.upper > self.lower), "ClutterEstimator: upper must be above lower"
+        assert self.cells.shape == (m,), "ClutterEstimator: cells must have one entry per axis"
+        assert np.all(self.cells >= 1), "ClutterEstimator: cells must be positive"
+        assert 0 <= self.forgetting_factor < 1, "ClutterEstimator: forgetting_factor must be in [0, 1)"
+
+        self._cell_volume = np.prod((self.upper - self.lower) / self.cells)
+        self.counts = np.full(tuple(self.cells), self.initial_intensity * self._cell_volume)
+
+    def cell_index(
+        self,
+        # measurements: shape=(M, m)
+        Z: np.ndarray,
+    ) -> np.ndarray:  # flat cell index of every measurement, clipped to the region: shape=(M,)
+        """Find the grid cell of every measurement."""
+        scaled = (Z - self.lower) / (self.upper - self.lower) * self.cells
+        idx = np.clip(np.floor(scaled).astype(int), 0, self.cells - 1)
+        return np.ravel_multi_index(idx.T, tuple(self.cells))
+
+    def update(
+        self,
+        # the returns of a scan not associated to any track: shape=(M, m)
+        Z: np.ndarray,
+    ) -> None:
+        """Include a scan of clutter returns in the running average."""
+        Z = np.asarray(Z, dtype=float).reshape(-1, self.lower.shape[0])
+        inside = np.all((Z >= self.lower) & (Z < self.upper), axis=1)
+        scan_counts = np.bincount(
+            self.cell_index(Z[inside]), minlength=self.counts.size
+        ).reshape(self.counts.shape)
+
+        self.counts *= self.forgetting_factor
+        self.counts += (1 - self.forgetting_factor) * scan_counts
+
+    def intensity(
+        self,
+        # measurements: shape=(M, m)
+        Z: np.ndarray,
+    ) -> np.ndarray:  # the clutter intensity at every measurement: shape=(M,)
+        """Look up the estimated clutter intensity at the measurements."""
+        Z = np.asarray(Z, dtype=float).reshape(-1, self.lower.shape[0])
+        cell_intensity = self.counts.ravel() / self._cell_volume
+        return np.maximum(cell_intensity[self.cell_index(Z)], self.min_intensity)
+
+    @property
+    def global_intensity(self) -> float:
+        """The average clutter intensity over the surveillance region."""
+        return max(self.counts.mean() / self._cell_volume, self.min_intensity)
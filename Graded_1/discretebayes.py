@@ -1,44 +1,100 @@
 from typing import Tuple
 
 import numpy as np
+from scipy.special import logsumexp
+
+# All functions accept batched priors, ie. leading axes (...) on pr and cond_pr broadcast
+# against each other. This lets a bank of IMMs do its discrete Bayes in a single call.
+# debug=True checks the results at the expense of speed, see also ESKF.debug.
+# discrete_bayes works on probabilities and falls back to discrete_bayes_log when they underflow.
 
 
 def discrete_bayes(
-    # the prior: shape=(n,)
+    # the prior: shape=(..., n)
     pr: np.ndarray,
-    # the conditional/likelihood: shape=(n, m)
+    # the conditional/likelihood: shape=(..., n, m)
     cond_pr: np.ndarray,
+    *,
+    debug: bool = True,
 ) -> Tuple[
     np.ndarray, np.ndarray
-]:  # the new marginal and conditional: shapes=((m,), (m, n))
+]:  # the new marginal and conditional: shapes=((..., m), (..., m, n))
     """Swap which discrete variable is the marginal and conditional."""
 
-    joint = cond_pr * pr[:, None]
+    joint = cond_pr * pr[..., :, None]
+
+    marginal = joint.sum(axis=-2)
 
-    marginal = joint.sum(axis=0)
+    # A zero marginal is either a joint that underflowed, eg. after a long run of a sharp mode
+    # sequence, or a truly degenerate one. Both are redone in the log domain, which keeps the
+    # ratios of the tiny products and falls back to the prior only in the truly degenerate case.
+    # Checked once so the common case only does a plain division.
+    degenerate = marginal <= 0
+    if degenerate.any():
+        with np.errstate(divide="ignore"):
+            log_marginal, log_conditional = discrete_bayes_log(
+                np.log(pr), np.log(cond_pr), debug=debug
+            )
+        marginal, conditional = np.exp(log_marginal), np.exp(log_conditional)
+    else:
+        # flip axes
+        conditional = (joint / marginal[..., None, :]).swapaxes(-1, -2)
 
-    # Take care of rare cases of degenerate zero marginal,
-    conditional = np.divide(
-        joint,
-        marginal[None],
-        out=np.repeat(pr[:, None], joint.shape[1], 1),
-        where=marginal[None] > 0,
-    )
+    if debug:
+        assert np.all(
+            np.isfinite(conditional)
+        ), f"NaN or inf in conditional in discrete bayes"
+        assert np.all(
+            np.less_equal(0, conditional)
+        ), f"Negative values for conditional in discrete bayes"
+        assert np.all(
+            np.less_equal(conditional, 1)
+        ), f"Value more than on in discrete bayes"
+
+        assert np.all(
+            np.isfinite(marginal)
+        ), f"NaN or inf in marginal in discrete bayes"
+
+    return marginal, conditional
+
+
+def discrete_bayes_log(
+    # the log prior: shape=(..., n)
+    log_pr: np.ndarray,
+    # the log conditional/likelihood: shape=(..., n, m)
+    log_cond_pr: np.ndarray,
+    *,
+    debug: bool = True,
+) -> Tuple[
+    np.ndarray, np.ndarray
+]:  # the new log marginal and log conditional: shapes=((..., m), (..., m, n))
+    """Swap which discrete variable is the marginal and conditional in the log domain."""
+
+    log_joint = log_cond_pr + log_pr[..., :, None]
+
+    log_marginal = logsumexp(log_joint, axis=-2)
+
+    # Degenerate marginals are log(0) = -inf, fall back to the prior as in discrete_bayes
+    degenerate = np.isneginf(log_marginal)
+    if degenerate.any():
+        log_joint = np.where(degenerate[..., None, :], log_pr[..., :, None], log_joint)
+        log_conditional = log_joint - np.where(degenerate, 0, log_marginal)[..., None, :]
+    else:
+        log_conditional = log_joint - log_marginal[..., None, :]
 
     # flip axes
-    conditional = conditional.T
+    log_conditional = log_conditional.swapaxes(-1, -2)
 
-    # DEBUG
-    assert np.all(
-        np.isfinite(conditional)
-    ), f"NaN or inf in conditional in discrete bayes"
-    assert np.all(
-        np.less_equal(0, conditional)
-    ), f"Negative values for conditional in discrete bayes"
-    assert np.all(
-        np.less_equal(conditional, 1)
-    ), f"Value more than on in discrete bayes"
+    if debug:
+        assert not np.any(
+            np.isnan(log_conditional)
+        ), f"NaN in log conditional in discrete bayes"
+        assert np.all(
+            np.less_equal(log_conditional, 1e-12)
+        ), f"Log value more than zero in discrete bayes"
 
-    assert np.all(np.isfinite(marginal)), f"NaN or inf in marginal in discrete bayes"
+        assert not np.any(
+            np.isnan(log_marginal)
+        ), f"NaN in log marginal in discrete bayes"
 
-    return marginal, conditional
+    return log_marginal, log_conditional
@@ -25,6 +25,8 @@ import measurementmodels as measmods
 from gaussparams import GaussParams, GaussParamList
 from mixturedata import MixtureParameters
 import mixturereduction
+import spatialindex
+import profiling
 
 from singledispatchmethod import singledispatchmethod
 
@@ -57,6 +59,7 @@ class EKF:
     def __post_init__(self) -> None:
         self._MLOG2PIby2: Final[float] = self.sensor_model.m * np.log(2 * np.pi) / 2
 
+    @profiling.stage("EKF.predict")
     def predict(
         self,
         ekfstate: GaussParams,
@@ -135,6 +138,7 @@ class EKF:
 
         return innovationstate
 
+    @profiling.stage("EKF.update")
     def update(
         self,
         z: np.ndarray,
@@ -167,6 +171,53 @@ class EKF:
         assert isPSD(P), "P_upd calculated by EKF.update not PSD"
         return ekfstate_upd
 
+    @profiling.stage("EKF.combined_update")
+    def combined_update(
+        self,
+        # measurements of shape=(M, m)=(#measurements, dim)
+        Z: np.ndarray,
+        # the weight of each association, first element for no measurement: shape=(M + 1,)
+        weights: np.ndarray,
+        ekfstate: GaussParams,
+        *,
+        sensor_state: Optional[Dict[str, Any]] = None,
+    ) -> GaussParams:
+        """Update ekfstate with the weighted mixture of all associations of Z, reduced to a single Gaussian.
+
+        All the association conditioned updates share S and W, so the reduction has the
+        closed form of the combined innovation. This equals updating with every z in Z,
+        prepending ekfstate for no measurement and reducing the weighted mixture.
+        """
+
+        x, P = ekfstate
+        assert isPSD(P), "P input to EKF.combined_update not PSD"
+
+        zbar = self.sensor_model.h(x, sensor_state=sensor_state)
+        S = self.innovation_cov(None, ekfstate, sensor_state=sensor_state)
+        H = self.sensor_model.H(x, sensor_state=sensor_state)
+        W = P @ la.solve(S, H).T
+
+        # combined innovation
+        innovations = Z - zbar
+        detection_weights = weights[1:]
+        v = detection_weights @ innovations
+
+        x_upd = x + W @ v
+
+        # the covariance conditioned on a detection, in Joseph form as in update
+        I = np.eye(*P.shape)
+        P_detected = (I - W @ H) @ P @ (I - W @ H).T + W @ self.sensor_model.R(x) @ W.T
+
+        # spread of the innovations
+        v_spread = (innovations * detection_weights[:, None]).T @ innovations - np.outer(v, v)
+
+        P_upd = weights[0] * P + (1 - weights[0]) * P_detected + W @ v_spread @ W.T
+
+        ekfstate_upd = GaussParams(x_upd, P_upd)
+
+        assert isPSD(P_upd), "P_upd calculated by EKF.combined_update not PSD"
+        return ekfstate_upd
+
     def step(
         self,
         z: np.ndarray,
@@ -203,6 +254,30 @@ class EKF:
         # NIS = v @ la.solve(S, v)
         return NIS
 
+    def NIS_batch(
+        self,
+        # measurements of shape=(M, m)=(#measurements, dim)
+        Z: np.ndarray,
+        ekfstate: GaussParams,
+        *,
+        sensor_state: Optional[Dict[str, Any]] = None,
+    ) -> np.ndarray:  # shape=(M,)
+        """Calculate the normalized innovation squared for ekfstate at every z in Z in sensor_state.
+
+        The predicted measurement and the Cholesky factor of S are calculated once, and all of Z is
+        whitened with a single triangular solve. Assumes that R does not depend on the measurement.
+        """
+        x = ekfstate.mean
+        zbar = self.sensor_model.h(x, sensor_state=sensor_state)
+        S = self.innovation_cov(None, ekfstate, sensor_state=sensor_state)
+
+        cholS = la.cholesky(S, lower=True)
+
+        invcholS_V = la.solve_triangular(cholS, (Z - zbar).T, lower=True)
+
+        NIS = (invcholS_V ** 2).sum(axis=0)
+        return NIS
+
     @classmethod
     def estimate(cls, ekfstate: GaussParams) -> GaussParams:
         """Get the estimate from the state with its covariance. (Compatibility method)"""
@@ -236,6 +311,7 @@ class EKF:
 
         return ll
 
+    @profiling.stage("EKF.reduce_mixture")
     def reduce_mixture(
         self, ekfstate_mixture: MixtureParameters[GaussParams]
     ) -> GaussParams:
@@ -259,6 +335,32 @@ class EKF:
 
         return (NIS<gate_size_square) # TODO: a simple comparison should suffice here
 
+    def gate_batch(
+        self,
+        # measurements of shape=(M, m)=(#measurements, dim)
+        Z: np.ndarray,
+        ekfstate: GaussParams,
+        gate_size_square: float,
+        *,
+        sensor_state: Optional[Dict[str, Any]] = None,
+    ) -> np.ndarray:  # shape=(M,)
+        """ Check which of the measurements in Z are inside sqrt(gate_sized_squared)-sigma ellipse of ekfstate in sensor_state """
+        NIS = self.NIS_batch(Z, ekfstate, sensor_state=sensor_state)
+
+        return NIS < gate_size_square
+
+    def gate_bounds(
+        self,
+        ekfstate: GaussParams,
+        gate_size_square: float,
+        *,
+        sensor_state: Optional[Dict[str, Any]] = None,
+    ) -> Tuple[np.ndarray, np.ndarray]:  # lower and upper corner, shapes=((m,), (m,))
+        """Calculate the axis aligned box around the sqrt(gate_sized_squared)-sigma ellipse of ekfstate in sensor_state"""
+        zbar = self.sensor_model.h(ekfstate.mean, sensor_state=sensor_state)
+        S = self.innovation_cov(None, ekfstate, sensor_state=sensor_state)
+        return spatialindex.gate_box(zbar, S, gate_size_square)
+
     @singledispatchmethod
     def init_filter_state(self, init) -> None:
         raise NotImplementedError(
@@ -1,5 +1,10 @@
-from typing import Sequence, Optional
+from typing import Callable, Deque, Dict, List, Sequence, Optional, Tuple
+from dataclasses import dataclass, field
+from collections import deque
+import functools
+
 import numpy as np
+import scipy.stats
 
 
 def mahalanobis_distance_squared(
@@ -31,9 +36,57 @@ def NEES(
     )
 
 
-NEES_sequence = np.vectorize(
-    NEES, otypes=[float], excluded=["idxs"], signature="(n),(m,m),(p)->()"
-)
+def forward_substitution(
+    # lower triangular, shape (..., n, n)
+    L: np.ndarray,
+    # shape (..., n)
+    b: np.ndarray,
+) -> np.ndarray:  # the solution y of L y = b, shape (..., n)
+    """Solve the lower triangular systems L y = b, vectorized over the leading dimensions."""
+    n = L.shape[-1]
+    y = np.empty(np.broadcast(L[..., 0], b).shape)
+    for i in range(n):
+        y[..., i] = (b[..., i] - (L[..., i, :i] * y[..., :i]).sum(axis=-1)) / L[..., i, i]
+    return y
+
+
+def mahalanobis_distance_squared_batch(
+    # shape (..., n)
+    a: np.ndarray,
+    # shape (..., n)
+    b: np.ndarray,
+    # shape (..., n, n)
+    psd_mat: np.ndarray,
+) -> np.ndarray:  # positive, shape (...,)
+    """Mahalanobis distances by one batched Cholesky factorization and forward substitution."""
+    cholesky = np.linalg.cholesky(psd_mat)
+    whitened = forward_substitution(cholesky, a - b)
+    return (whitened ** 2).sum(axis=-1)
+
+
+def NEES_sequence(
+    # shape=(K, n)
+    estimate: np.ndarray,
+    # shape=(K, n, n), positive definite,
+    cov: np.ndarray,
+    # shape=(K, p), p >= n
+    true_val: np.ndarray,
+    # into which part of the state to calculate NEES for
+    idxs: Optional[Sequence[int]] = None,
+) -> np.ndarray:  # positive, shape (K,)
+    idxs = np.asarray(idxs if idxs is not None else np.arange(estimate.shape[-1]))
+    return mahalanobis_distance_squared_batch(
+        estimate[..., idxs], true_val[..., idxs], cov[..., idxs[:, None], idxs]
+    )
+
+
+def NIS_sequence(
+    # innovations, shape=(K, m)
+    v: np.ndarray,
+    # innovation covariances, shape=(K, m, m), positive definite
+    S: np.ndarray,
+) -> np.ndarray:  # positive, shape (K,)
+    return mahalanobis_distance_squared_batch(v, np.zeros_like(v), S)
 
 
 def distance_sequence(
@@ -48,3 +101,154 @@ def distance_sequence(
     true_seq_indexed = true_seq if idxs is None else true_seq[:, idxs]
     dists = np.linalg.norm(mean_seq_indexed - true_seq_indexed, axis=-1)
     return dists
+
+
+@functools.lru_cache(maxsize=1024)
+def chi2_average_interval(
+    # degrees of freedom of every term
+    dof: int,
+    # the number of terms averaged
+    count: int,
+    confidence: float = 0.95,
+) -> Tuple[float, float]:
+    """The confidence interval of the average of count independent chi2(dof) variables, eg. ANEES."""
+    lower, upper = scipy.stats.chi2.interval(confidence, dof * count)
+    return lower / count, upper / count
+
+
+@dataclass
+class ConsistencyEvent:
+    # the monitored quantity, a NEES sub-state name or "NIS"
+    name: str
+    # the number of values added to the quantity when the event happened
+    step: int
+    # the window average
+    average: float
+    lower: float
+    upper: float
+    # whether the window average went inside (True) or outside (False) its interval
+    inside: bool
+
+
+@dataclass
+class _RunningAverage:
+    dof: int
+    window: int
+    count: int = 0
+    total: float = 0.0
+    window_total: float = 0.0
+    inside: bool = True
+    buffer: np.ndarray = field(init=False, repr=False)
+
+    def __post_init__(self):
+        self.buffer = np.zeros(self.window)
+
+    def add(self, value: float) -> None:
+        pos = self.count % self.window
+        self.window_total += value - self.buffer[pos]
+        self.buffer[pos] = value
+        self.count += 1
+        self.total += value
+        if pos == self.window - 1:
+            # avoid drift in the running window sum
+            self.window_total = self.buffer.sum()
+
+    @property
+    def average(self) -> float:
+        return self.total / max(self.count, 1)
+
+    @property
+    def window_average(self) -> float:
+        return self.window_total / max(min(self.count, self.window), 1)
+
+
+@dataclass
+class ConsistencyMonitor:
+    """
+    Running and windowed averages of NEES per sub-state and of NIS in constant memory.
+
+    When a full window average leaves (or returns into) its chi-square interval a ConsistencyEvent
+    is passed to on_event and kept among the last max_events events.
+    """
+
+    # the sub-states to monitor NEES for, eg. {"pos": [0, 1], "vel": [2, 3]}
+    idxs: Dict[str, Sequence[int]] = field(default_factory=dict)
+    # the number of values in the window averages
+    window: int = 50
+    confidence: float = 0.95
+    on_event: Optional[Callable[[ConsistencyEvent], None]] = None
+    max_events: int = 100
+
+    events: Deque[ConsistencyEvent] = field(init=False, repr=False)
+    _averages: Dict[str, _RunningAverage] = field(init=False, repr=False)
+
+    def __post_init__(self):
+        assert self.window >= 1, "ConsistencyMonitor: window must be positive"
+        self.idxs = {name: np.asarray(idx, dtype=int) for name, idx in self.idxs.items()}
+        self.events = deque(maxlen=self.max_events)
+        self._averages = {
+            name: _RunningAverage(idx.size, self.window) for name, idx in self.idxs.items()
+        }
+
+    def add_NEES(
+        self,
+        # shape=(n,)
+        estimate: np.ndarray,
+        # shape=(n,n), positive definite,
+        cov: np.ndarray,
+        # shape=(n,)
+        true_val: np.ndarray,
+    ) -> Dict[str, float]:  # the NEES of every sub-state
+        """Add the NEES of every monitored sub-state of an estimate."""
+        NEESes = {}
+        for name, idx in self.idxs.items():
+            NEESes[name] = NEES(estimate, cov, true_val, idxs=idx)
+            self._add(name, NEESes[name])
+        return NEESes
+
+    def add_NIS(self, NIS: float, dof: int) -> None:
+        """Add a NIS value with dof degrees of freedom, the measurement dimension."""
+        if "NIS" not in self._averages:
+            self._averages["NIS"] = _RunningAverage(dof, self.window)
+        assert (
+            self._averages["NIS"].dof == dof
+        ), "ConsistencyMonitor.add_NIS: the NIS degrees of freedom can not change"
+        self._add("NIS", NIS)
+
+    def _add(self, name: str, value: float) -> None:
+        running = self._averages[name]
+        running.add(value)
+        if running.count < self.window:
+            return
+
+        lower, upper = chi2_average_interval(running.dof, self.window, self.confidence)
+        average = running.window_average
+        inside = lower <= average <= upper
+        if inside != running.inside:
+            running.inside = inside
+            event = ConsistencyEvent(name, running.count, average, lower, upper, inside)
+            self.events.append(event)
+            if self.on_event is not None:
+                self.on_event(event)
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        """The running and window averages with their intervals for every monitored quantity."""
+        summary = {}
+        for name, running in self._averages.items():
+            if running.count == 0:
+                continue
+            lower, upper = chi2_average_interval(running.dof, running.count, self.confidence)
+            window_count = min(running.count, self.window)
+            window_lower, window_upper = chi2_average_interval(
+                running.dof, window_count, self.confidence
+            )
+            summary[name] = dict(
+                count=running.count,
+                average=running.average,
+                lower=lower,
+                upper=upper,
+                window_average=running.window_average,
+                window_lower=window_lower,
+                window_upper=window_upper,
+            )
+        return summary
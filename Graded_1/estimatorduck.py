@@ -1,5 +1,5 @@
 #%%
-from typing import Dict, Any, Generic, TypeVar, Optional
+from typing import Dict, Any, Generic, TypeVar, Optional, Tuple
 from typing_extensions import Protocol, runtime
 
 from mixturedata import MixtureParameters
@@ -59,3 +59,22 @@ class StateEstimator(Protocol[T]):
         sensor_state: Optional[Dict[str, Any]] = None,
     ) -> bool:
         ...
+
+    def gate_batch(
+        self,
+        Z: np.ndarray,
+        eststate: T,
+        gate_size_square: float,
+        *,
+        sensor_state: Optional[Dict[str, Any]] = None,
+    ) -> np.ndarray:
+        ...
+
+    def gate_bounds(
+        self,
+        eststate: T,
+        gate_size_square: float,
+        *,
+        sensor_state: Optional[Dict[str, Any]] = None,
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        ...
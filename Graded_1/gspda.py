@@ -0,0 +1,155 @@
+"""
+Gaussian sum PDA: a PDA that keeps a mixture of association hypotheses across scans.
+
+The state is a MixtureParameters over hypotheses, where each component is a state of the
+PDA's state_filter (eg. GaussParams for the EKF or an immstate for the IMM).
+Every scan each hypothesis is split into its association conditioned updates,
+the children are pruned by weight and the mixture is capped to max_hypotheses components.
+"""
+from typing import TypeVar, Optional, Dict, Any, List, Generic
+from dataclasses import dataclass
+import numpy as np
+from scipy.special import logsumexp
+
+from pda import PDA
+from mixturedata import MixtureParameters
+from gaussparams import GaussParams
+import mixturereduction
+
+ET = TypeVar("ET")
+
+
+@dataclass
+class GaussianSumPDA(Generic[ET]):
+    # the single scan PDA used for gating, association likelihoods and conditional updates
+    pda: PDA[ET]
+    # the maximum number of hypotheses kept per track
+    max_hypotheses: int = 10
+    # hypotheses with a normalized weight below this are removed
+    prune_threshold: float = 1e-3
+    # the merging cost used to cap Gaussian hypotheses, see mixturereduction.reduce_mixture_components
+    merge_cost: str = "runnalls"
+
+    def __post_init__(self):
+        assert self.max_hypotheses >= 1, "GaussianSumPDA: max_hypotheses must be positive"
+
+    def predict(
+        self, filter_state: MixtureParameters[ET], Ts: float
+    ) -> MixtureParameters[ET]:
+        """Predict every hypothesis Ts time units ahead"""
+        return MixtureParameters(
+            filter_state.weights,
+            [self.pda.predict(comp, Ts) for comp in filter_state.components],
+        )
+
+    def gate(
+        self,
+        # measurements of shape=(M, m)=(#measurements, dim)
+        Z: np.ndarray,
+        filter_state: MixtureParameters[ET],
+        *,
+        sensor_state: Optional[Dict[str, Any]] = None,
+    ) -> np.ndarray:  # gated (M,): gated(j) = true if measurement j is within the gate of any hypothesis
+        """Gate the measurements against every hypothesis."""
+        gated = np.zeros(Z.shape[0], dtype=bool)
+        for comp in filter_state.components:
+            gated |= self.pda.gate(Z, comp, sensor_state=sensor_state)
+        return gated
+
+    def update(
+        self,
+        # measurements of shape=(M, m)=(#measurements, dim)
+        Z: np.ndarray,
+        filter_state: MixtureParameters[ET],
+        *,
+        sensor_state: Optional[Dict[str, Any]] = None,
+        # clutter intensity at each measurement, shape=(M,). Defaults to pda.clutter_intensity
+        clutter_intensity: Optional[np.ndarray] = None,
+    ) -> MixtureParameters[ET]:
+        """
+        Split every hypothesis on its associations, prune and cap the resulting mixture.
+
+        The PDA loglikelihood ratios of all hypotheses are relative to the same
+        all clutter scan, so they can be normalized jointly with the prior hypothesis weights.
+        """
+        log_weights: List[np.ndarray] = []
+        children: List[ET] = []
+        for weight, comp in zip(filter_state.weights, filter_state.components):
+            gated = self.pda.gate(Z, comp, sensor_state=sensor_state)
+            Zg = Z[gated]
+            lls = self.pda.loglikelihood_ratios(
+                Zg,
+                comp,
+                sensor_state=sensor_state,
+                clutter_intensity=None
+                if clutter_intensity is None
+                else np.asarray(clutter_intensity)[gated],
+            )
+            log_weights.append(np.log(weight) + lls)
+            children.extend(
+                self.pda.conditional_update(Zg, comp, sensor_state=sensor_state)
+            )
+
+        log_weights = np.concatenate(log_weights)
+        weights = np.exp(log_weights - logsumexp(log_weights))
+
+        return self.reduce_hypotheses(MixtureParameters(weights, children))
+
+    def reduce_hypotheses(
+        self, filter_state: MixtureParameters[ET]
+    ) -> MixtureParameters[ET]:
+        """Prune hypotheses by weight and cap their number to max_hypotheses."""
+        weights = filter_state.weights
+        components = filter_state.components
+
+        # prune, but always keep the most probable hypothesis
+        keep = weights >= self.prune_threshold
+        keep[np.argmax(weights)] = True
+        weights = weights[keep]
+        components = [comp for comp, k in zip(components, keep) if k]
+
+        if len(components) > self.max_hypotheses:
+            if isinstance(components[0], GaussParams):
+                # merge the most similar Gaussians to keep the mixture moments
+                x = np.array([c.mean for c in components], dtype=float)
+                P = np.array([c.cov for c in components], dtype=float)
+                weights, x, P = mixturereduction.reduce_mixture_components(
+                    weights, x, P, self.max_hypotheses, cost=self.merge_cost
+                )
+                components = [GaussParams(xk, Pk) for xk, Pk in zip(x, P)]
+            else:
+                # no general merge of two states, so keep the most probable ones
+                best = np.argsort(weights)[::-1][: self.max_hypotheses]
+                weights = weights[best]
+                components = [components[k] for k in best]
+
+        weights = weights / weights.sum()
+        return MixtureParameters(weights, components)
+
+    def step(
+        self,
+        # measurements of shape=(M, m)=(#measurements, dim)
+        Z: np.ndarray,
+        filter_state: MixtureParameters[ET],
+        Ts: float,
+        *,
+        sensor_state: Optional[Dict[str, Any]] = None,
+        # clutter intensity at each measurement, shape=(M,). Defaults to pda.clutter_intensity
+        clutter_intensity: Optional[np.ndarray] = None,
+    ) -> MixtureParameters[ET]:
+        """Perform a predict update cycle with Ts time units and measurements Z in sensor_state"""
+        filter_state_predicted = self.predict(filter_state, Ts)
+        return self.update(
+            Z,
+            filter_state_predicted,
+            sensor_state=sensor_state,
+            clutter_intensity=clutter_intensity,
+        )
+
+    def estimate(self, filter_state: MixtureParameters[ET]) -> GaussParams:
+        """Get an estimate with its covariance from the hypothesis mixture."""
+        return self.pda.estimate(self.pda.reduce_mixture(filter_state))
+
+    def init_filter_state(self, init_state: ET) -> MixtureParameters[ET]:
+        """Initialize a single hypothesis state."""
+        return MixtureParameters(np.ones(1), [self.pda.init_filter_state(init_state)])
@@ -30,6 +30,7 @@ from scipy.special import logsumexp
 
 # local
 import discretebayes
+import profiling
 
 # %% TypeVar and aliases
 MT = TypeVar("MT")  # a type variable to be the mode type
@@ -41,6 +42,8 @@ class IMM(Generic[MT]):
     filters: List[StateEstimator[MT]]
     # the transition matrix. PI[i, j] = probability of going from model i to j: shape (M, M)
     PI: np.ndarray
+    # check numeric properties at the expense of calculation speed (see also ESKF.debug)
+    debug: bool = True
 
     def __post_init__(self):
         assert (
@@ -69,27 +72,29 @@ class IMM(Generic[MT]):
         """Calculate the predicted mode probability and the mixing probabilities."""
 
         predicted_mode_probabilities, mix_probabilities = discretebayes.discrete_bayes(
-            immstate.weights, self.PI
+            immstate.weights, self.PI, debug=self.debug
         )
 
-        assert predicted_mode_probabilities.shape == (
-            self.PI.shape[0],
-        ), "IMM.mix_probabilities: Wrong shape on the predicted mode probabilities"
-        assert (
-            mix_probabilities.shape == self.PI.shape
-        ), "IMM.mix_probabilities: Wrong shape on mixing probabilities"
-        assert np.all(
-            np.isfinite(predicted_mode_probabilities)
-        ), "IMM.mix_probabilities: predicted mode probabilities not finite"
-        assert np.all(
-            np.isfinite(mix_probabilities)
-        ), "IMM.mix_probabilities: mix probabilities not finite"
-        assert np.allclose(
-            mix_probabilities.sum(axis=1), 1
-        ), "IMM.mix_probabilities: mix probabilities does not sum to 1 per mode"
+        if self.debug:
+            assert predicted_mode_probabilities.shape == (
+                self.PI.shape[0],
+            ), "IMM.mix_probabilities: Wrong shape on the predicted mode probabilities"
+            assert (
+                mix_probabilities.shape == self.PI.shape
+            ), "IMM.mix_probabilities: Wrong shape on mixing probabilities"
+            assert np.all(
+                np.isfinite(predicted_mode_probabilities)
+            ), "IMM.mix_probabilities: predicted mode probabilities not finite"
+            assert np.all(
+                np.isfinite(mix_probabilities)
+            ), "IMM.mix_probabilities: mix probabilities not finite"
+            assert np.allclose(
+                mix_probabilities.sum(axis=1), 1
+            ), "IMM.mix_probabilities: mix probabilities does not sum to 1 per mode"
 
         return predicted_mode_probabilities, mix_probabilities
 
+    @profiling.stage("IMM.mix_states")
     def mix_states(
         self,
         immstate: MixtureParameters[MT],
@@ -113,6 +118,7 @@ class IMM(Generic[MT]):
         ]
         return modestates_pred
 
+    @profiling.stage("IMM.predict")
     def predict(
         self,
         immstate: MixtureParameters[MT],
@@ -173,15 +179,17 @@ class IMM(Generic[MT]):
 
         updated_mode_probabilities = np.exp(logjoint - logsumexp(logjoint))
 
-        assert np.all(
-            np.isfinite(updated_mode_probabilities)
-        ), "IMM.update_mode_probabilities: updated probabilities not finite "
-        assert np.allclose(
-            np.sum(updated_mode_probabilities), 1
-        ), "IMM.update_mode_probabilities: updated probabilities does not sum to one"
+        if self.debug:
+            assert np.all(
+                np.isfinite(updated_mode_probabilities)
+            ), "IMM.update_mode_probabilities: updated probabilities not finite "
+            assert np.allclose(
+                np.sum(updated_mode_probabilities), 1
+            ), "IMM.update_mode_probabilities: updated probabilities does not sum to one"
 
         return updated_mode_probabilities
 
+    @profiling.stage("IMM.update")
     def update(
         self,
         z: np.ndarray,
@@ -239,6 +247,7 @@ class IMM(Generic[MT]):
         ), "IMM.loglikelihood: did not calculate ll to be a single float"
         return ll
 
+    @profiling.stage("IMM.reduce_mixture")
     def reduce_mixture(
         self, immstate_mixture: MixtureParameters[MixtureParameters[MT]]
     ) -> MixtureParameters[MT]:
@@ -272,7 +281,9 @@ class IMM(Generic[MT]):
         )
 
         # flip conditioning order with Bayes to get Pr(s), and Pr(a | s)
-        mode_prob, mode_conditioned_component_prob = discretebayes.discrete_bayes(weights, component_conditioned_mode_prob)  # TODO
+        mode_prob, mode_conditioned_component_prob = discretebayes.discrete_bayes(
+            weights, component_conditioned_mode_prob, debug=self.debug
+        )  # TODO
 
         # We need to gather all the state parameters from the associations for mode s into a
         # single list in order to reduce it to a single parameter set.
@@ -320,6 +331,96 @@ class IMM(Generic[MT]):
         gated: bool = any(mode_gated) # TODO: check if _any_ of the modes gated the measurement
         return gated
 
+    def gate_batch(
+        self,
+        # measurements of shape=(M, m)=(#measurements, dim)
+        Z: np.ndarray,
+        immstate: MixtureParameters[MT],
+        gate_size_square: float,
+        sensor_state: Dict[str, Any] = None,
+    ) -> np.ndarray:  # shape=(M,)
+        """Check which of the measurements in Z are within the gate of any mode in immstate in sensor_state"""
+
+        gated, _, _ = self.gate_modes(Z, immstate, gate_size_square, sensor_state=sensor_state)
+        return gated
+
+    def gate_modes(
+        self,
+        # measurements of shape=(M, m)=(#measurements, dim)
+        Z: np.ndarray,
+        immstate: MixtureParameters[MT],
+        gate_size_square: float,
+        sensor_state: Dict[str, Any] = None,
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:  # gated, NIS, log det(S) / 2: shapes=((M,), (#modes, M), (#modes,))
+        """Gate all of Z against all the modes in immstate at once, also giving the NIS of every mode and measurement
+
+        The innovation covariances of the modes are stacked and factorized together, and the
+        innovations of each mode are whitened with a triangular solve against its Cholesky factor.
+        The NIS and log determinants give the mode conditioned likelihoods, see gate_loglikelihoods.
+        """
+
+        zbar = np.array(
+            [
+                fs.sensor_model.h(comp.mean, sensor_state=sensor_state)
+                for fs, comp in zip(self.filters, immstate.components)
+            ]
+        )
+        S = np.array(
+            [
+                fs.innovation_cov(None, comp, sensor_state=sensor_state)
+                for fs, comp in zip(self.filters, immstate.components)
+            ]
+        )
+        cholS = np.linalg.cholesky(S)
+
+        # innovations of all measurements for every mode: shape=(#modes, m, M)
+        V = (Z[None] - zbar[:, None]).swapaxes(-1, -2)
+        invcholS_V = np.array(
+            [linalg.solve_triangular(cholS_s, V_s, lower=True) for cholS_s, V_s in zip(cholS, V)]
+        ).reshape(V.shape)
+
+        NIS = (invcholS_V ** 2).sum(axis=-2)
+        logdetSby2 = np.log(np.diagonal(cholS, axis1=-2, axis2=-1)).sum(axis=-1)
+        gated = (NIS < gate_size_square).any(axis=0)
+        return gated, NIS, logdetSby2
+
+    def gate_loglikelihoods(
+        self,
+        # measurements of shape=(M, m)=(#measurements, dim)
+        Z: np.ndarray,
+        immstate: MixtureParameters[MT],
+        gate_size_square: float,
+        sensor_state: Dict[str, Any] = None,
+    ) -> Tuple[np.ndarray, np.ndarray]:  # gated, loglikelihood: shapes=((M,), (M,))
+        """Gate Z as gate_batch and give the log likelihood of every measurement, as loglikelihood,
+        from the same factorization of the innovation covariances."""
+
+        gated, NIS, logdetSby2 = self.gate_modes(
+            Z, immstate, gate_size_square, sensor_state=sensor_state
+        )
+        MLOG2PIby2 = Z.shape[-1] * np.log(2 * np.pi) / 2
+        mode_conditioned_ll = -(NIS / 2 + logdetSby2[:, None] + MLOG2PIby2)
+        ll = immstate.weights @ mode_conditioned_ll
+
+        if self.debug:
+            assert np.all(np.isfinite(ll)), "IMM.gate_loglikelihoods: ll not finite"
+        return gated, ll
+
+    def gate_bounds(
+        self,
+        immstate: MixtureParameters[MT],
+        gate_size_square: float,
+        sensor_state: Dict[str, Any] = None,
+    ) -> Tuple[np.ndarray, np.ndarray]:  # lower and upper corner, shapes=((m,), (m,))
+        """Calculate the axis aligned box around the gates of all the modes in immstate in sensor_state"""
+        lowers, uppers = zip(
+            *[
+                fs.gate_bounds(comp, gate_size_square, sensor_state=sensor_state)
+                for fs, comp in zip(self.filters, immstate.components)
+            ]
+        )
+        return np.min(lowers, axis=0), np.max(uppers, axis=0)
+
     def NISes(
         self,
         z: np.ndarray,
@@ -0,0 +1,409 @@
+"""
+Notation:
+----------
+The IMM bank runs the same IMM on N independent targets with all the targets stored in stacked arrays.
+N is the number of targets, M the number of modes, n the state dimension and m the measurement dimension.
+
+A bank state is a MixtureParameters where
+    weights is the mode probabilities: shape=(N, M)
+    components is a GaussParamList with mean shape=(N, M, n) and cov shape=(N, M, n, n)
+
+Ts can be a single float or one per target: shape=(N,)
+present is a boolean mask over the targets telling which targets got a measurement: shape=(N,)
+
+A scan is all the measurements of a time step shared by the targets: shape=(K, m)
+gated is a boolean mask telling which measurements of the scan each target gates: shape=(N, K)
+"""
+# %% Imports
+# types
+from typing import List, Optional, Dict, Any, Sequence, Tuple, Union
+
+# packages
+from dataclasses import dataclass
+import numpy as np
+from scipy.special import logsumexp
+
+# local
+import discretebayes
+import ekf
+import imm
+import mixturereduction
+from gaussparams import GaussParams, GaussParamList
+from mixturedata import MixtureParameters
+
+
+# %% IMM bank
+@dataclass
+class IMMBank:
+    # The M mode matched EKFs shared by all the targets in the bank
+    filters: List[ekf.EKF]
+    # the transition matrix. PI[i, j] = probability of going from model i to j: shape (M, M)
+    PI: np.ndarray
+    # check numeric properties at the expense of calculation speed (see also IMM.debug)
+    debug: bool = True
+
+    def __post_init__(self):
+        assert (
+            self.PI.ndim == 2
+        ), "Transition matrix PI shape must be (len(filters), len(filters))"
+        assert (
+            self.PI.shape[0] == self.PI.shape[1]
+        ), "Transition matrix PI shape must be (len(filters), len(filters))"
+        assert np.allclose(
+            self.PI.sum(axis=1), 1
+        ), "The rows of the transition matrix PI must sum to 1."
+        assert (
+            len(self.filters) == self.PI.shape[0]
+        ), "Transition matrix PI shape must be (len(filters), len(filters))"
+        assert all(
+            fs.sensor_model.m == self.filters[0].sensor_model.m for fs in self.filters
+        ), "IMMBank: all modes must share the measurement dimension"
+
+    @classmethod
+    def from_imm(cls, imm_filter: imm.IMM) -> "IMMBank":
+        """Make a bank running imm_filter for every target."""
+        return cls(imm_filter.filters, imm_filter.PI, imm_filter.debug)
+
+    @classmethod
+    def from_ekf(cls, ekf_filter: ekf.EKF, debug: bool = True) -> "IMMBank":
+        """Make a single mode bank running ekf_filter for every target."""
+        return cls([ekf_filter], np.ones((1, 1)), debug)
+
+    @staticmethod
+    def stack(
+        immstates: Sequence[MixtureParameters[GaussParams]],
+    ) -> MixtureParameters[GaussParamList]:
+        """Stack one immstate per target into a bank state."""
+        weights = np.array([s.weights for s in immstates], dtype=float)
+        mean = np.array([[c.mean for c in s.components] for s in immstates], dtype=float)
+        cov = np.array([[c.cov for c in s.components] for s in immstates], dtype=float)
+        return MixtureParameters(weights, GaussParamList(mean, cov))
+
+    @staticmethod
+    def unstack(
+        bankstate: MixtureParameters[GaussParamList],
+    ) -> List[MixtureParameters[GaussParams]]:
+        """Split a bank state into one immstate per target."""
+        x = bankstate.components.mean
+        P = bankstate.components.cov
+        return [
+            MixtureParameters(weights, list(GaussParamList(xi, Pi)))
+            for weights, xi, Pi in zip(bankstate.weights, x, P)
+        ]
+
+    def mix_probabilities(
+        self, bankstate: MixtureParameters[GaussParamList],
+    ) -> Tuple[
+        np.ndarray, np.ndarray
+    ]:  # predicted_mode_probabilities, mix_probabilities: shapes = ((N, M), (N, M, M)).
+        # mix_probabilities[i, s] is the mixture weights for mode s of target i
+        """Calculate the predicted mode probability and the mixing probabilities for all targets."""
+
+        predicted_mode_probabilities, mix_probabilities = discretebayes.discrete_bayes(
+            bankstate.weights, self.PI, debug=self.debug
+        )
+
+        return predicted_mode_probabilities, mix_probabilities
+
+    def mix_states(
+        self,
+        bankstate: MixtureParameters[GaussParamList],
+        # the mixing probabilities: shape=(N, M, M)
+        mix_probabilities: np.ndarray,
+    ) -> GaussParamList:
+        """Calculate the mixed state of every mode for all targets."""
+        x = bankstate.components.mean
+        P = bankstate.components.cov
+
+        # one mixture per target and mode, all sharing the components of the target
+        x_mixed, P_mixed = mixturereduction.gaussian_mixture_moments(
+            mix_probabilities, x[:, None], P[:, None]
+        )
+
+        return GaussParamList(x_mixed, P_mixed)
+
+    def mode_matched_prediction(
+        self,
+        mode_states: GaussParamList,
+        # the sampling time per target: shape=(N,)
+        Ts: np.ndarray,
+    ) -> GaussParamList:
+        """Predict every mode of every target Ts time units ahead."""
+        x = mode_states.mean
+        P = mode_states.cov
+        x_pred = np.empty_like(x)
+        P_pred = np.empty_like(P)
+
+        for s, fs in enumerate(self.filters):
+            # the models work on a single state, so only their evaluation is done per target
+            dynmod = fs.dynamic_model
+            x_s = x[:, s]
+            F = np.array([dynmod.F(xi, Ti) for xi, Ti in zip(x_s, Ts)])
+            Q = np.array([dynmod.Q(xi, Ti) for xi, Ti in zip(x_s, Ts)])
+            x_pred[:, s] = [dynmod.f(xi, Ti) for xi, Ti in zip(x_s, Ts)]
+            P_pred[:, s] = F @ P[:, s] @ F.swapaxes(-1, -2) + Q
+
+        return GaussParamList(x_pred, P_pred)
+
+    def predict(
+        self,
+        bankstate: MixtureParameters[GaussParamList],
+        # sampling time, single or per target
+        Ts: Union[float, np.ndarray],
+    ) -> MixtureParameters[GaussParamList]:
+        """Predict all the targets Ts time units ahead approximating the mixture step."""
+        N = bankstate.weights.shape[0]
+        Ts = np.broadcast_to(np.asarray(Ts, dtype=float), (N,))
+
+        predicted_mode_probabilities, mix_probabilities = self.mix_probabilities(
+            bankstate
+        )
+        mixed_mode_states = self.mix_states(bankstate, mix_probabilities)
+        predicted_mode_states = self.mode_matched_prediction(mixed_mode_states, Ts)
+
+        return MixtureParameters(predicted_mode_probabilities, predicted_mode_states)
+
+    def measurement_prediction(
+        self,
+        mode_states: GaussParamList,
+        # the measurements: shape=(N, m), or None if R does not depend on them
+        Z: Optional[np.ndarray],
+        *,
+        sensor_state: Optional[Dict[str, Any]] = None,
+    ) -> Tuple[
+        np.ndarray, np.ndarray, np.ndarray
+    ]:  # zbar, H, R: shapes=((N, M, m), (N, M, m, n), (N, M, m, m))
+        """Evaluate the measurement models at every mode of every target."""
+        x = mode_states.mean
+        N, M, n = x.shape
+        m = self.filters[0].sensor_model.m
+
+        zbar = np.empty((N, M, m))
+        H = np.empty((N, M, m, n))
+        R = np.empty((N, M, m, m))
+        for s, fs in enumerate(self.filters):
+            measmod = fs.sensor_model
+            for i, xi in enumerate(x[:, s]):
+                zi = None if Z is None else Z[i]
+                zbar[i, s] = measmod.h(xi, sensor_state=sensor_state)
+                H[i, s] = measmod.H(xi, sensor_state=sensor_state)
+                R[i, s] = measmod.R(xi, sensor_state=sensor_state, z=zi)
+
+        return zbar, H, R
+
+    def update(
+        self,
+        # the measurements: shape=(N, m)
+        Z: np.ndarray,
+        bankstate: MixtureParameters[GaussParamList],
+        present: Optional[np.ndarray] = None,
+        *,
+        sensor_state: Optional[Dict[str, Any]] = None,
+    ) -> MixtureParameters[GaussParamList]:
+        """Update the targets marked in present with their measurement in Z."""
+        N = bankstate.weights.shape[0]
+        present = (
+            np.ones(N, dtype=bool) if present is None else np.asarray(present, dtype=bool)
+        )
+        idx = np.flatnonzero(present)
+
+        weights = bankstate.weights.copy()
+        x = bankstate.components.mean.copy()
+        P = bankstate.components.cov.copy()
+        if idx.size == 0:
+            return MixtureParameters(weights, GaussParamList(x, P))
+
+        xp = x[idx]
+        Pp = P[idx]
+        Zp = np.asarray(Z, dtype=float)[idx]
+        zbar, H, R = self.measurement_prediction(
+            GaussParamList(xp, Pp), Zp, sensor_state=sensor_state
+        )
+
+        # innovation
+        v = Zp[:, None] - zbar
+        HT = H.swapaxes(-1, -2)
+        PHT = Pp @ HT
+        S = H @ PHT + R
+        cholS = np.linalg.cholesky(S)
+
+        # mode matched Kalman update in Joseph form
+        W = np.linalg.solve(S, PHT.swapaxes(-1, -2)).swapaxes(-1, -2)
+        x[idx] = xp + (W @ v[..., None])[..., 0]
+        I_WH = np.eye(xp.shape[-1]) - W @ H
+        P[idx] = I_WH @ Pp @ I_WH.swapaxes(-1, -2) + W @ R @ W.swapaxes(-1, -2)
+
+        # mode probabilities from the mode matched log likelihoods
+        invcholS_v = np.linalg.solve(cholS, v[..., None])[..., 0]
+        NISby2 = (invcholS_v ** 2).sum(axis=-1) / 2
+        logdetSby2 = np.log(np.diagonal(cholS, axis1=-2, axis2=-1)).sum(axis=-1)
+        loglikelihood = -(NISby2 + logdetSby2 + self.filters[0]._MLOG2PIby2)
+
+        logjoint = loglikelihood + np.log(weights[idx])
+        weights[idx] = np.exp(logjoint - logsumexp(logjoint, axis=1, keepdims=True))
+
+        if self.debug:
+            assert np.all(
+                np.isfinite(weights)
+            ), "IMMBank.update: updated probabilities not finite"
+
+        return MixtureParameters(weights, GaussParamList(x, P))
+
+    def scan_innovations(
+        self,
+        # the scan: shape=(K, m)
+        Z: np.ndarray,
+        bankstate: MixtureParameters[GaussParamList],
+        *,
+        sensor_state: Optional[Dict[str, Any]] = None,
+    ) -> Tuple[
+        np.ndarray, np.ndarray, np.ndarray, np.ndarray
+    ]:  # v, H, R, cholS: shapes=((N, M, K, m), (N, M, m, n), (N, M, m, m), (N, M, m, m))
+        """Calculate the innovations of every scan measurement for every mode of every target."""
+        zbar, H, R = self.measurement_prediction(
+            bankstate.components, None, sensor_state=sensor_state
+        )
+        P = bankstate.components.cov
+        S = H @ P @ H.swapaxes(-1, -2) + R
+        cholS = np.linalg.cholesky(S)
+        v = np.asarray(Z, dtype=float)[None, None] - zbar[:, :, None]
+        return v, H, R, cholS
+
+    @staticmethod
+    def _whiten(
+        # the lower Cholesky factors of S: shape=(N, M, m, m)
+        cholS: np.ndarray,
+        # the innovations: shape=(N, M, K, m)
+        v: np.ndarray,
+    ) -> np.ndarray:  # cholS^(-1) v: shape=(N, M, K, m)
+        """Whiten all the innovations with one batched solve."""
+        return np.linalg.solve(cholS, v.swapaxes(-1, -2)).swapaxes(-1, -2)
+
+    def gate(
+        self,
+        # the scan: shape=(K, m)
+        Z: np.ndarray,
+        bankstate: MixtureParameters[GaussParamList],
+        gate_size_square: float,
+        *,
+        sensor_state: Optional[Dict[str, Any]] = None,
+    ) -> np.ndarray:  # gated: shape=(N, K)
+        """Check which scan measurements are within the gate of any mode of every target."""
+        v, _, _, cholS = self.scan_innovations(Z, bankstate, sensor_state=sensor_state)
+        NIS = (self._whiten(cholS, v) ** 2).sum(axis=-1)
+        return (NIS < gate_size_square).any(axis=1)
+
+    def pda_update(
+        self,
+        # the scan: shape=(K, m)
+        Z: np.ndarray,
+        bankstate: MixtureParameters[GaussParamList],
+        # the clutter intensity, single or at every scan measurement: shape=(K,)
+        clutter_intensity: Union[float, np.ndarray],
+        PD: float,
+        gate_size_square: float,
+        *,
+        sensor_state: Optional[Dict[str, Any]] = None,
+    ) -> Tuple[
+        MixtureParameters[GaussParamList], np.ndarray, np.ndarray
+    ]:  # updated bankstate, gated, log_evidence_ratio: shapes=(..., (N, K), (N,))
+        """
+        Gate the scan and perform the IMM-PDA update of all the targets at once.
+
+        The joint association and mode probabilities are
+            Pr(a=0, s) ~ Pr(s) (1 - PD),
+            Pr(a=j, s) ~ Pr(s) PD N(z_j; zbar_s, S_s) / clutter_intensity_j for the gated z_j.
+        Every mode is then updated with the closed form combined innovation
+        using Pr(a | s) (see EKF.combined_update), and Pr(s) is updated to sum_a Pr(a, s).
+
+        log_evidence_ratio is the log likelihood ratio of the scan given the target
+        relative to the scan being only clutter, ie. log(1 - PD + PD sum_j l_j / clutter_intensity_j).
+        """
+        weights = bankstate.weights
+        x = bankstate.components.mean
+        P = bankstate.components.cov
+        N, M = weights.shape
+
+        v, H, R, cholS = self.scan_innovations(Z, bankstate, sensor_state=sensor_state)
+        K = v.shape[2]
+
+        # gating and the mode matched log likelihoods
+        NIS = (self._whiten(cholS, v) ** 2).sum(axis=-1)
+        gated = (NIS < gate_size_square).any(axis=1)
+        logdetSby2 = np.log(np.diagonal(cholS, axis1=-2, axis2=-1)).sum(axis=-1)
+        loglikelihood = -(NIS / 2 + logdetSby2[..., None] + self.filters[0]._MLOG2PIby2)
+
+        # joint association and mode log probabilities relative to clutter: shape=(N, M, K + 1)
+        log_clutter = np.broadcast_to(np.log(clutter_intensity), (K,))
+        logjoint = np.empty((N, M, K + 1))
+        logjoint[:, :, 0] = np.log(1 - PD)
+        logjoint[:, :, 1:] = np.where(
+            gated[:, None], np.log(PD) + loglikelihood - log_clutter, -np.inf
+        )
+        logjoint += np.log(weights)[..., None]
+
+        logmode = logsumexp(logjoint, axis=-1)
+        log_evidence_ratio = logsumexp(logmode, axis=-1)
+        updated_weights = np.exp(logmode - log_evidence_ratio[:, None])
+        beta = np.exp(logjoint - logmode[..., None])  # Pr(a | s)
+
+        # per mode combined innovation update
+        HT = H.swapaxes(-1, -2)
+        PHT = P @ HT
+        W = np.linalg.solve(
+            cholS.swapaxes(-1, -2),
+            np.linalg.solve(cholS, PHT.swapaxes(-1, -2)),
+        ).swapaxes(-1, -2)
+
+        beta_detected = beta[..., 1:]
+        vbar = (beta_detected[..., None, :] @ v)[..., 0, :]
+        x_upd = x + (W @ vbar[..., None])[..., 0]
+
+        I_WH = np.eye(x.shape[-1]) - W @ H
+        P_detected = I_WH @ P @ I_WH.swapaxes(-1, -2) + W @ R @ W.swapaxes(-1, -2)
+        v_spread = (v * beta_detected[..., None]).swapaxes(-1, -2) @ v - (
+            vbar[..., :, None] * vbar[..., None, :]
+        )
+        beta_missed = beta[..., 0, None, None]
+        P_upd = (
+            beta_missed * P
+            + (1 - beta_missed) * P_detected
+            + W @ v_spread @ W.swapaxes(-1, -2)
+        )
+
+        if self.debug:
+            assert np.all(
+                np.isfinite(updated_weights)
+            ), "IMMBank.pda_update: updated probabilities not finite"
+            assert np.all(
+                np.isfinite(P_upd)
+            ), "IMMBank.pda_update: updated covariances not finite"
+
+        return (
+            MixtureParameters(updated_weights, GaussParamList(x_upd, P_upd)),
+            gated,
+            log_evidence_ratio,
+        )
+
+    def step(
+        self,
+        # the measurements: shape=(N, m)
+        Z: np.ndarray,
+        bankstate: MixtureParameters[GaussParamList],
+        Ts: Union[float, np.ndarray],
+        present: Optional[np.ndarray] = None,
+        *,
+        sensor_state: Optional[Dict[str, Any]] = None,
+    ) -> MixtureParameters[GaussParamList]:
+        """Predict all the targets Ts time units ahead and update the present ones with Z"""
+        predicted_bankstate = self.predict(bankstate, Ts)
+        return self.update(
+            Z, predicted_bankstate, present, sensor_state=sensor_state
+        )
+
+    def estimate(self, bankstate: MixtureParameters[GaussParamList]) -> GaussParamList:
+        """Calculate a state estimate with its covariance for every target."""
+        xbar, Pbar = mixturereduction.gaussian_mixture_moments(
+            bankstate.weights, bankstate.components.mean, bankstate.components.cov
+        )
+        return GaussParamList(xbar, Pbar)
@@ -0,0 +1,118 @@
+"""
+Integrated PDA (IPDA): the PDA with the probability that the target exists carried in the state.
+
+With the PDA loglikelihood ratios ll (first element for no detection), which are relative to clutter,
+    1 - delta = sum(exp(ll)) = 1 - PD + PD sum_j l_j / lambda_j
+is the likelihood ratio of the gated measurements given an existing target relative to only clutter.
+The existence probability r is then predicted and updated as
+    r- = P_S r,
+    r+ = r- (1 - delta) / (1 - delta r-),
+while the state itself gets the usual PDA update conditioned on existence.
+"""
+from typing import TypeVar, Optional, Dict, Any, Generic
+from dataclasses import dataclass
+import numpy as np
+from scipy.special import logsumexp
+
+from pda import PDA
+from gaussparams import GaussParams
+from spatialindex import ScanIndex
+
+ET = TypeVar("ET")
+
+
+@dataclass
+class IPDAState(Generic[ET]):
+    # the probability that the target exists
+    existence: float
+    # the state of the PDA's state_filter conditioned on existence
+    filter_state: ET
+
+
+def existence_update(
+    # existence probability, single or per track
+    existence: np.ndarray,
+    # log(1 - delta), the log likelihood ratio of the scan given the track relative to only clutter
+    log_evidence_ratio: np.ndarray,
+) -> np.ndarray:
+    """Update the existence probability with the evidence of a scan."""
+    # r (1 - delta) / (1 - delta r) = 1 / (1 + (1 - r) / (r (1 - delta)))
+    with np.errstate(divide="ignore"):
+        log_odds = np.log(existence) - np.log1p(-existence) + log_evidence_ratio
+    return 1 / (1 + np.exp(-log_odds))
+
+
+@dataclass
+class IPDA(Generic[ET]):
+    # the single target PDA used for gating, likelihoods and the association mixture update
+    pda: PDA[ET]
+    # the probability that an existing target still exists after one prediction
+    survival_probability: float = 0.99
+
+    def predict(self, filter_state: IPDAState[ET], Ts: float) -> IPDAState[ET]:
+        """Predict the state Ts time units ahead and the existence one scan ahead"""
+        return IPDAState(
+            self.survival_probability * filter_state.existence,
+            self.pda.predict(filter_state.filter_state, Ts),
+        )
+
+    def update(
+        self,
+        # measurements of shape=(M, m)=(#measurements, dim)
+        Z: np.ndarray,
+        filter_state: IPDAState[ET],
+        *,
+        sensor_state: Optional[Dict[str, Any]] = None,
+        scan_index: Optional[ScanIndex] = None,
+        # clutter intensity at each measurement, shape=(M,). Defaults to pda.clutter_intensity
+        clutter_intensity: Optional[np.ndarray] = None,
+    ) -> IPDAState[ET]:
+        """Perform the PDA update of the state and update the existence probability."""
+        state = filter_state.filter_state
+        gated = self.pda.gate(Z, state, sensor_state=sensor_state, scan_index=scan_index)
+        Zg = Z[gated]
+        if clutter_intensity is not None:
+            clutter_intensity = np.asarray(clutter_intensity)[gated]
+
+        lls = self.pda.loglikelihood_ratios(
+            Zg, state, sensor_state=sensor_state, clutter_intensity=clutter_intensity
+        )
+        total = logsumexp(lls)
+        beta = np.exp(lls - total)
+
+        existence = existence_update(filter_state.existence, total)
+
+        return IPDAState(
+            float(existence),
+            self.pda.mixture_update(Zg, beta, state, sensor_state=sensor_state),
+        )
+
+    def step(
+        self,
+        # measurements of shape=(M, m)=(#measurements, dim)
+        Z: np.ndarray,
+        filter_state: IPDAState[ET],
+        Ts: float,
+        *,
+        sensor_state: Optional[Dict[str, Any]] = None,
+        scan_index: Optional[ScanIndex] = None,
+        # clutter intensity at each measurement, shape=(M,). Defaults to pda.clutter_intensity
+        clutter_intensity: Optional[np.ndarray] = None,
+    ) -> IPDAState[ET]:
+        """Perform a predict update cycle with Ts time units and measurements Z in sensor_state"""
+        filter_state_predicted = self.predict(filter_state, Ts)
+        return self.update(
+            Z,
+            filter_state_predicted,
+            sensor_state=sensor_state,
+            scan_index=scan_index,
+            clutter_intensity=clutter_intensity,
+        )
+
+    def estimate(self, filter_state: IPDAState[ET]) -> GaussParams:
+        """Get an estimate with its covariance given that the target exists."""
+        return self.pda.estimate(filter_state.filter_state)
+
+    def init_filter_state(self, init_state: ET, existence: float = 0.5) -> IPDAState[ET]:
+        """Initialize a state with the given existence probability."""
+        return IPDAState(existence, self.pda.init_filter_state(init_state))
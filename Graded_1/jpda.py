@@ -0,0 +1,288 @@
+"""
+Joint probabilistic data association (JPDA) for a known number of targets sharing the scans.
+
+A joint association event assigns each target either no detection or a gated measurement, with no
+measurement used by two targets. With the PDA loglikelihood ratios l[t, a] for target t and
+association a (0 is no detection), the joint event probability is proportional to
+prod_t exp(l[t, a_t]), since every target contributes exactly one factor of the clutter intensity.
+
+Targets that do not share gated measurements are independent, so the targets are clustered by
+gate overlap and every cluster is marginalized separately. Small clusters enumerate their events
+exactly, larger ones approximate the marginals by the max_hypotheses best events found by Murty's
+algorithm over scipy.optimize.linear_sum_assignment.
+"""
+from typing import TypeVar, Optional, Dict, Any, List, Generic, Tuple
+from dataclasses import dataclass
+import heapq
+import itertools
+
+import numpy as np
+from scipy.optimize import linear_sum_assignment
+from scipy.sparse.csgraph import connected_components
+from scipy.special import logsumexp
+
+from pda import PDA
+from gaussparams import GaussParams
+from spatialindex import ScanIndex
+import profiling
+
+ET = TypeVar("ET")
+
+
+@dataclass
+class JPDA(Generic[ET]):
+    # the single target PDA used for gating, likelihoods and the association mixture update
+    pda: PDA[ET]
+    # clusters with at most this many joint events are marginalized exactly
+    max_exact_events: int = 1000
+    # the number of best joint events used to approximate the marginals of larger clusters
+    max_hypotheses: int = 100
+
+    def predict(self, filter_states: List[ET], Ts: float) -> List[ET]:
+        """Predict all the target states Ts time units ahead"""
+        return [self.pda.predict(fs, Ts) for fs in filter_states]
+
+    def gate(
+        self,
+        # measurements of shape=(M, m)=(#measurements, dim)
+        Z: np.ndarray,
+        filter_states: List[ET],
+        *,
+        sensor_state: Optional[Dict[str, Any]] = None,
+    ) -> np.ndarray:  # gated (T, M): gated[t, j] = true if measurement j is within the gate of target t
+        """Gate the measurements against every target, sharing one spatial index for the scan."""
+        scan_index = ScanIndex(Z) if len(filter_states) > 1 else None
+        gated = np.zeros((len(filter_states), Z.shape[0]), dtype=bool)
+        for t, fs in enumerate(filter_states):
+            gated[t] = self.pda.gate(
+                Z, fs, sensor_state=sensor_state, scan_index=scan_index
+            )
+        return gated
+
+    def loglikelihood_ratios(
+        self,
+        # measurements of shape=(M, m)=(#measurements, dim)
+        Z: np.ndarray,
+        filter_states: List[ET],
+        gated: np.ndarray,
+        *,
+        sensor_state: Optional[Dict[str, Any]] = None,
+        # clutter intensity at each measurement, shape=(M,). Defaults to pda.clutter_intensity
+        clutter_intensity: Optional[np.ndarray] = None,
+    ) -> np.ndarray:  # shape=(T, M + 1), first column for no detection, -inf outside the gates
+        """Calculate the PDA loglikelihood ratios of every target for its gated measurements."""
+        ll = np.full((len(filter_states), Z.shape[0] + 1), -np.inf)
+        for t, fs in enumerate(filter_states):
+            columns = np.concatenate(([0], 1 + np.flatnonzero(gated[t])))
+            ll[t, columns] = self.pda.loglikelihood_ratios(
+                Z[gated[t]],
+                fs,
+                sensor_state=sensor_state,
+                clutter_intensity=None
+                if clutter_intensity is None
+                else np.asarray(clutter_intensity)[gated[t]],
+            )
+        return ll
+
+    @profiling.stage("JPDA.association_probabilities")
+    def association_probabilities(
+        self,
+        # measurements of shape=(M, m)=(#measurements, dim)
+        Z: np.ndarray,
+        filter_states: List[ET],
+        gated: np.ndarray,
+        *,
+        sensor_state: Optional[Dict[str, Any]] = None,
+        # clutter intensity at each measurement, shape=(M,). Defaults to pda.clutter_intensity
+        clutter_intensity: Optional[np.ndarray] = None,
+    ) -> np.ndarray:  # beta, shape=(T, M + 1): the marginal association probabilities per target
+        """Calculate the marginal association probabilities of every target."""
+        T = len(filter_states)
+        ll = self.loglikelihood_ratios(
+            Z,
+            filter_states,
+            gated,
+            sensor_state=sensor_state,
+            clutter_intensity=clutter_intensity,
+        )
+        beta = np.zeros_like(ll)
+        if T == 0:
+            return beta
+
+        # targets are connected when they share a gated measurement
+        overlap = (gated.astype(int) @ gated.T.astype(int)) > 0
+        num_clusters, labels = connected_components(overlap, directed=False)
+
+        for c in range(num_clusters):
+            targets = np.flatnonzero(labels == c)
+            measurements = np.flatnonzero(gated[targets].any(axis=0))
+            columns = np.concatenate(([0], 1 + measurements))
+            ll_cluster = ll[np.ix_(targets, columns)]
+
+            num_events = np.prod(np.isfinite(ll_cluster).sum(axis=1), dtype=float)
+            if num_events <= self.max_exact_events:
+                events = enumerate_events(ll_cluster)
+            else:
+                events = murty_events(ll_cluster, self.max_hypotheses)
+
+            beta[np.ix_(targets, columns)] = marginal_association_probabilities(
+                ll_cluster, events
+            )
+
+        return beta
+
+    @profiling.stage("JPDA.update")
+    def update(
+        self,
+        # measurements of shape=(M, m)=(#measurements, dim)
+        Z: np.ndarray,
+        filter_states: List[ET],
+        *,
+        sensor_state: Optional[Dict[str, Any]] = None,
+        # clutter intensity at each measurement, shape=(M,). Defaults to pda.clutter_intensity
+        clutter_intensity: Optional[np.ndarray] = None,
+    ) -> List[ET]:
+        """Perform the JPDA update cycle for all targets."""
+        gated = self.gate(Z, filter_states, sensor_state=sensor_state)
+        beta = self.association_probabilities(
+            Z,
+            filter_states,
+            gated,
+            sensor_state=sensor_state,
+            clutter_intensity=clutter_intensity,
+        )
+
+        updated = []
+        for t, fs in enumerate(filter_states):
+            columns = np.concatenate(([0], 1 + np.flatnonzero(gated[t])))
+            updated.append(
+                self.pda.mixture_update(
+                    Z[gated[t]], beta[t, columns], fs, sensor_state=sensor_state
+                )
+            )
+        return updated
+
+    def step(
+        self,
+        # measurements of shape=(M, m)=(#measurements, dim)
+        Z: np.ndarray,
+        filter_states: List[ET],
+        Ts: float,
+        *,
+        sensor_state: Optional[Dict[str, Any]] = None,
+        # clutter intensity at each measurement, shape=(M,). Defaults to pda.clutter_intensity
+        clutter_intensity: Optional[np.ndarray] = None,
+    ) -> List[ET]:
+        """Perform a predict update cycle with Ts time units and measurements Z in sensor_state"""
+        filter_states_predicted = self.predict(filter_states, Ts)
+        return self.update(
+            Z,
+            filter_states_predicted,
+            sensor_state=sensor_state,
+            clutter_intensity=clutter_intensity,
+        )
+
+    def estimate(self, filter_states: List[ET]) -> List[GaussParams]:
+        """Get an estimate with its covariance for every target."""
+        return [self.pda.estimate(fs) for fs in filter_states]
+
+
+def enumerate_events(
+    # loglikelihood ratios, -inf for impossible associations: shape=(T, M + 1)
+    ll: np.ndarray,
+) -> np.ndarray:  # all feasible joint events, events[e, t] = association of target t: shape=(E, T)
+    """Enumerate all joint events where no measurement is used by more than one target."""
+    T = ll.shape[0]
+    options = [np.flatnonzero(np.isfinite(ll[t])) for t in range(T)]
+    events: List[Tuple[int, ...]] = []
+
+    def recurse(t: int, event: List[int], used: set) -> None:
+        if t == T:
+            events.append(tuple(event))
+            return
+        for a in options[t]:
+            if a == 0 or a not in used:
+                event.append(a)
+                if a > 0:
+                    used.add(a)
+                recurse(t + 1, event, used)
+                used.discard(a)
+                event.pop()
+
+    recurse(0, [], set())
+    return np.array(events, dtype=int).reshape(-1, T)
+
+
+def murty_events(
+    # loglikelihood ratios, -inf for impossible associations: shape=(T, M + 1)
+    ll: np.ndarray,
+    k: int,
+) -> np.ndarray:  # the k most probable joint events, events[e, t] = association of target t: shape=(E, T)
+    """
+    Find the k most probable joint events with Murty's algorithm.
+
+    Each event is an assignment in the (T, M + T) cost matrix where column j < M is measurement j + 1
+    and column M + t is the no detection of target t only.
+    """
+    T, M = ll.shape[0], ll.shape[1] - 1
+    cost = np.full((T, M + T), np.inf)
+    cost[:, :M] = -ll[:, 1:]
+    cost[np.arange(T), M + np.arange(T)] = -ll[:, 0]
+
+    def solve(
+        forced: Tuple[Tuple[int, int], ...], excluded: Tuple[Tuple[int, int], ...]
+    ) -> Optional[Tuple[float, np.ndarray]]:
+        constrained = cost.copy()
+        for r, c in excluded:
+            constrained[r, c] = np.inf
+        for r, c in forced:
+            keep = constrained[r, c]
+            constrained[r, :] = np.inf
+            constrained[:, c] = np.inf
+            constrained[r, c] = keep
+        try:
+            rows, cols = linear_sum_assignment(constrained)
+        except ValueError:  # infeasible
+            return None
+        total = constrained[rows, cols].sum()
+        return (total, cols) if np.isfinite(total) else None
+
+    counter = itertools.count()
+    best = solve((), ())
+    queue = [(best[0], next(counter), best[1], (), ())]
+    events = []
+    while queue and len(events) < k:
+        _, _, cols, forced, excluded = heapq.heappop(queue)
+        events.append(cols)
+
+        # partition the remaining solution space on this assignment
+        for r in range(len(forced), T):
+            sub_forced = forced + tuple((rr, cols[rr]) for rr in range(len(forced), r))
+            sub_excluded = excluded + ((r, cols[r]),)
+            solution = solve(sub_forced, sub_excluded)
+            if solution is not None:
+                heapq.heappush(
+                    queue,
+                    (solution[0], next(counter), solution[1], sub_forced, sub_excluded),
+                )
+
+    # columns to associations
+    events = np.array(events, dtype=int).reshape(-1, T)
+    return np.where(events < M, events + 1, 0)
+
+
+def marginal_association_probabilities(
+    # loglikelihood ratios: shape=(T, M + 1)
+    ll: np.ndarray,
+    # joint events: shape=(E, T)
+    events: np.ndarray,
+) -> np.ndarray:  # beta, shape=(T, M + 1)
+    """Marginalize the normalized joint event probabilities to per target association probabilities."""
+    T = ll.shape[0]
+    event_ll = ll[np.arange(T), events].sum(axis=1)
+    event_probabilities = np.exp(event_ll - logsumexp(event_ll))
+
+    beta = np.zeros_like(ll)
+    for t in range(T):
+        np.add.at(beta[t], events[:, t], event_probabilities)
+    return beta
@@ -1,29 +1,132 @@
 from typing import Tuple
+import heapq
 
 import numpy as np
 
+import profiling
 
+
+@profiling.stage("mixturereduction.gaussian_mixture_moments")
 def gaussian_mixture_moments(
-    w: np.ndarray,  # the mixture weights shape=(N,)
-    x: np.ndarray,  # the mixture means shape(N, n)
-    P: np.ndarray,  # the mixture covariances shape (N, n, n)
+    w: np.ndarray,  # the mixture weights shape=(..., N)
+    x: np.ndarray,  # the mixture means shape(..., N, n)
+    P: np.ndarray,  # the mixture covariances shape (..., N, n, n)
 ) -> Tuple[
     np.ndarray, np.ndarray
-]:  # the mean and covariance of of the mixture shapes ((n,), (n, n))
-    """Calculate the first two moments of a Gaussian mixture"""
+]:  # the mean and covariance of of the mixture shapes ((..., n), (..., n, n))
+    """Calculate the first two moments of a Gaussian mixture, or of a batch of mixtures"""
+    w = np.asarray(w, dtype=float)
+    n = x.shape[-1]
+
+    # normalized weights as a row vector for matrix products: shape=(..., 1, N)
+    w_row = (w / w.sum(axis=-1, keepdims=True))[..., None, :]
 
     # mean
-    xbar = np.average(x, axis=0, weights=w)
+    xbar = (w_row @ x)[..., 0, :]
 
     # covariance
-    # # internal covariance
-    Pint = np.average(P, axis=0, weights=w)
+    # # internal covariance, as one product over the flattened covariances
+    Pint = (w_row @ P.reshape(*P.shape[:-2], n * n)).reshape(*w_row.shape[:-2], n, n)
 
-    # # spread of means
-    xdiff = x - xbar[None]
-    Pext = np.average(xdiff[:, :, None] * xdiff[:, None, :], axis=0, weights=w)
+    # # spread of means, as the single product (xdiff * w)^T @ xdiff
+    xdiff = x - xbar[..., None, :]
+    Pext = (xdiff * w_row.swapaxes(-1, -2)).swapaxes(-1, -2) @ xdiff
 
     # # total
     Pbar = Pint + Pext
 
     return xbar, Pbar
+
+
+def _merge_costs(
+    w: np.ndarray,  # the weights shape=(N,)
+    x: np.ndarray,  # the means shape=(N, n)
+    P: np.ndarray,  # the covariances shape=(N, n, n)
+    logdetP: np.ndarray,  # log determinants of the covariances shape=(N,)
+    i: np.ndarray,  # first index of the pairs shape=(B,)
+    j: np.ndarray,  # second index of the pairs shape=(B,)
+    cost: str,
+    invPtot: np.ndarray,  # inverse of the total mixture covariance, used by Salmond shape=(n, n)
+) -> np.ndarray:  # the cost of merging pair i[b], j[b] shape=(B,)
+    """Calculate the merging costs of a batch of component pairs"""
+    wi, wj = w[i], w[j]
+    if cost == "runnalls":
+        # Runnalls' upper bound on the KL divergence from the mixture before merging
+        pair_w = np.stack((wi, wj), axis=-1)
+        pair_x = np.stack((x[i], x[j]), axis=-2)
+        pair_P = np.stack((P[i], P[j]), axis=-3)
+        _, Pij = gaussian_mixture_moments(pair_w, pair_x, pair_P)
+        logdetPij = np.linalg.slogdet(Pij)[1]
+        return 0.5 * ((wi + wj) * logdetPij - wi * logdetP[i] - wj * logdetP[j])
+    elif cost == "salmond":
+        # Salmond's increase in within-component scatter, measured by the total covariance
+        xdiff = x[i] - x[j]
+        return wi * wj / (wi + wj) * ((xdiff @ invPtot) * xdiff).sum(axis=-1)
+    else:
+        raise ValueError(f"mixturereduction: unknown merge cost {cost}")
+
+
+@profiling.stage("mixturereduction.reduce_mixture_components")
+def reduce_mixture_components(
+    w: np.ndarray,  # the mixture weights shape=(N,)
+    x: np.ndarray,  # the mixture means shape(N, n)
+    P: np.ndarray,  # the mixture covariances shape (N, n, n)
+    K: int,  # the maximum number of components to keep
+    cost: str = "runnalls",  # "runnalls" or "salmond"
+) -> Tuple[
+    np.ndarray, np.ndarray, np.ndarray
+]:  # the reduced weights, means and covariances shapes ((K,), (K, n), (K, n, n))
+    """
+    Reduce a Gaussian mixture to at most K components by greedy pairwise merging.
+
+    The pair with the lowest merging cost is merged until K components are left.
+    All pairwise costs are calculated once and kept in a heap, and only the costs
+    involving a newly merged component are recalculated. Outdated heap entries are
+    recognized by a version counter per component and skipped when popped.
+    """
+    w = np.array(w, dtype=float)
+    x = np.array(x, dtype=float)
+    P = np.array(P, dtype=float)
+    N = w.shape[0]
+    assert K >= 1, "mixturereduction.reduce_mixture_components: K must be positive"
+    if N <= K:
+        return w, x, P
+
+    logdetP = np.linalg.slogdet(P)[1]
+    invPtot = np.linalg.inv(gaussian_mixture_moments(w, x, P)[1]) if cost == "salmond" else None
+
+    active = np.ones(N, dtype=bool)
+    version = np.zeros(N, dtype=int)
+
+    # all pairwise costs at once
+    i, j = np.triu_indices(N, k=1)
+    costs = _merge_costs(w, x, P, logdetP, i, j, cost, invPtot)
+    heap = list(zip(costs.tolist(), i.tolist(), j.tolist(), [0] * i.size, [0] * i.size))
+    heapq.heapify(heap)
+
+    num_active = N
+    while num_active > K:
+        _, i, j, version_i, version_j = heapq.heappop(heap)
+        if not (active[i] and active[j]) or (version[i], version[j]) != (version_i, version_j):
+            continue  # outdated entry
+
+        # merge j into i
+        w_ij = w[[i, j]]
+        x[i], P[i] = gaussian_mixture_moments(w_ij, x[[i, j]], P[[i, j]])
+        w[i] = w_ij.sum()
+        logdetP[i] = np.linalg.slogdet(P[i])[1]
+        version[i] += 1
+        active[j] = False
+        num_active -= 1
+
+        # new costs between the merged component and the remaining ones
+        others = np.flatnonzero(active)
+        others = others[others != i]
+        if others.size > 0:
+            first = np.minimum(others, i)
+            second = np.maximum(others, i)
+            new_costs = _merge_costs(w, x, P, logdetP, first, second, cost, invPtot)
+            for c, a, b in zip(new_costs.tolist(), first.tolist(), second.tolist()):
+                heapq.heappush(heap, (c, a, b, version[a], version[b]))
+
+    return w[active], x[active], P[active]
@@ -0,0 +1,313 @@
+"""
+Monte Carlo consistency analysis of a state estimator over many simulated realizations.
+
+R trajectories with their measurements are sampled from a dynamic and a measurement model with
+independent seeds. The estimator is then run on every realization in a process pool. The datasets
+are placed in shared memory once, so every worker reads them in place instead of receiving them
+pickled with every task, and the estimator is sent once per worker.
+
+The results are aggregated to
+    ANEES and ANIS over all runs and time steps, and per time step over the runs,
+    with chi-square confidence intervals,
+    position and velocity RMSE per time step with percentile bands over the runs.
+"""
+# %% Imports
+# types
+from typing import Any, Dict, Optional, Sequence, Tuple, Union
+
+# packages
+from dataclasses import dataclass
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+
+# local
+import dynamicmodels
+import measurementmodels
+import estimationstatistics as estats
+
+
+# %% Simulation
+def sample_trajectory(
+    dynamic_model: dynamicmodels.DynamicModel,
+    measurement_model: measurementmodels.MeasurementModel,
+    # number of time steps
+    K: int,
+    # sampling time
+    Ts: float,
+    # initial state distribution, shapes=((n,), (n, n))
+    x0: np.ndarray,
+    P0: np.ndarray,
+    rng: np.random.Generator,
+) -> Tuple[np.ndarray, np.ndarray]:  # Xgt, Z: shapes=((K, n), (K, m))
+    """Sample a trajectory with the process noise Q of dynamic_model and its measurements with noise R."""
+    n = x0.shape[0]
+    m = measurement_model.m
+    Xgt = np.empty((K, n))
+    Z = np.empty((K, m))
+
+    x = rng.multivariate_normal(x0, P0, method="eigh")
+    for k in range(K):
+        Q = dynamic_model.Q(x, Ts)
+        x = dynamic_model.f(x, Ts) + rng.multivariate_normal(np.zeros(n), Q, method="eigh")
+        R = measurement_model.R(x)
+        Xgt[k] = x
+        Z[k] = measurement_model.h(x) + rng.multivariate_normal(np.zeros(m), R, method="eigh")
+
+    return Xgt, Z
+
+
+def simulate(
+    dynamic_model: dynamicmodels.DynamicModel,
+    measurement_model: measurementmodels.MeasurementModel,
+    # number of realizations
+    R: int,
+    K: int,
+    Ts: float,
+    x0: np.ndarray,
+    P0: np.ndarray,
+    seed: Optional[int] = None,
+) -> Tuple[np.ndarray, np.ndarray]:  # Xgt, Z: shapes=((R, K, n), (R, K, m))
+    """Sample R independent realizations, each with its own seed spawned from seed."""
+    rngs = [np.random.default_rng(s) for s in np.random.SeedSequence(seed).spawn(R)]
+    realizations = [
+        sample_trajectory(dynamic_model, measurement_model, K, Ts, x0, P0, rng)
+        for rng in rngs
+    ]
+    Xgt = np.array([Xgt_r for Xgt_r, _ in realizations])
+    Z = np.array([Z_r for _, Z_r in realizations])
+    return Xgt, Z
+
+
+# %% Running an estimator
+def run_estimator(
+    # a StateEstimator, eg. an EKF or IMM
+    estimator: Any,
+    init_state: Any,
+    # measurements, shape=(K, m), or K scans of shape=(M, m) for a PDA
+    Z: Union[np.ndarray, Sequence[np.ndarray]],
+    # ground truth, shape=(K, n)
+    Xgt: np.ndarray,
+    # sampling time, single or per time step: shape=(K,)
+    Ts: Union[float, np.ndarray],
+    # the part of the state to calculate NEES for
+    idxs: Sequence[int],
+    pos_idx: Sequence[int],
+    vel_idx: Sequence[int],
+) -> Dict[str, np.ndarray]:  # NEES, NIS, pos_err, vel_err: shape=(K,) each
+    """Run estimator over one realization and calculate NEES, NIS and errors of the updated estimates."""
+    K = len(Z)
+    Ts = np.broadcast_to(Ts, (K,))
+    x_hat = np.empty((K, len(idxs)))
+    P_hat = np.empty((K, len(idxs), len(idxs)))
+    NIS = np.full(K, np.nan)
+
+    state = init_state
+    for k, zk in enumerate(Z):
+        predicted = estimator.predict(state, Ts[k])
+        if hasattr(estimator, "NISes"):  # IMM
+            NIS[k] = estimator.NISes(zk, predicted)[0]
+        elif hasattr(estimator, "NIS"):
+            NIS[k] = estimator.NIS(zk, predicted)
+        state = estimator.update(zk, predicted)
+
+        estimate = estimator.estimate(state)
+        x_hat[k] = estimate.mean[idxs]
+        P_hat[k] = estimate.cov[np.ix_(idxs, idxs)]
+
+    X = Xgt[:, idxs]
+    pos = np.flatnonzero(np.isin(idxs, pos_idx))
+    vel = np.flatnonzero(np.isin(idxs, vel_idx))
+    return dict(
+        NEES=estats.NEES_sequence(x_hat, P_hat, X),
+        NIS=NIS,
+        pos_err=estats.distance_sequence(x_hat[:, pos], X[:, pos]),
+        vel_err=estats.distance_sequence(x_hat[:, vel], X[:, vel]),
+    )
+
+
+# %% Process pool workers
+# the datasets and estimator of a worker process, set once by _init_worker
+_worker: Dict[str, Any] = {}
+
+
+def _init_worker(
+    # name, shape and dtype of the shared memory block of each dataset
+    shared: Dict[str, Tuple[str, Tuple[int, ...], str]],
+    run_kwargs: Dict[str, Any],
+) -> None:
+    for key, (name, shape, dtype) in shared.items():
+        shm = shared_memory.SharedMemory(name=name)
+        _worker[key + "_shm"] = shm  # keep the mapping alive
+        _worker[key] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    _worker["run_kwargs"] = run_kwargs
+
+
+def _run_worker(r: int) -> Dict[str, np.ndarray]:
+    return run_estimator(Z=_worker["Z"][r], Xgt=_worker["Xgt"][r], **_worker["run_kwargs"])
+
+
+def _to_shared_memory(arr: np.ndarray) -> Tuple[shared_memory.SharedMemory, np.ndarray]:
+    shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+    shared = np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)
+    shared[...] = arr
+    return shm, shared
+
+
+# %% Results
+@dataclass
+class MonteCarloResult:
+    # shape=(R, K) each
+    NEES: np.ndarray
+    NIS: np.ndarray
+    pos_err: np.ndarray
+    vel_err: np.ndarray
+    # degrees of freedom of NEES and NIS
+    NEES_dof: int
+    NIS_dof: int
+
+    def ANEES(self, confidence: float = 0.95) -> Tuple[float, Tuple[float, float]]:
+        """ANEES over all runs and time steps with its confidence interval."""
+        return (
+            self.NEES.mean(),
+            estats.chi2_average_interval(self.NEES_dof, self.NEES.size, confidence),
+        )
+
+    def ANIS(self, confidence: float = 0.95) -> Tuple[float, Tuple[float, float]]:
+        """ANIS over all runs and time steps with its confidence interval."""
+        NIS = self.NIS[np.isfinite(self.NIS)]
+        return (
+            NIS.mean(),
+            estats.chi2_average_interval(self.NIS_dof, NIS.size, confidence),
+        )
+
+    def ANEES_sequence(
+        self, confidence: float = 0.95
+    ) -> Tuple[np.ndarray, Tuple[float, float]]:  # shape=(K,) and the interval
+        """ANEES over the runs per time step with its confidence interval."""
+        R = self.NEES.shape[0]
+        return (
+            self.NEES.mean(axis=0),
+            estats.chi2_average_interval(self.NEES_dof, R, confidence),
+        )
+
+    def ANIS_sequence(
+        self, confidence: float = 0.95
+    ) -> Tuple[np.ndarray, Tuple[float, float]]:  # shape=(K,) and the interval
+        """ANIS over the runs per time step with its confidence interval."""
+        R = self.NIS.shape[0]
+        return (
+            self.NIS.mean(axis=0),
+            estats.chi2_average_interval(self.NIS_dof, R, confidence),
+        )
+
+    def RMSE_sequence(
+        self, which: str = "pos", band: float = 0.95
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:  # RMSE, lower, upper: shapes=(K,)
+        """RMSE over the runs per time step, with the band of the middle band fraction of the run errors."""
+        err = self.pos_err if which == "pos" else self.vel_err
+        tail = (1 - band) / 2 * 100
+        lower, upper = np.percentile(err, [tail, 100 - tail], axis=0)
+        return np.sqrt(np.mean(err ** 2, axis=0)), lower, upper
+
+    def summary(self, confidence: float = 0.95) -> Dict[str, Any]:
+        """ANEES and ANIS with their intervals and the total RMSEs."""
+        return dict(
+            ANEES=self.ANEES(confidence),
+            ANIS=self.ANIS(confidence),
+            pos_RMSE=np.sqrt(np.mean(self.pos_err ** 2)),
+            vel_RMSE=np.sqrt(np.mean(self.vel_err ** 2)),
+        )
+
+
+# %% Harness
+def monte_carlo(
+    # a StateEstimator, eg. an EKF or IMM. Must be picklable to run in a pool
+    estimator: Any,
+    init_state: Any,
+    # measurements, shape=(R, K, m)
+    Z: np.ndarray,
+    # ground truth, shape=(R, K, n)
+    Xgt: np.ndarray,
+    Ts: float,
+    # the part of the state to calculate NEES for, defaults to the estimated state
+    idxs: Optional[Sequence[int]] = None,
+    pos_idx: Sequence[int] = (0, 1),
+    vel_idx: Sequence[int] = (2, 3),
+    # number of worker processes, None for all cores, 0 to run in this process
+    max_workers: Optional[int] = None,
+) -> MonteCarloResult:
+    """Run estimator on all the R realizations and collect the consistency statistics."""
+    R = Z.shape[0]
+    if idxs is None:
+        idxs = np.arange(estimator.estimate(init_state).mean.shape[0])
+    idxs = np.asarray(idxs, dtype=int)
+    assert np.all(np.isin(pos_idx, idxs)) and np.all(
+        np.isin(vel_idx, idxs)
+    ), "monte_carlo: pos_idx and vel_idx must be in idxs"
+
+    run_kwargs = dict(
+        estimator=estimator,
+        init_state=init_state,
+        Ts=Ts,
+        idxs=idxs,
+        pos_idx=np.asarray(pos_idx),
+        vel_idx=np.asarray(vel_idx),
+    )
+
+    if max_workers == 0:
+        runs = [run_estimator(Z=Z[r], Xgt=Xgt[r], **run_kwargs) for r in range(R)]
+    else:
+        blocks = {}
+        try:
+            for key, arr in (("Z", Z), ("Xgt", Xgt)):
+                blocks[key] = _to_shared_memory(np.ascontiguousarray(arr, dtype=float))
+            shared = {
+                key: (shm.name, arr.shape, arr.dtype.str)
+                for key, (shm, arr) in blocks.items()
+            }
+            with ProcessPoolExecutor(
+                max_workers=max_workers,
+                initializer=_init_worker,
+                initargs=(shared, run_kwargs),
+            ) as pool:
+                runs = list(pool.map(_run_worker, range(R)))
+        finally:
+            for shm, _ in blocks.values():
+                shm.close()
+                shm.unlink()
+
+    stacked = {key: np.array([run[key] for run in runs]) for key in runs[0]}
+    return MonteCarloResult(
+        **stacked, NEES_dof=idxs.size, NIS_dof=Z.shape[-1]
+    )
+
+
+# %% Example
+if __name__ == "__main__":
+    import ekf
+    from gaussparams import GaussParams
+
+    # the true models, as in the simulation part of run_ekf.py
+    sigma_a_true = 0.25
+    sigma_omega_true = np.pi / 15
+    sigma_z_true = 3
+    K = 300
+    Ts = 0.1
+    x0 = np.array([0, 0, 1, 1, 0])
+    P0 = np.diag([50, 50, 10, 10, np.pi / 4]) ** 2
+
+    true_dynamic_model = dynamicmodels.ConstantTurnrate(sigma_a_true, sigma_omega_true)
+    true_measurement_model = measurementmodels.CartesianPosition(sigma_z_true, state_dim=5)
+    Xgt, Z = simulate(true_dynamic_model, true_measurement_model, 100, K, Ts, x0, P0, seed=0)
+
+    # a CV EKF on the first four states
+    ekf_filter = ekf.EKF(
+        dynamicmodels.WhitenoiseAccelleration(2.5),
+        measurementmodels.CartesianPosition(sigma_z_true),
+    )
+    init_state = GaussParams(x0[:4], P0[:4, :4])
+
+    result = monte_carlo(ekf_filter, init_state, Z, Xgt, Ts)
+    for key, value in result.summary().items():
+        print(f"{key} = {value}")
@@ -1,4 +1,4 @@
-from typing import TypeVar, Optional, Dict, Any, List, Generic
+from typing import TypeVar, Optional, Dict, Any, List, Generic, Tuple
 from dataclasses import dataclass, field
 import numpy as np
 import scipy
@@ -7,6 +7,8 @@ import scipy.special
 from estimatorduck import StateEstimator
 from mixturedata import MixtureParameters
 from gaussparams import GaussParams
+from spatialindex import ScanIndex
+import profiling
 
 ET = TypeVar("ET")
 
@@ -29,28 +31,65 @@ class PDA(Generic[ET]):  # Probabilistic Data Association
         filter_state: ET,
         *,
         sensor_state: Optional[Dict[str, Any]] = None,
-    ) -> bool:  # gated (m x 1): gated(j) = true if measurement j is within gate
+        # optional spatial index over Z shared by all the tracks gating this scan
+        scan_index: Optional[ScanIndex] = None,
+    ) -> np.ndarray:  # gated (M,): gated(j) = true if measurement j is within gate
         """Gate/validate measurements: (z-h(x))'S^(-1)(z-h(x)) <= g^2."""
+        gated, _ = self.gate_loglikelihoods(
+            Z, filter_state, sensor_state=sensor_state, scan_index=scan_index
+        )
+        return gated
+
+    @profiling.stage("PDA.gate")
+    def gate_loglikelihoods(
+        self,
+        # measurements of shape=(M, m)=(#measurements, dim)
+        Z: np.ndarray,
+        filter_state: ET,
+        *,
+        sensor_state: Optional[Dict[str, Any]] = None,
+        # optional spatial index over Z shared by all the tracks gating this scan
+        scan_index: Optional[ScanIndex] = None,
+    ) -> Tuple[np.ndarray, Optional[np.ndarray]]:  # gated, loglikelihoods: shapes=((M,), (M,))
+        """
+        Gate the measurements as gate, also giving the state filter log likelihoods of the gated
+        measurements when the state filter gets them from the gating factorization (eg. IMM),
+        otherwise None. The log likelihoods of measurements not gated are undefined.
+        """
 
-        M = Z.shape[0]
         g_squared = self.gate_size ** 2
+        gate_loglikelihoods = getattr(self.state_filter, "gate_loglikelihoods", None)
 
+        def gate_batch(Zc: np.ndarray) -> Tuple[np.ndarray, Optional[np.ndarray]]:
+            if gate_loglikelihoods is not None:
+                return gate_loglikelihoods(
+                    Zc, filter_state, gate_size_square=g_squared, sensor_state=sensor_state
+                )
+            gated = self.state_filter.gate_batch(
+                Zc, filter_state, gate_size_square=g_squared, sensor_state=sensor_state,
+            )
+            return gated, None
 
-        # The loop can be done using ether of these: normal loop, list comprehension or map
-        gated = np.array(
-            [
-                self.state_filter.gate(
-                    zj, 
-                    filter_state, 
-                    gate_size_square=g_squared,
-                    sensor_state=sensor_state,
-                    )
-                    for zj in Z
-            ], 
-                dtype=bool,
-        ) # TODO: some for loop over elements of Z using self.state_filter.gate
+        if scan_index is None:
+            # all of Z is gated at once, S is factorized once per state (once per mode for IMM)
+            return gate_batch(Z)
 
-        return gated
+        assert len(scan_index) == Z.shape[0], "PDA.gate: scan_index is not built from Z"
+
+        # only the measurements in the bounding box of the gate are tested exactly
+        lower, upper = self.state_filter.gate_bounds(
+            filter_state, g_squared, sensor_state=sensor_state
+        )
+        candidates = scan_index.query_box(lower, upper)
+
+        gated = np.zeros(Z.shape[0], dtype=bool)
+        lls = np.full(Z.shape[0], np.nan) if gate_loglikelihoods is not None else None
+        if candidates.size > 0:
+            gated[candidates], candidate_lls = gate_batch(Z[candidates])
+            if lls is not None:
+                lls[candidates] = candidate_lls
+
+        return gated, lls
 
     def loglikelihood_ratios(
         self,  # measurements of shape=(M, m)=(#measurements, dim)
@@ -58,29 +97,43 @@ class PDA(Generic[ET]):  # Probabilistic Data Association
         filter_state: ET,
         *,
         sensor_state: Optional[Dict[str, Any]] = None,
+        # clutter intensity at each measurement, shape=(M,). Defaults to self.clutter_intensity
+        clutter_intensity: Optional[np.ndarray] = None,
+        # the state filter log likelihoods of Z if already calculated, eg. by gate_loglikelihoods: shape=(M,)
+        loglikelihoods: Optional[np.ndarray] = None,
     ) -> np.ndarray:  # shape=(M + 1,), first element for no detection
-        """ Calculates the posterior event loglikelihood ratios."""
+        """ Calculates the posterior event loglikelihood ratios.
+
+        The ratios are relative to the measurements being clutter, so that
+        exp(logsumexp(ll)) = 1 - PD + PD sum_j l_j / clutter_intensity_j.
+        """
 
         log_PD = np.log(self.PD)
         log_PND = np.log(1 - self.PD)  # P_ND = 1 - P_D
-        log_clutter = np.log(self.clutter_intensity)
+        if clutter_intensity is None:
+            clutter_intensity = self.clutter_intensity
+        log_clutter = np.log(clutter_intensity)
 
         # allocate
         ll = np.empty(Z.shape[0] + 1)
 
         # calculate log likelihood ratios
-        ll[0] = log_PND + log_clutter # TODO: missed detection
-        ll[1:] = np.array(
-            [
-                self.state_filter.loglikelihood(
-                    zj, filter_state, sensor_state=sensor_state 
-                )
-                for zj in Z
-            ]# TODO: some for loop over elements of Z using self.state_filter.loglikelihood
-        )
-        ll[1:] += log_PD
+        ll[0] = log_PND # TODO: missed detection
+        if loglikelihoods is not None:
+            ll[1:] = loglikelihoods
+        else:
+            ll[1:] = np.array(
+                [
+                    self.state_filter.loglikelihood(
+                        zj, filter_state, sensor_state=sensor_state 
+                    )
+                    for zj in Z
+                ]# TODO: some for loop over elements of Z using self.state_filter.loglikelihood
+            )
+        ll[1:] += log_PD - log_clutter
         return ll
 
+    @profiling.stage("PDA.association_probabilities")
     def association_probabilities(
         self,
         # measurements of shape=(M, m)=(#measurements, dim)
@@ -88,11 +141,21 @@ class PDA(Generic[ET]):  # Probabilistic Data Association
         filter_state: ET,
         *,
         sensor_state: Optional[Dict[str, Any]] = None,
+        # clutter intensity at each measurement, shape=(M,). Defaults to self.clutter_intensity
+        clutter_intensity: Optional[np.ndarray] = None,
+        # the state filter log likelihoods of Z if already calculated, eg. by gate_loglikelihoods: shape=(M,)
+        loglikelihoods: Optional[np.ndarray] = None,
     ) -> np.ndarray:  # beta, shape=(M + 1,): the association probabilities (normalized likelihood ratios)
         """calculate the poseterior event/association probabilities."""
 
         # log likelihoods
-        lls = self.loglikelihood_ratios(Z, filter_state, sensor_state=sensor_state)
+        lls = self.loglikelihood_ratios(
+            Z,
+            filter_state,
+            sensor_state=sensor_state,
+            clutter_intensity=clutter_intensity,
+            loglikelihoods=loglikelihoods,
+        )
 
         # probabilities
         beta = np.exp(lls - scipy.special.logsumexp(lls))# TODO
@@ -130,6 +193,7 @@ class PDA(Generic[ET]):  # Probabilistic Data Association
         return  self.state_filter.reduce_mixture(mixture_filter_state)# TODO: utilize self.state_filter to keep this working for both EKF and IMM
 
 
+    @profiling.stage("PDA.update")
     def update(
         self,
         # measurements of shape=(M, m)=(#measurements, dim)
@@ -137,24 +201,57 @@ class PDA(Generic[ET]):  # Probabilistic Data Association
         filter_state: ET,
         *,
         sensor_state: Optional[Dict[str, Any]] = None,
+        scan_index: Optional[ScanIndex] = None,
+        # clutter intensity at each measurement, shape=(M,). Defaults to self.clutter_intensity
+        clutter_intensity: Optional[np.ndarray] = None,
     ) -> ET:  # The filter_state updated by approximating the data association
         """
         Perform the PDA update cycle.
 
         Gate -> association probabilities -> conditional update -> reduce mixture.
         """
-        # remove the not gated measurements from consideration
-        gated = self.gate(Z, filter_state, sensor_state=sensor_state)# TODO
+        # remove the not gated measurements from consideration, keeping the log likelihoods
+        # the gating may have calculated from the same factorization
+        gated, lls = self.gate_loglikelihoods(
+            Z, filter_state, sensor_state=sensor_state, scan_index=scan_index
+        )
         Zg = Z[gated]
+        if clutter_intensity is not None:
+            clutter_intensity = np.asarray(clutter_intensity)[gated]
 
         # find association probabilities
         beta = self.association_probabilities(
-            Zg, filter_state, sensor_state=sensor_state
+            Zg,
+            filter_state,
+            sensor_state=sensor_state,
+            clutter_intensity=clutter_intensity,
+            loglikelihoods=None if lls is None else lls[gated],
         ) # TODO
 
+        return self.mixture_update(Zg, beta, filter_state, sensor_state=sensor_state)
+
+    @profiling.stage("PDA.mixture_update")
+    def mixture_update(
+        self,
+        # gated measurements of shape=(M, m)=(#measurements, dim)
+        Z: np.ndarray,
+        # association probabilities, first element for no detection: shape=(M + 1,)
+        beta: np.ndarray,
+        filter_state: ET,
+        *,
+        sensor_state: Optional[Dict[str, Any]] = None,
+    ) -> ET:  # The filter_state updated by the association mixture reduced
+        """Update the state with all associations weighted by beta and reduce the resulting mixture."""
+
+        # state filters with shared S and W for all associations (eg. EKF) reduce in closed form
+        if hasattr(self.state_filter, "combined_update"):
+            return self.state_filter.combined_update(
+                Z, beta, filter_state, sensor_state=sensor_state
+            )
+
         # find the mixture components
         filter_state_update_mixture_components = self.conditional_update(
-            Zg, filter_state, sensor_state=sensor_state
+            Z, filter_state, sensor_state=sensor_state
         ) # TODO
 
         # make mixture
@@ -175,12 +272,19 @@ class PDA(Generic[ET]):  # Probabilistic Data Association
         Ts: float,
         *,
         sensor_state: Optional[Dict[str, Any]] = None,
+        scan_index: Optional[ScanIndex] = None,
+        # clutter intensity at each measurement, shape=(M,). Defaults to self.clutter_intensity
+        clutter_intensity: Optional[np.ndarray] = None,
     ) -> ET:
         """Perform a predict update cycle with Ts time units and measurements Z in sensor_state"""
 
         filter_state_predicted = self.predict(filter_state, Ts) # TODO
         filter_state_updated = self.update(
-            Z, filter_state_predicted, sensor_state=sensor_state
+            Z,
+            filter_state_predicted,
+            sensor_state=sensor_state,
+            scan_index=scan_index,
+            clutter_intensity=clutter_intensity,
         ) # TODO
         return filter_state_updated
 
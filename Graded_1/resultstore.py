@@ -0,0 +1,249 @@
+"""
+A chunked columnar store on disk for the per step results of a filter run.
+
+A store is a directory with an index.json and one directory per chunk, holding one .npy file per
+column. Every row is a time step with a time t. There are three kinds of columns:
+    fixed:  every row has the same shape, eg. means, NIS, NEES or mode probabilities,
+    packed: symmetric (n, n) matrices stored as their n (n + 1) / 2 upper triangular elements,
+    ragged: every row is a 1D array of its own length, eg. the association probabilities of a
+            PDA, stored as the concatenated values and the offsets of the rows.
+
+ResultWriter buffers the rows in memory and writes a chunk every chunk_size rows, updating the
+index last. An interrupted run keeps all the chunks written so far, and opening a writer on an
+existing store appends to it. ResultStore reads a range of times by loading only the chunks
+overlapping it, memory mapped, so reading the end of a long run does not load all of it.
+
+Typical use in a run script:
+    with ResultWriter("results/imm_pda", packed=["cov"], ragged=["beta"]) as writer:
+        for k, zk in enumerate(Z):
+            ...
+            writer.append(k * Ts, mean=estimate.mean, cov=estimate.cov, NEES=NEES, beta=beta)
+    results = ResultStore("results/imm_pda").read(["mean", "cov"], t_start=10, t_stop=20)
+"""
+# %% Imports
+# types
+from typing import Any, Dict, List, Optional, Sequence, Union
+
+# packages
+from dataclasses import dataclass, field
+import json
+import os
+
+import numpy as np
+
+INDEX_FILE = "index.json"
+
+
+# %% Packing of symmetric matrices
+def pack_cov(P: np.ndarray) -> np.ndarray:  # shape=(..., n * (n + 1) // 2)
+    """Get the upper triangular elements of the symmetric matrices P of shape=(..., n, n)."""
+    iu = np.triu_indices(P.shape[-1])
+    return P[..., iu[0], iu[1]]
+
+
+def unpack_cov(packed: np.ndarray, n: int) -> np.ndarray:  # shape=(..., n, n)
+    """Get the symmetric matrices from their packed upper triangular elements."""
+    iu = np.triu_indices(n)
+    P = np.empty((*packed.shape[:-1], n, n), dtype=packed.dtype)
+    P[..., iu[0], iu[1]] = packed
+    P[..., iu[1], iu[0]] = packed
+    return P
+
+
+# %% Index
+def _read_index(directory: str) -> Dict[str, Any]:
+    with open(os.path.join(directory, INDEX_FILE)) as file:
+        return json.load(file)
+
+
+def _write_index(directory: str, index: Dict[str, Any]) -> None:
+    # write and rename, so the index always lists only complete chunks
+    tmp = os.path.join(directory, INDEX_FILE + ".tmp")
+    with open(tmp, "w") as file:
+        json.dump(index, file, indent=1)
+    os.replace(tmp, os.path.join(directory, INDEX_FILE))
+
+
+def _chunk_dir(directory: str, chunk: int) -> str:
+    return os.path.join(directory, f"chunk_{chunk:05d}")
+
+
+# %% Writing
+@dataclass
+class ResultWriter:
+    # the store directory, created if needed, appended to if it exists
+    directory: str
+    # the number of rows per chunk
+    chunk_size: int = 1000
+    # the names of the columns of symmetric matrices to store packed
+    packed: Sequence[str] = ()
+    # the names of the columns with rows of varying length
+    ragged: Sequence[str] = ()
+
+    index: Dict[str, Any] = field(init=False, repr=False)
+    _buffer: Dict[str, List[np.ndarray]] = field(init=False, repr=False)
+
+    def __post_init__(self):
+        assert self.chunk_size >= 1, "ResultWriter: chunk_size must be positive"
+        assert not set(self.packed) & set(self.ragged), "ResultWriter: a column can not be both packed and ragged"
+        os.makedirs(self.directory, exist_ok=True)
+        if os.path.exists(os.path.join(self.directory, INDEX_FILE)):
+            self.index = _read_index(self.directory)
+        else:
+            self.index = dict(columns={}, chunks=[])
+        self._buffer = {}
+
+    def __enter__(self) -> "ResultWriter":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def _add_column(self, name: str, value: np.ndarray) -> None:
+        if name in self.ragged:
+            kind, shape = "ragged", None
+        elif name in self.packed:
+            assert value.ndim == 2 and value.shape[0] == value.shape[1], f"ResultWriter.append: packed column {name} must be square"
+            kind, shape = "packed", list(value.shape)
+        else:
+            kind, shape = "fixed", list(value.shape)
+        self.index["columns"][name] = dict(kind=kind, dtype=value.dtype.str, shape=shape)
+
+    def append(self, t: float, **columns: Union[np.ndarray, float]) -> None:
+        """Buffer a row at time t, writing a chunk when chunk_size rows are buffered.
+        The first row defines the columns, later rows must have the same columns."""
+        values = {name: np.asarray(value) for name, value in columns.items()}
+        if not self.index["columns"]:
+            for name, value in values.items():
+                self._add_column(name, value)
+            self._buffer = {name: [] for name in ["t", *values]}
+        elif not self._buffer:
+            self._buffer = {name: [] for name in ["t", *self.index["columns"]]}
+
+        assert values.keys() == self.index["columns"].keys(), (
+            f"ResultWriter.append: got columns {sorted(values)}, "
+            f"expected {sorted(self.index['columns'])}"
+        )
+        for name, value in values.items():
+            spec = self.index["columns"][name]
+            if spec["kind"] == "ragged":
+                value = value.ravel()
+            else:
+                assert list(value.shape) == spec["shape"], f"ResultWriter.append: column {name} has shape {value.shape}, expected {tuple(spec['shape'])}"
+                if spec["kind"] == "packed":
+                    value = pack_cov(value)
+            self._buffer[name].append(value)
+        self._buffer["t"].append(np.asarray(t, dtype=float))
+
+        if len(self._buffer["t"]) >= self.chunk_size:
+            self.flush()
+
+    def flush(self) -> None:
+        """Write the buffered rows as a chunk."""
+        if not self._buffer or not self._buffer["t"]:
+            return
+
+        chunk = len(self.index["chunks"])
+        chunk_dir = _chunk_dir(self.directory, chunk)
+        os.makedirs(chunk_dir, exist_ok=True)
+
+        t = np.array(self._buffer["t"])
+        np.save(os.path.join(chunk_dir, "t.npy"), t)
+        for name, spec in self.index["columns"].items():
+            rows = self._buffer[name]
+            dtype = np.dtype(spec["dtype"])
+            if spec["kind"] == "ragged":
+                lengths = [row.size for row in rows]
+                offsets = np.concatenate(([0], np.cumsum(lengths))).astype(np.int64)
+                values = np.concatenate(rows).astype(dtype) if rows else np.empty(0, dtype)
+                np.save(os.path.join(chunk_dir, f"{name}.values.npy"), values)
+                np.save(os.path.join(chunk_dir, f"{name}.offsets.npy"), offsets)
+            else:
+                np.save(os.path.join(chunk_dir, f"{name}.npy"), np.array(rows, dtype=dtype))
+
+        start = sum(c["length"] for c in self.index["chunks"])
+        self.index["chunks"].append(
+            dict(start=start, length=t.size, t_min=float(t.min()), t_max=float(t.max()))
+        )
+        _write_index(self.directory, self.index)
+        self._buffer = {name: [] for name in self._buffer}
+
+    def close(self) -> None:
+        """Write the remaining rows."""
+        self.flush()
+
+
+# %% Reading
+@dataclass
+class ResultStore:
+    # the store directory written by a ResultWriter
+    directory: str
+
+    index: Dict[str, Any] = field(init=False, repr=False)
+
+    def __post_init__(self):
+        self.index = _read_index(self.directory)
+
+    @property
+    def columns(self) -> List[str]:
+        return list(self.index["columns"])
+
+    def __len__(self) -> int:
+        return sum(chunk["length"] for chunk in self.index["chunks"])
+
+    def read(
+        self,
+        # the columns to read, None for all
+        columns: Optional[Sequence[str]] = None,
+        # the rows with t_start <= t < t_stop, None for no bound
+        t_start: Optional[float] = None,
+        t_stop: Optional[float] = None,
+    ) -> Dict[str, Union[np.ndarray, List[np.ndarray]]]:
+        """Read the rows in the time range, assuming the times are non-decreasing. Ragged columns
+        are lists of arrays, the rest arrays with the rows along the first axis, and packed
+        columns are unpacked."""
+        columns = self.columns if columns is None else list(columns)
+        for name in columns:
+            assert name in self.index["columns"], f"ResultStore.read: no column {name}"
+
+        parts: Dict[str, List[Any]] = {name: [] for name in ["t", *columns]}
+        for chunk, info in enumerate(self.index["chunks"]):
+            if t_start is not None and info["t_max"] < t_start:
+                continue
+            if t_stop is not None and info["t_min"] >= t_stop:
+                continue
+
+            chunk_dir = _chunk_dir(self.directory, chunk)
+            t = np.load(os.path.join(chunk_dir, "t.npy"), mmap_mode="r")
+            rows = np.ones(t.size, dtype=bool)
+            if t_start is not None:
+                rows &= t >= t_start
+            if t_stop is not None:
+                rows &= t < t_stop
+            first, last = np.flatnonzero(rows)[[0, -1]] if rows.any() else (0, -1)
+            rows = slice(first, last + 1)
+
+            parts["t"].append(np.array(t[rows]))
+            for name in columns:
+                spec = self.index["columns"][name]
+                if spec["kind"] == "ragged":
+                    values = np.load(os.path.join(chunk_dir, f"{name}.values.npy"), mmap_mode="r")
+                    offsets = np.load(os.path.join(chunk_dir, f"{name}.offsets.npy"))
+                    parts[name].extend(
+                        np.array(values[begin:end])
+                        for begin, end in zip(offsets[rows], offsets[1:][rows])
+                    )
+                else:
+                    data = np.load(os.path.join(chunk_dir, f"{name}.npy"), mmap_mode="r")
+                    parts[name].append(np.array(data[rows]))
+
+        result: Dict[str, Union[np.ndarray, List[np.ndarray]]] = {}
+        for name, chunks in parts.items():
+            spec = self.index["columns"].get(name, dict(kind="fixed", dtype="<f8", shape=[]))
+            if spec["kind"] == "ragged":
+                result[name] = chunks
+                continue
+            width = [spec["shape"][0] * (spec["shape"][0] + 1) // 2] if spec["kind"] == "packed" else spec["shape"]
+            data = np.concatenate(chunks) if chunks else np.empty((0, *width), dtype=spec["dtype"])
+            result[name] = unpack_cov(data, spec["shape"][0]) if spec["kind"] == "packed" else data
+        return result
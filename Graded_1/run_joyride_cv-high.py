@@ -194,9 +194,6 @@ tracker = pda.PDA(imm_filter, clutter_intensity, PD, gate_size)
 #init_imm_pda_state = tracker.init_filter_state(init__immstate)
 
 
-NEES = np.zeros(K)
-NEESpos = np.zeros(K)
-NEESvel = np.zeros(K)
 NEESposHigh = np.zeros(K)
 NIS = np.zeros(K)
 
@@ -215,15 +212,18 @@ for k, (Zk, x_true_k) in enumerate(zip(Z, Xgt)):
     # You can look at the prediction estimate as well
     tracker_estimate = tracker.estimate(tracker_update)
 
-    NEES[k] = estats.NEES(*tracker_estimate, x_true_k, idxs=np.arange(4))
-    NEESpos[k] = estats.NEES(*tracker_estimate, x_true_k, idxs=np.arange(2))
-    NEESvel[k] = estats.NEES(*tracker_estimate, x_true_k, idxs=np.arange(2, 4))
     tracker_predict_list.append(tracker_predict)
     tracker_update_list.append(tracker_update)
     tracker_estimate_list.append(tracker_estimate)
 
 
 x_hat = np.array([est.mean for est in tracker_estimate_list])
+P_hat = np.array([est.cov for est in tracker_estimate_list])
+
+# consistency of the whole run at once
+NEES = estats.NEES_sequence(x_hat, P_hat, Xgt, idxs=np.arange(4))
+NEESpos = estats.NEES_sequence(x_hat, P_hat, Xgt, idxs=np.arange(2))
+NEESvel = estats.NEES_sequence(x_hat, P_hat, Xgt, idxs=np.arange(2, 4))
 prob_hat = np.array([upd.weights for upd in tracker_update_list])
 
 # calculate a performance metrics
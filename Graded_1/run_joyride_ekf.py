@@ -179,15 +179,17 @@ for i, (tracker, name) in enumerate(zip(trackers, names)):
         # You can look at the prediction estimate as well
         tracker_estimate = tracker.estimate(tracker_update)
 
-        NEES[i][k] = estats.NEES(*tracker_estimate, x_true_k, idxs=np.arange(4))
-        NEESpos[i][k] = estats.NEES(*tracker_estimate, x_true_k, idxs=np.arange(2))
-        NEESvel[i][k] = estats.NEES(*tracker_estimate, x_true_k, idxs=np.arange(2, 4))
-
         tracker_predict_list[i][k]= tracker_predict
         tracker_update_list[i][k] = tracker_update
         tracker_estimate_list[i][k] = tracker_estimate
 
     x_hat[i] = np.array([est.mean for est in tracker_estimate_list[i]])
+    P_hat = np.array([est.cov for est in tracker_estimate_list[i]])
+
+    # consistency of the whole run at once
+    NEES[i] = estats.NEES_sequence(x_hat[i], P_hat, Xgt, idxs=np.arange(4))
+    NEESpos[i] = estats.NEES_sequence(x_hat[i], P_hat, Xgt, idxs=np.arange(2))
+    NEESvel[i] = estats.NEES_sequence(x_hat[i], P_hat, Xgt, idxs=np.arange(2, 4))
 
 # calculate performance metrics
 posRMSE = np.empty((len(trackers)), dtype=float)
@@ -118,11 +118,6 @@ ekf_filter = ekf.EKF(dynamic_model, measurement_model)
 
 tracker = pda.PDA(ekf_filter, clutter_intensity, PD, gate_size)
 
-# allocate
-NEES = np.zeros(K)
-NEESpos = np.zeros(K)
-NEESvel = np.zeros(K)
-
 # initialize
 x_bar_init = np.array([*Z[0][true_association[0] - 1], 0, 0])
 
@@ -139,16 +134,18 @@ tracker_predict_list = []
 for k, (Zk, x_true_k) in enumerate(zip(Z, Xgt)):
     tracker_predict = tracker.predict(tracker_update,Ts)
     tracker_update = tracker.update(Zk,tracker_predict)
-    NEES[k] = estimationstatistics.NEES(*tracker_update, x_true_k, idxs=np.arange(4))
-    NEESpos[k] = estimationstatistics.NEES(*tracker_update, x_true_k, idxs=np.arange(2))
-    NEESvel[k] = estimationstatistics.NEES(
-        *tracker_update, x_true_k, idxs=np.arange(2, 4)
-        )
 
     tracker_predict_list.append(tracker_predict)
     tracker_update_list.append(tracker_update)
 
 x_hat = np.array([upd.mean for upd in tracker_update_list])
+P_hat = np.array([upd.cov for upd in tracker_update_list])
+
+# consistency of the whole run at once
+NEES = estimationstatistics.NEES_sequence(x_hat, P_hat, Xgt, idxs=np.arange(4))
+NEESpos = estimationstatistics.NEES_sequence(x_hat, P_hat, Xgt, idxs=np.arange(2))
+NEESvel = estimationstatistics.NEES_sequence(x_hat, P_hat, Xgt, idxs=np.arange(2, 4))
+
 # calculate a performance metric
 posRMSE = np.sqrt(np.mean(np.sum((x_hat[:, :2] - Xgt[:, :2]) ** 2, axis=1)))
 velRMSE = np.sqrt(np.mean(np.sum((x_hat[:, 2:4] - Xgt[:, 2:4]) ** 2, axis=1)))
@@ -0,0 +1,298 @@
+"""
+Vectorized simulation of many target trajectories with cluttered scans, for load and Monte Carlo
+tests of the PDA and IMM-PDA.
+
+The trajectories of all R realizations are generated together in arrays of shape=(R, K, n), with
+the models of dynamicmodels.py: the state is [x, y, u, v] for CV and [x, y, u, v, omega] for CT and
+for the Markov switching between CV and CT of an IMM. CV is generated in closed form with
+cumulative sums over time, CT and the Markov switching step through time for all realizations at
+once.
+
+scans then detects the targets with probability PD and draws all the Poisson clutter of all the
+scans in one go, uniform over the surveillance region. The scans are returned in CSR form: the
+measurements of all scans concatenated, with the offset of every scan, and the target measurement
+of every scan as "a" in data_for_pda.mat: 1 indexed, 0 when missed, so scan[a - 1] is the target.
+
+Every function takes a seed, or a np.random.Generator, so a scenario is reproducible.
+montecarlo.simulate samples from any dynamic and measurement model, but one step at a time.
+"""
+# %% Imports
+# types
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+# packages
+from dataclasses import dataclass
+import numpy as np
+
+from dynamicmodels import cosc
+
+Seed = Union[None, int, np.random.SeedSequence, np.random.Generator]
+
+
+# %% Process noise
+def _white_acceleration_noise(
+    rng: np.random.Generator, shape: Tuple[int, ...], sigma_a: np.ndarray, Ts: float
+) -> Tuple[np.ndarray, np.ndarray]:  # position and velocity noise, shapes=(*shape, 2)
+    """Sample the discretized white acceleration noise of Q in dynamicmodels for both axes."""
+    # the Cholesky factor of [[Ts^3 / 3, Ts^2 / 2], [Ts^2 / 2, Ts]]
+    L = np.linalg.cholesky(np.array([[Ts ** 3 / 3, Ts ** 2 / 2], [Ts ** 2 / 2, Ts]]))
+    e = rng.standard_normal((*shape, 2, 2))  # last axis: position, velocity
+    w = (e @ L.T) * np.asarray(sigma_a)[..., None, None]
+    return w[..., 0], w[..., 1]
+
+
+def _initial_states(
+    rng: np.random.Generator, R: int, x0: np.ndarray, P0: np.ndarray
+) -> np.ndarray:  # shape=(R, n)
+    return x0 + rng.standard_normal((R, x0.shape[0])) @ np.linalg.cholesky(P0).T
+
+
+# %% Trajectories
+def cv_trajectories(
+    # number of realizations and time steps
+    R: int,
+    K: int,
+    Ts: float,
+    # initial state distribution [x, y, u, v], shapes=((4,), (4, 4))
+    x0: np.ndarray,
+    P0: np.ndarray,
+    sigma_a: float,
+    seed: Seed = None,
+) -> np.ndarray:  # shape=(R, K, 4)
+    """Sample constant velocity trajectories, the states after each of the K steps."""
+    rng = np.random.default_rng(seed)
+    x_init = _initial_states(rng, R, np.asarray(x0, dtype=float), np.asarray(P0, dtype=float))
+    w_pos, w_vel = _white_acceleration_noise(rng, (R, K), sigma_a, Ts)
+
+    # v_k = v_0 + sum_{i <= k} w_vel_i, p_k = p_0 + Ts sum_{i < k} v_i + sum_{i <= k} w_pos_i
+    vel = x_init[:, None, 2:4] + np.cumsum(w_vel, axis=1)
+    vel_before = np.concatenate((x_init[:, None, 2:4], vel[:, :-1]), axis=1)
+    pos = x_init[:, None, :2] + Ts * np.cumsum(vel_before, axis=1) + np.cumsum(w_pos, axis=1)
+    return np.concatenate((pos, vel), axis=-1)
+
+
+def f_CT_batch(
+    # states [x, y, u, v, omega]: shape=(..., 5)
+    X: np.ndarray,
+    Ts: float,
+) -> np.ndarray:  # shape=(..., 5)
+    """The constant turn rate transition of dynamicmodels.f_CT for many states."""
+    x, y, u, v, omega = np.moveaxis(X, -1, 0)
+    theta = omega * Ts
+    cth, sth = np.cos(theta), np.sin(theta)
+    sincth = np.sinc(theta / np.pi)
+    coscth = cosc(theta / np.pi)
+    return np.stack(
+        (
+            x + Ts * u * sincth - Ts * v * coscth,
+            y + Ts * u * coscth + Ts * v * sincth,
+            u * cth - v * sth,
+            u * sth + v * cth,
+            omega,
+        ),
+        axis=-1,
+    )
+
+
+def markov_trajectories(
+    R: int,
+    K: int,
+    Ts: float,
+    # initial state distribution [x, y, u, v, omega], shapes=((5,), (5, 5))
+    x0: np.ndarray,
+    P0: np.ndarray,
+    # per mode: the acceleration noise, and if the mode turns (CT) or not (CV): shapes=(M,)
+    sigma_a: np.ndarray,
+    turns: np.ndarray,
+    # the turn rate noise of the turning modes
+    sigma_omega: float,
+    # transition matrix PI[i, j] = probability of going from mode i to j: shape=(M, M)
+    PI: np.ndarray,
+    # initial mode probabilities: shape=(M,)
+    mode_probabilities: np.ndarray,
+    # the standard deviation of the turn rate drawn when entering a turning mode
+    turn_rate_std: float = 0.1,
+    seed: Seed = None,
+) -> Tuple[np.ndarray, np.ndarray]:  # states, modes: shapes=((R, K, 5), (R, K))
+    """
+    Sample trajectories switching between CV and CT modes as a Markov chain, as assumed by the IMM.
+
+    A CV mode has zero turn rate, as the 5 state WhitenoiseAccelleration. A turning mode starts
+    with a turn rate drawn with turn_rate_std and lets it drift with sigma_omega.
+    """
+    rng = np.random.default_rng(seed)
+    sigma_a = np.asarray(sigma_a, dtype=float)
+    turns = np.asarray(turns, dtype=bool)
+    PI = np.asarray(PI, dtype=float)
+    M = PI.shape[0]
+    assert sigma_a.shape == turns.shape == (M,), "markov_trajectories: sigma_a and turns must have one entry per mode"
+    assert np.allclose(PI.sum(axis=1), 1), "markov_trajectories: the rows of PI must sum to 1"
+
+    # the mode sequences, vectorized over the realizations
+    PI_cumsum = np.cumsum(PI, axis=1)
+    u = rng.random((R, K))
+    modes = np.empty((R, K), dtype=int)
+    mode = np.minimum(
+        np.searchsorted(np.cumsum(mode_probabilities), rng.random(R), side="right"), M - 1
+    )
+    for k in range(K):
+        mode = np.minimum((u[:, k, None] >= PI_cumsum[mode]).sum(axis=1), M - 1)
+        modes[:, k] = mode
+
+    # the states
+    X = np.empty((R, K, 5))
+    x = _initial_states(rng, R, np.asarray(x0, dtype=float), np.asarray(P0, dtype=float))
+    w_pos, w_vel = _white_acceleration_noise(rng, (R, K), sigma_a[modes], Ts)
+    w_omega = sigma_omega * np.sqrt(Ts) * rng.standard_normal((R, K))
+    new_turn_rate = turn_rate_std * rng.standard_normal((R, K))
+    previous = np.concatenate((np.full((R, 1), -1), modes[:, :-1]), axis=1)
+    for k in range(K):
+        turning = turns[modes[:, k]]
+        entering = turning & (modes[:, k] != previous[:, k])
+        x[:, 4] = np.where(
+            turning, np.where(entering, new_turn_rate[:, k], x[:, 4] + w_omega[:, k]), 0
+        )
+        x = f_CT_batch(x, Ts)
+        x[:, :2] += w_pos[:, k]
+        x[:, 2:4] += w_vel[:, k]
+        X[:, k] = x
+
+    return X, modes
+
+
+def ct_trajectories(
+    R: int,
+    K: int,
+    Ts: float,
+    x0: np.ndarray,
+    P0: np.ndarray,
+    sigma_a: float,
+    sigma_omega: float,
+    seed: Seed = None,
+) -> np.ndarray:  # shape=(R, K, 5)
+    """Sample constant turn rate trajectories, with the turn rate drifting with sigma_omega."""
+    rng = np.random.default_rng(seed)
+    X = np.empty((R, K, 5))
+    x = _initial_states(rng, R, np.asarray(x0, dtype=float), np.asarray(P0, dtype=float))
+    w_pos, w_vel = _white_acceleration_noise(rng, (R, K), sigma_a, Ts)
+    w_omega = sigma_omega * np.sqrt(Ts) * rng.standard_normal((R, K))
+    for k in range(K):
+        x = f_CT_batch(x, Ts)
+        x[:, :2] += w_pos[:, k]
+        x[:, 2:4] += w_vel[:, k]
+        x[:, 4] += w_omega[:, k]
+        X[:, k] = x
+    return X
+
+
+# %% Measurements
+@dataclass
+class Scans:
+    # the measurements of all the scans concatenated: shape=(total, 2)
+    Z: np.ndarray
+    # scan k of realization r is Z[offsets[r, k]:offsets[r, k + 1]]: shape=(R, K + 1)
+    offsets: np.ndarray
+    # the target measurement of every scan, 1 indexed and 0 when missed as "a" in
+    # data_for_pda.mat, so the target of a scan is scan[a - 1]: shape=(R, K)
+    a: np.ndarray
+    # the surveillance region of every realization, shapes=((R, 2), (R, 2))
+    lower: np.ndarray
+    upper: np.ndarray
+
+    @property
+    def counts(self) -> np.ndarray:  # shape=(R, K)
+        """The number of measurements in every scan."""
+        return np.diff(self.offsets, axis=1)
+
+    def scan(self, r: int, k: int) -> np.ndarray:  # shape=(M, 2)
+        return self.Z[self.offsets[r, k] : self.offsets[r, k + 1]]
+
+    def scans(self, r: int) -> List[np.ndarray]:
+        """The scans of realization r, as loaded from data_for_pda.mat."""
+        return np.split(self.Z[self.offsets[r, 0] : self.offsets[r, -1]], self.offsets[r, 1:-1] - self.offsets[r, 0])
+
+
+def scans(
+    # the true states, positions first: shape=(R, K, n)
+    X: np.ndarray,
+    # measurement noise standard deviation, as in measurementmodels.CartesianPosition
+    sigma_z: float,
+    PD: float,
+    # the expected number of clutter measurements per area
+    clutter_intensity: float,
+    # the surveillance region, shapes=((2,) or (R, 2)),
+    # None for the bounding box of the positions of each realization with a margin
+    lower: Optional[np.ndarray] = None,
+    upper: Optional[np.ndarray] = None,
+    margin: float = 50.0,
+    seed: Seed = None,
+) -> Scans:
+    """Detect the targets with probability PD and add Poisson clutter, all scans at once."""
+    rng = np.random.default_rng(seed)
+    R, K = X.shape[:2]
+    pos = X[..., :2]
+    lower = pos.min(axis=1) - margin if lower is None else np.broadcast_to(lower, (R, 2))
+    upper = pos.max(axis=1) + margin if upper is None else np.broadcast_to(upper, (R, 2))
+    lower, upper = np.asarray(lower, dtype=float), np.asarray(upper, dtype=float)
+
+    # counts per scan, in bulk
+    detected = rng.random((R, K)) < PD
+    n_clutter = rng.poisson(clutter_intensity * np.prod(upper - lower, axis=1)[:, None], size=(R, K))
+    counts = n_clutter + detected
+    ends = np.concatenate(([0], np.cumsum(counts.ravel())))
+    offsets = ends[np.arange(R)[:, None] * K + np.arange(K + 1)]
+    total = offsets[-1, -1]
+
+    # the target measurement goes to a random place in its scan, 1 indexed as in data_for_pda.mat
+    a = np.where(detected, np.floor(rng.random((R, K)) * counts).astype(int) + 1, 0)
+
+    # fill all the scans: clutter everywhere except at the target measurements
+    scan_of = np.repeat(np.arange(R * K), counts.ravel())
+    place = np.arange(total) - offsets[:, :-1].ravel()[scan_of]
+    is_target = place == a.ravel()[scan_of] - 1
+
+    Z = np.empty((total, 2))
+    realization_of = scan_of[~is_target] // K
+    Z[~is_target] = rng.uniform(lower[realization_of], upper[realization_of])
+    Z[is_target] = pos[detected] + sigma_z * rng.standard_normal((detected.sum(), 2))
+
+    return Scans(Z, offsets, a, lower, upper)
+
+
+def dataset(X: np.ndarray, scans: Scans, Ts: float, r: int) -> Dict[str, Any]:
+    """Realization r as loaded by tuning.load_mat_dataset, to run a filter on it."""
+    K = X.shape[1]
+    return dict(Z=scans.scans(r), Xgt=X[r], Ts=np.full(K, Ts), a=scans.a[r])
+
+
+# %% Example
+if __name__ == "__main__":
+    import time
+
+    R, K, Ts = 1000, 1000, 0.1
+    x0 = np.array([0, 0, 10, 0, 0])
+    P0 = np.diag([10, 10, 2, 2, 0.01]) ** 2
+
+    start = time.perf_counter()
+    X, modes = markov_trajectories(
+        R,
+        K,
+        Ts,
+        x0,
+        P0,
+        sigma_a=np.array([0.1, 0.1]),
+        turns=np.array([False, True]),
+        sigma_omega=0.01,
+        PI=np.array([[0.99, 0.01], [0.02, 0.98]]),
+        mode_probabilities=np.array([0.9, 0.1]),
+        seed=0,
+    )
+    trajectories = time.perf_counter() - start
+    start = time.perf_counter()
+    simulated_scans = scans(X, 2, 0.9, 1e-5, seed=1)
+    measurements = time.perf_counter() - start
+
+    print(
+        f"{R} IMM trajectories of {K} steps in {trajectories * 1e3:.0f} ms, "
+        f"{simulated_scans.Z.shape[0]} measurements in {measurements * 1e3:.0f} ms"
+    )
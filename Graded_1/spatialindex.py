@@ -0,0 +1,66 @@
+from typing import Tuple
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+class ScanIndex:
+    """
+    A k-d tree over the measurements of a single scan for coarse spatial pre-gating.
+
+    Build it once per scan and share it between all the tracks gating that scan.
+    A query returns the measurements inside an axis aligned box, which is then
+    to be checked with the exact ellipsoidal gate.
+    """
+
+    __slots__ = ["Z", "_tree"]
+
+    def __init__(
+        self,
+        # measurements of shape=(M, m)=(#measurements, dim)
+        Z: np.ndarray,
+        leafsize: int = 16,
+    ) -> None:
+        self.Z = np.asarray(Z, dtype=float)
+        self._tree = cKDTree(self.Z, leafsize=leafsize)
+
+    def __len__(self) -> int:
+        return self.Z.shape[0]
+
+    def query_box(
+        self,
+        # lower corner of the box, shape=(m,)
+        lower: np.ndarray,
+        # upper corner of the box, shape=(m,)
+        upper: np.ndarray,
+    ) -> np.ndarray:  # sorted indices into Z of the measurements in the box
+        """Find the measurements inside the box [lower, upper]."""
+        if len(self) == 0:
+            return np.empty(0, dtype=int)
+
+        center = (lower + upper) / 2
+        half_width = (upper - lower) / 2
+
+        # the cube circumscribing the box in the infinity norm, then the box itself
+        idx = np.asarray(
+            self._tree.query_ball_point(center, r=half_width.max(), p=np.inf),
+            dtype=int,
+        )
+        inside = np.all(np.abs(self.Z[idx] - center) <= half_width, axis=1)
+        return np.sort(idx[inside])
+
+
+def gate_box(
+    # predicted measurement, shape=(m,)
+    zbar: np.ndarray,
+    # innovation covariance, shape=(m, m)
+    S: np.ndarray,
+    gate_size_square: float,
+) -> Tuple[np.ndarray, np.ndarray]:  # lower and upper corner, shapes=((m,), (m,))
+    """
+    Calculate the smallest axis aligned box containing the gate (z-zbar)'S^(-1)(z-zbar) <= g^2.
+
+    The half width along axis i is the extent of the gate ellipsoid along i, sqrt(g^2 * S[i, i]),
+    which is never larger than the radius sqrt(g^2 * max(eig(S))) of the circumscribing sphere.
+    """
+    half_width = np.sqrt(gate_size_square * np.diagonal(S))
+    return zbar - half_width, zbar + half_width
@@ -0,0 +1,239 @@
+"""
+An asyncio runtime for running a tracker on a stream of scans.
+
+A source is an async iterator of Scans. The TrackerService reads the source into a bounded queue
+and a tracker task takes the scans from the queue, calls tracker.step (eg. PDA.step, IMM.step or
+EKF.step) with Ts from the scan timestamps and passes the new state to the sinks. When the tracker
+falls behind and the queue is full, the oldest scan in the queue is dropped so that the tracker
+always works on the most recent data.
+
+ReplaySource replays the bundled .mat files at real time, accelerated or as fast as possible,
+so real time behaviour can be tested without a live sensor.
+"""
+# %% Imports
+# types
+from typing import (
+    Any,
+    AsyncIterable,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Union,
+)
+
+# packages
+from dataclasses import dataclass, field
+import asyncio
+import functools
+import inspect
+
+import numpy as np
+import scipy.io
+
+
+# %% Scans and sources
+@dataclass
+class Scan:
+    # the scan number in the source
+    k: int
+    # the sensor timestamp of the scan
+    t: float
+    # the measurements, shape=(M, m) for a scan, or shape=(m,) for a single measurement
+    Z: np.ndarray
+    # the event loop time when the source emitted the scan
+    received: float = 0.0
+
+
+class ReplaySource:
+    """
+    Replay the measurements of a .mat file as used by the run scripts.
+
+    Z is either a cell array of scans (eg. data_for_pda.mat), or a (m, K) array of single
+    measurements (eg. data_for_imm.mat). The timestamps are taken from "time" if present,
+    otherwise from "Ts", either a single sampling time or the K - 1 times between the scans.
+    speed is the replay speed relative to real time, None to emit the scans as fast as possible
+    (a sensor faster than any tracker, so expect dropped scans).
+    """
+
+    def __init__(self, filename: str, speed: Optional[float] = 1.0) -> None:
+        loaded_data = scipy.io.loadmat(filename)
+        self.speed = speed
+
+        Z = loaded_data["Z"]
+        if Z.dtype == object:
+            self.Z: List[np.ndarray] = [zk.T for zk in Z.ravel()]
+        else:
+            self.Z = list(Z.T)
+        K = len(self.Z)
+
+        Ts = np.asarray(loaded_data["Ts"], dtype=float).ravel()
+        if "time" in loaded_data:
+            self.times = np.asarray(loaded_data["time"], dtype=float).ravel()
+        elif Ts.size == 1:
+            self.times = Ts.item() * np.arange(1, K + 1)
+        else:
+            self.times = np.concatenate(([Ts[0]], Ts[0] + np.cumsum(Ts[: K - 1])))
+
+        # the time of the initial state, one sampling time before the first scan
+        self.start_time = self.times[0] - Ts[0]
+
+    def __len__(self) -> int:
+        return len(self.Z)
+
+    async def __aiter__(self) -> AsyncIterator[Scan]:
+        loop = asyncio.get_running_loop()
+        wall_start = loop.time()
+        for k, (tk, Zk) in enumerate(zip(self.times, self.Z)):
+            if self.speed is None:
+                await asyncio.sleep(0)
+            else:
+                due = wall_start + (tk - self.times[0]) / self.speed
+                await asyncio.sleep(max(due - loop.time(), 0))
+            yield Scan(k, float(tk), Zk, loop.time())
+
+
+# %% Statistics
+@dataclass
+class StreamStats:
+    # scans read from the source
+    received: int = 0
+    # scans run through the tracker
+    processed: int = 0
+    # scans dropped because the queue was full
+    dropped: int = 0
+    # time from the source emitting a scan until all sinks have got its result, in seconds
+    latencies: List[float] = field(default_factory=list)
+
+    def summary(self) -> Dict[str, float]:
+        """Counts and latency statistics in milliseconds."""
+        latencies = np.array(self.latencies) * 1e3
+        summary = dict(received=self.received, processed=self.processed, dropped=self.dropped)
+        if latencies.size > 0:
+            summary.update(
+                latency_mean_ms=latencies.mean(),
+                latency_p50_ms=np.percentile(latencies, 50),
+                latency_p95_ms=np.percentile(latencies, 95),
+                latency_max_ms=latencies.max(),
+            )
+        return summary
+
+
+# a sink gets every processed scan with the updated tracker state, and may be a coroutine function
+Sink = Callable[[Scan, Any], Union[None, Awaitable[None]]]
+
+
+# %% Tracker service
+@dataclass
+class TrackerService:
+    # anything with step(Z, filter_state, Ts), eg. a PDA, IMM or EKF
+    tracker: Any
+    # the initial tracker state
+    filter_state: Any
+    # called with every processed scan and the updated state
+    sinks: Sequence[Sink] = ()
+    # the maximum number of scans waiting for the tracker
+    queue_size: int = 8
+    # the time of the initial state, Ts of the first scan is measured from here
+    start_time: float = 0.0
+    sensor_state: Optional[Dict[str, Any]] = None
+
+    stats: StreamStats = field(init=False, repr=False)
+
+    def __post_init__(self):
+        assert self.queue_size >= 1, "TrackerService: queue_size must be positive"
+        self.stats = StreamStats()
+
+    async def run(self, source: AsyncIterable[Scan]) -> StreamStats:
+        """Run the tracker on all the scans of source and return the stream statistics."""
+        self.stats = StreamStats()
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.queue_size)
+
+        producer = asyncio.ensure_future(self._produce(source, queue))
+        consumer = asyncio.ensure_future(self._consume(queue))
+        try:
+            await asyncio.gather(producer, consumer)
+        finally:
+            producer.cancel()
+            consumer.cancel()
+        return self.stats
+
+    async def _produce(self, source: AsyncIterable[Scan], queue: asyncio.Queue) -> None:
+        try:
+            async for scan in source:
+                self.stats.received += 1
+                if queue.full():
+                    queue.get_nowait()
+                    self.stats.dropped += 1
+                queue.put_nowait(scan)
+        finally:
+            # the end of stream marker must get through even if the queue is full
+            if queue.full():
+                queue.get_nowait()
+                self.stats.dropped += 1
+            queue.put_nowait(None)
+
+    async def _consume(self, queue: asyncio.Queue) -> None:
+        loop = asyncio.get_running_loop()
+        last_time = self.start_time
+        kwargs = {} if self.sensor_state is None else dict(sensor_state=self.sensor_state)
+
+        while True:
+            scan = await queue.get()
+            if scan is None:
+                break
+
+            # the tracker runs in a worker thread so the source is not blocked
+            Ts = scan.t - last_time
+            self.filter_state = await loop.run_in_executor(
+                None,
+                functools.partial(
+                    self.tracker.step, scan.Z, self.filter_state, Ts, **kwargs
+                ),
+            )
+            last_time = scan.t
+
+            for sink in self.sinks:
+                result = sink(scan, self.filter_state)
+                if inspect.isawaitable(result):
+                    await result
+
+            self.stats.processed += 1
+            self.stats.latencies.append(loop.time() - scan.received)
+
+
+# %% Replay demo
+if __name__ == "__main__":
+    import dynamicmodels
+    import measurementmodels
+    import ekf
+    import imm
+    import pda
+    from gaussparams import GaussParams
+    from mixturedata import MixtureParameters
+
+    measurement_model = measurementmodels.CartesianPosition(1.9, state_dim=5)
+    ekf_filters = [
+        ekf.EKF(dynamicmodels.WhitenoiseAccelleration(0.14, n=5), measurement_model),
+        ekf.EKF(dynamicmodels.ConstantTurnrate(0.06, 0.02), measurement_model),
+    ]
+    imm_filter = imm.IMM(ekf_filters, np.array([[0.9, 0.1], [0.1, 0.9]]))
+    tracker = pda.PDA(imm_filter, 1e-4, 0.85, 3)
+
+    mode_states_init = GaussParams(np.array([0, 20, 0, 0, 0]), np.diag([5, 5, 3, 3, 1]) ** 2)
+    init_imm_state = MixtureParameters(np.array([0.9, 0.1]), [mode_states_init] * 2)
+
+    estimates = []
+
+    def store_estimate(scan: Scan, filter_state) -> None:
+        estimates.append(tracker.estimate(filter_state).mean)
+
+    source = ReplaySource("data_for_imm_pda.mat", speed=100)
+    service = TrackerService(
+        tracker, init_imm_state, sinks=[store_estimate], start_time=source.start_time
+    )
+    stats = asyncio.run(service.run(source))
+    print(stats.summary())
@@ -0,0 +1,378 @@
+"""
+Multi target track management around the IMM-PDA of an IMMBank (a single mode bank gives plain PDA tracks).
+
+Every scan the tracks are predicted and updated at once by IMMBank.pda_update, with each track doing
+its own PDA over the shared scan. The measurements not gated by any track start new tentative tracks:
+    - two-point initiation (max_speed given): a measurement within max_speed * Ts of an unused
+      measurement of the previous scan starts a track with the velocity between the two.
+    - single-point initiation (max_speed None): every unused measurement starts a track at rest
+      with the velocity uncertainty of init_cov.
+A tentative track is confirmed when it has gated measurements in confirm_hits of its last confirm_window
+scans (M-of-N), and deleted when it can no longer reach that. A confirmed track is deleted after
+max_misses scans in a row without gated measurements.
+
+Every track also carries its IPDA existence probability (see ipda.py), and any track whose existence
+falls below delete_existence is deleted, which keeps the number of false tracks bounded in dense clutter.
+
+Two confirmed tracks can converge onto the same target, after which they share its measurements and
+never separate. When the position estimates of two confirmed tracks fall inside each other's gates
+(the position covariance of the track plus R, at gate_size), the younger one is deleted, or the one
+with the lower existence probability if they are the same age.
+
+All the track data is kept in arrays stacked over the tracks, next to the bank state.
+"""
+# %% Imports
+# types
+from typing import Optional, Dict, Any, Sequence, Tuple
+
+# packages
+from dataclasses import dataclass, field
+import numpy as np
+from scipy.spatial import cKDTree
+
+# local
+from immbank import IMMBank
+from ipda import existence_update
+from clutterestimation import ClutterEstimator
+from gaussparams import GaussParamList
+from mixturedata import MixtureParameters
+
+TENTATIVE = 0
+CONFIRMED = 1
+
+
+# %% Track manager
+@dataclass
+class TrackManager:
+    bank: IMMBank
+    clutter_intensity: float
+    PD: float
+    gate_size: float
+    # the covariance of a new track, its position (and velocity for two-point) blocks are set from R: shape=(n, n)
+    init_cov: np.ndarray
+    # the mode probabilities of a new track: shape=(M,)
+    init_mode_probabilities: Optional[np.ndarray] = None
+    # the largest speed linking two measurements in two-point initiation, None for single-point initiation
+    max_speed: Optional[float] = None
+    # M-of-N confirmation: M
+    confirm_hits: int = 2
+    # M-of-N confirmation: N
+    confirm_window: int = 3
+    # consecutive scans without gated measurements before a confirmed track is deleted
+    max_misses: int = 3
+    # the probability that a track still exists after one prediction
+    survival_probability: float = 0.99
+    # the existence probability of a new track
+    init_existence: float = 0.5
+    # tracks with an existence probability below this are deleted
+    delete_existence: float = 0.0
+    # estimates the clutter intensity from the ungated measurements if given, replacing clutter_intensity
+    clutter_estimator: Optional[ClutterEstimator] = None
+    # indexes into the state for position and velocity (defaults to 0:m and m:2m)
+    pos_idx: Optional[Sequence[int]] = None
+    vel_idx: Optional[Sequence[int]] = None
+
+    # the bank state of all the tracks: weights shape=(N, M), mean shape=(N, M, n), cov shape=(N, M, n, n)
+    bankstate: MixtureParameters[GaussParamList] = field(init=False, repr=False)
+    # unique track numbers: shape=(N,)
+    track_ids: np.ndarray = field(init=False, repr=False)
+    # TENTATIVE or CONFIRMED: shape=(N,)
+    status: np.ndarray = field(init=False, repr=False)
+    # whether a measurement was gated in each of the last confirm_window scans, newest last: shape=(N, confirm_window)
+    hits: np.ndarray = field(init=False, repr=False)
+    # consecutive scans without gated measurements: shape=(N,)
+    misses: np.ndarray = field(init=False, repr=False)
+    # number of scans since initiation: shape=(N,)
+    age: np.ndarray = field(init=False, repr=False)
+    # the log likelihood ratio of the last scan given each track relative to only clutter: shape=(N,)
+    log_evidence_ratio: np.ndarray = field(init=False, repr=False)
+    # the probability that the track exists: shape=(N,)
+    existence: np.ndarray = field(init=False, repr=False)
+
+    _unused_measurements: np.ndarray = field(init=False, repr=False)
+    _next_id: int = field(init=False, repr=False)
+
+    def __post_init__(self):
+        M = len(self.bank.filters)
+        m = self.bank.filters[0].sensor_model.m
+        n = self.init_cov.shape[0]
+
+        if self.init_mode_probabilities is None:
+            self.init_mode_probabilities = np.full(M, 1 / M)
+        self.init_mode_probabilities = np.asarray(self.init_mode_probabilities, dtype=float)
+        self.pos_idx = np.asarray(
+            self.pos_idx if self.pos_idx is not None else np.arange(m), dtype=int
+        )
+        self.vel_idx = np.asarray(
+            self.vel_idx if self.vel_idx is not None else np.arange(m, 2 * m), dtype=int
+        )
+
+        assert self.init_cov.shape == (n, n), "TrackManager: init_cov must be square"
+        assert self.init_mode_probabilities.shape == (
+            M,
+        ), "TrackManager: init_mode_probabilities must have one probability per mode"
+        assert np.allclose(
+            self.init_mode_probabilities.sum(), 1
+        ), "TrackManager: init_mode_probabilities must sum to 1"
+        assert (
+            0 < self.confirm_hits <= self.confirm_window
+        ), "TrackManager: must have 0 < confirm_hits <= confirm_window"
+
+        self.bankstate = MixtureParameters(
+            np.empty((0, M)), GaussParamList(np.empty((0, M, n)), np.empty((0, M, n, n)))
+        )
+        self.track_ids = np.empty(0, dtype=int)
+        self.status = np.empty(0, dtype=int)
+        self.hits = np.empty((0, self.confirm_window), dtype=bool)
+        self.misses = np.empty(0, dtype=int)
+        self.age = np.empty(0, dtype=int)
+        self.log_evidence_ratio = np.empty(0)
+        self.existence = np.empty(0)
+        self._unused_measurements = np.empty((0, m))
+        self._next_id = 0
+
+    def __len__(self) -> int:
+        return self.track_ids.shape[0]
+
+    def step(
+        self,
+        # the scan: shape=(K, m)
+        Z: np.ndarray,
+        Ts: float,
+        *,
+        sensor_state: Optional[Dict[str, Any]] = None,
+    ) -> None:
+        """Predict and update all the tracks, then confirm, delete and initiate tracks."""
+        Z = np.asarray(Z, dtype=float).reshape(-1, self._unused_measurements.shape[1])
+
+        gated = np.zeros((len(self), Z.shape[0]), dtype=bool)
+        if len(self) > 0:
+            predicted = self.bank.predict(self.bankstate, Ts)
+            if Z.shape[0] > 0:
+                clutter_intensity = (
+                    self.clutter_intensity
+                    if self.clutter_estimator is None
+                    else self.clutter_estimator.intensity(Z)
+                )
+                self.bankstate, gated, self.log_evidence_ratio = self.bank.pda_update(
+                    Z,
+                    predicted,
+                    clutter_intensity,
+                    self.PD,
+                    self.gate_size ** 2,
+                    sensor_state=sensor_state,
+                )
+            else:
+                self.bankstate = predicted
+                self.log_evidence_ratio = np.full(len(self), np.log(1 - self.PD))
+
+            self.existence = existence_update(
+                self.survival_probability * self.existence, self.log_evidence_ratio
+            )
+
+        if self.clutter_estimator is not None:
+            # tentative tracks are mostly clutter, so only the confirmed tracks claim measurements
+            confirmed = self.status == CONFIRMED
+            self.clutter_estimator.update(Z[~gated[confirmed].any(axis=0)])
+
+        self.update_track_status(gated.any(axis=1))
+        self.delete_duplicates(sensor_state=sensor_state)
+
+        unused = Z[~gated.any(axis=0)]
+        self.initiate(unused, Ts, sensor_state=sensor_state)
+
+    def update_track_status(
+        self,
+        # whether each track gated a measurement this scan: shape=(N,)
+        detected: np.ndarray,
+    ) -> None:
+        """Update the hit history of the tracks, confirm the M-of-N tentative ones and delete lost tracks."""
+        self.hits = np.concatenate((self.hits[:, 1:], detected[:, None]), axis=1)
+        self.misses = np.where(detected, 0, self.misses + 1)
+        self.age = self.age + 1
+
+        num_hits = self.hits.sum(axis=1)
+        tentative = self.status == TENTATIVE
+        self.status[tentative & (num_hits >= self.confirm_hits)] = CONFIRMED
+
+        # the hits still possible within the window of a tentative track
+        remaining = np.maximum(self.confirm_window - self.age, 0)
+        lost_tentative = (self.status == TENTATIVE) & (
+            num_hits + remaining < self.confirm_hits
+        )
+        lost_confirmed = (self.status == CONFIRMED) & (self.misses >= self.max_misses)
+        unlikely = self.existence < self.delete_existence
+        self.select(~(lost_tentative | lost_confirmed | unlikely))
+
+    def delete_duplicates(
+        self,
+        *,
+        sensor_state: Optional[Dict[str, Any]] = None,
+    ) -> None:
+        """Delete the younger of two confirmed tracks whose positions are inside each other's gates."""
+        confirmed = np.flatnonzero(self.status == CONFIRMED)
+        if confirmed.shape[0] < 2:
+            return
+
+        estimates = self.bank.estimate(self.bankstate)[confirmed]
+        pos = estimates.mean[:, self.pos_idx]
+        measmod = self.bank.filters[0].sensor_model
+        S = estimates.cov[(slice(None), *np.ix_(self.pos_idx, self.pos_idx))] + measmod.R(
+            estimates.mean[0], sensor_state=sensor_state
+        )
+
+        # NIS[i, j]: the position of track j in the gate of track i
+        diff = pos[None, :] - pos[:, None]
+        NIS = np.einsum("ijk,ijk->ij", diff, np.linalg.solve(S[:, None], diff[..., None])[..., 0])
+        inside = (NIS < self.gate_size ** 2) & (NIS.T < self.gate_size ** 2)
+
+        # oldest first, then by existence, and a track is dropped if it is inside a kept one
+        order = np.lexsort((-self.existence[confirmed], -self.age[confirmed]))
+        kept = np.zeros(confirmed.shape[0], dtype=bool)
+        for i in order:
+            kept[i] = not (inside[i] & kept).any()
+
+        keep = np.ones(len(self), dtype=bool)
+        keep[confirmed[~kept]] = False
+        self.select(keep)
+
+    def initiate(
+        self,
+        # the measurements not gated by any track: shape=(K, m)
+        Z: np.ndarray,
+        Ts: float,
+        *,
+        sensor_state: Optional[Dict[str, Any]] = None,
+    ) -> None:
+        """Start tentative tracks from measurements not gated by any track."""
+        if self.max_speed is None:
+            starts, previous = Z, None
+            self._unused_measurements = Z[:0]
+        else:
+            starts, previous, rest = self._link_two_point(Z, Ts)
+            self._unused_measurements = rest
+
+        if starts.shape[0] == 0:
+            return
+
+        # the measurements are positions relative to the sensor
+        position = starts if sensor_state is None else starts + sensor_state["pos"]
+
+        num_new = starts.shape[0]
+        n = self.init_cov.shape[0]
+        mean = np.zeros((num_new, n))
+        mean[:, self.pos_idx] = position
+        cov = np.broadcast_to(self.init_cov, (num_new, n, n)).copy()
+
+        measmod = self.bank.filters[0].sensor_model
+        R = measmod.R(mean[0], sensor_state=sensor_state)
+        pos = np.ix_(self.pos_idx, self.pos_idx)
+        cov[:, self.pos_idx] = 0
+        cov[:, :, self.pos_idx] = 0
+        cov[(slice(None), *pos)] = R
+
+        if previous is not None:
+            # the difference of two positions, both with covariance R
+            vel = np.ix_(self.vel_idx, self.vel_idx)
+            mean[:, self.vel_idx] = (starts - previous) / Ts
+            cov[:, self.vel_idx] = 0
+            cov[:, :, self.vel_idx] = 0
+            cov[(slice(None), *vel)] = 2 * R / Ts ** 2
+            cov[(slice(None), *np.ix_(self.pos_idx, self.vel_idx))] = R / Ts
+            cov[(slice(None), *np.ix_(self.vel_idx, self.pos_idx))] = R / Ts
+
+        M = len(self.bank.filters)
+        new_bankstate = MixtureParameters(
+            np.broadcast_to(self.init_mode_probabilities, (num_new, M)),
+            GaussParamList(
+                np.broadcast_to(mean[:, None], (num_new, M, n)),
+                np.broadcast_to(cov[:, None], (num_new, M, n, n)),
+            ),
+        )
+
+        self.bankstate = MixtureParameters(
+            np.concatenate((self.bankstate.weights, new_bankstate.weights)),
+            GaussParamList(
+                np.concatenate((self.bankstate.components.mean, new_bankstate.components.mean)),
+                np.concatenate((self.bankstate.components.cov, new_bankstate.components.cov)),
+            ),
+        )
+        self.track_ids = np.concatenate(
+            (self.track_ids, self._next_id + np.arange(num_new))
+        )
+        self._next_id += num_new
+        self.status = np.concatenate((self.status, np.full(num_new, TENTATIVE)))
+        self.hits = np.concatenate(
+            (self.hits, np.zeros((num_new, self.confirm_window), dtype=bool))
+        )
+        self.misses = np.concatenate((self.misses, np.zeros(num_new, dtype=int)))
+        self.age = np.concatenate((self.age, np.zeros(num_new, dtype=int)))
+        self.log_evidence_ratio = np.concatenate(
+            (self.log_evidence_ratio, np.zeros(num_new))
+        )
+        self.existence = np.concatenate(
+            (self.existence, np.full(num_new, self.init_existence))
+        )
+
+    def _link_two_point(
+        self,
+        # the measurements not gated by any track: shape=(K, m)
+        Z: np.ndarray,
+        Ts: float,
+    ) -> Tuple[
+        np.ndarray, np.ndarray, np.ndarray
+    ]:  # starts, previous, rest: shapes=((L, m), (L, m), (K - L, m))
+        """Pair measurements with the closest free unused measurement of the previous scan within max_speed * Ts."""
+        previous = self._unused_measurements
+        linked = np.full(Z.shape[0], -1)
+        if Z.shape[0] > 0 and previous.shape[0] > 0:
+            tree = cKDTree(previous)
+            distances, candidates = tree.query(
+                Z,
+                k=min(previous.shape[0], 8),
+                distance_upper_bound=self.max_speed * Ts,
+            )
+            distances = distances.reshape(Z.shape[0], -1)
+            candidates = candidates.reshape(Z.shape[0], -1)
+
+            # greedily by distance, every previous measurement starts at most one track
+            taken = np.zeros(previous.shape[0], dtype=bool)
+            for flat in np.argsort(distances, axis=None):
+                j, c = np.unravel_index(flat, distances.shape)
+                if not np.isfinite(distances[j, c]):
+                    break
+                p = candidates[j, c]
+                if linked[j] < 0 and not taken[p]:
+                    linked[j] = p
+                    taken[p] = True
+
+        is_linked = linked >= 0
+        return Z[is_linked], previous[linked[is_linked]], Z[~is_linked]
+
+    def select(
+        self,
+        # the tracks to keep: shape=(N,)
+        keep: np.ndarray,
+    ) -> None:
+        """Keep only the selected tracks."""
+        self.bankstate = MixtureParameters(
+            self.bankstate.weights[keep],
+            self.bankstate.components[keep],
+        )
+        self.track_ids = self.track_ids[keep]
+        self.status = self.status[keep]
+        self.hits = self.hits[keep]
+        self.misses = self.misses[keep]
+        self.age = self.age[keep]
+        self.log_evidence_ratio = self.log_evidence_ratio[keep]
+        self.existence = self.existence[keep]
+
+    def estimates(
+        self, confirmed_only: bool = True
+    ) -> Tuple[np.ndarray, GaussParamList]:  # track_ids and estimates: shapes=((N,), ...)
+        """Get the track numbers and state estimates of the (confirmed) tracks."""
+        estimates = self.bank.estimate(self.bankstate)
+        if not confirmed_only:
+            return self.track_ids, estimates
+        confirmed = self.status == CONFIRMED
+        return self.track_ids[confirmed], estimates[confirmed]
@@ -0,0 +1,509 @@
+"""
+Grid and random search over filter parameters, run in parallel and cached on disk.
+
+A search evaluates an objective, objective(params, data) -> metrics, for every parameter set of a
+search space. The parameter sets are farmed out to a process pool. Every worker loads the dataset
+once with load_data when it starts, instead of receiving it with every task. Each finished
+parameter set is written to the cache directory as <sha1 of the parameters>.json as soon as it is
+done. A search that is interrupted and started again with the same cache directory only runs the
+parameter sets that are missing.
+
+The cache is keyed by the parameters only, so use one cache directory per objective and dataset.
+
+FilterObjective is an objective that builds a filter from the parameters with a factory and runs it
+over a dataset loaded with load_mat_dataset, giving ANEES, ANIS and RMSE.
+
+successive_halving spends less time on bad parameter sets than a full grid. It runs all candidates
+on a short prefix of the dataset, keeps the best 1 / eta of them by a score, runs those on an eta
+times longer prefix, and so on until the survivors are run on the whole dataset. ConsistencyScore
+scores a parameter set by the distance of ANEES and ANIS from their chi-square bands plus RMSE.
+"""
+# %% Imports
+# types
+from typing import Any, Callable, Dict, Iterable, List, Mapping, Optional, Sequence, Tuple
+
+# packages
+from dataclasses import dataclass
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import functools
+import hashlib
+import itertools
+import json
+import os
+import tempfile
+
+import numpy as np
+import scipy.io
+
+# local
+import estimationstatistics as estats
+from montecarlo import run_estimator
+
+Params = Dict[str, Any]
+Metrics = Dict[str, float]
+
+
+# %% Search spaces
+def grid(space: Mapping[str, Sequence[Any]]) -> List[Params]:
+    """All combinations of the values in space, the last parameter varying fastest."""
+    names = list(space)
+    return [
+        dict(zip(names, values)) for values in itertools.product(*space.values())
+    ]
+
+
+def random_parameters(
+    # the lower and upper bound of every parameter
+    bounds: Mapping[str, Tuple[float, float]],
+    n: int,
+    seed: Optional[int] = None,
+    # sample uniformly in log scale, as the noise parameters span decades
+    log_scale: bool = True,
+) -> List[Params]:
+    """Sample n parameter sets uniformly within bounds."""
+    rng = np.random.default_rng(seed)
+    low, high = np.array(list(bounds.values()), dtype=float).T
+    if log_scale:
+        assert np.all(low > 0), "random_parameters: log_scale needs positive bounds"
+        samples = np.exp(rng.uniform(np.log(low), np.log(high), size=(n, low.size)))
+    else:
+        samples = rng.uniform(low, high, size=(n, low.size))
+    return [dict(zip(bounds, map(float, sample))) for sample in samples]
+
+
+# %% Cache
+def _to_json(value: Any) -> Any:
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+
+def parameter_hash(params: Params) -> str:
+    """The sha1 of the parameters, independent of their order."""
+    text = json.dumps(params, sort_keys=True, default=_to_json)
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+@dataclass
+class ResultCache:
+    # the directory holding one <parameter_hash>.json per finished parameter set
+    directory: str
+
+    def __post_init__(self):
+        os.makedirs(self.directory, exist_ok=True)
+
+    def path(self, params: Params) -> str:
+        return os.path.join(self.directory, parameter_hash(params) + ".json")
+
+    def get(self, params: Params) -> Optional[Metrics]:
+        """The cached metrics of params, or None if they are not evaluated."""
+        try:
+            with open(self.path(params)) as file:
+                return json.load(file)["metrics"]
+        except FileNotFoundError:
+            return None
+
+    def put(self, params: Params, metrics: Metrics) -> None:
+        """Store the metrics of params. The file is replaced atomically, so an interrupt can not
+        leave a partial entry behind."""
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "w") as file:
+            json.dump(dict(params=params, metrics=metrics), file, default=_to_json)
+        os.replace(tmp, self.path(params))
+
+    def trials(self) -> List["Trial"]:
+        """All the cached parameter sets with their metrics."""
+        trials = []
+        for name in sorted(os.listdir(self.directory)):
+            if name.endswith(".json"):
+                with open(os.path.join(self.directory, name)) as file:
+                    entry = json.load(file)
+                trials.append(Trial(entry["params"], entry["metrics"]))
+        return trials
+
+
+# %% Search
+@dataclass
+class Trial:
+    params: Params
+    metrics: Metrics
+
+
+def best(
+    trials: Sequence[Trial], key: str, minimize: bool = True
+) -> Trial:
+    """The trial with the lowest (or highest) finite value of metric key."""
+    values = np.array([trial.metrics[key] for trial in trials], dtype=float)
+    values[~np.isfinite(values)] = np.inf if minimize else -np.inf
+    return trials[int(np.argmin(values) if minimize else np.argmax(values))]
+
+
+# the dataset and objective of a worker process, set once by _init_worker
+_worker: Dict[str, Any] = {}
+
+
+def _init_worker(
+    load_data: Callable[[], Any], objective: Callable[[Params, Any], Metrics]
+) -> None:
+    _worker["data"] = load_data()
+    _worker["objective"] = objective
+
+
+def _run_worker(params: Params) -> Metrics:
+    return _worker["objective"](params, _worker["data"])
+
+
+def search(
+    # the metrics of a parameter set on the data. Must be picklable to run in a pool
+    objective: Callable[[Params, Any], Metrics],
+    candidates: Iterable[Params],
+    # loads the data, called once in every worker. Must be picklable to run in a pool
+    load_data: Callable[[], Any],
+    # where finished parameter sets are stored, None to not cache
+    cache_dir: Optional[str] = None,
+    # number of worker processes, None for all cores, 0 to run in this process
+    max_workers: Optional[int] = None,
+    # called with every trial as it finishes, eg. for progress
+    callback: Optional[Callable[[Trial], None]] = None,
+) -> List[Trial]:
+    """Evaluate objective for all candidates, taking the ones already in the cache from there."""
+    candidates = list(candidates)
+    cache = ResultCache(cache_dir) if cache_dir is not None else None
+
+    metrics: List[Optional[Metrics]] = [
+        cache.get(params) if cache is not None else None for params in candidates
+    ]
+    todo = [i for i, m in enumerate(metrics) if m is None]
+
+    def finish(i: int, result: Metrics) -> None:
+        result = {key: float(value) for key, value in result.items()}
+        metrics[i] = result
+        if cache is not None:
+            cache.put(candidates[i], result)
+        if callback is not None:
+            callback(Trial(candidates[i], result))
+
+    if max_workers == 0:
+        if todo:
+            data = load_data()
+        for i in todo:
+            finish(i, objective(candidates[i], data))
+    elif todo:
+        with ProcessPoolExecutor(
+            max_workers=max_workers,
+            initializer=_init_worker,
+            initargs=(load_data, objective),
+        ) as pool:
+            futures = {pool.submit(_run_worker, candidates[i]): i for i in todo}
+            try:
+                for future in as_completed(futures):
+                    finish(futures[future], future.result())
+            except BaseException:
+                # keep what is cached, and do not wait for the queued parameter sets
+                for future in futures:
+                    future.cancel()
+                raise
+
+    return [Trial(params, m) for params, m in zip(candidates, metrics)]
+
+
+# %% Filter objective
+def load_mat_dataset(filename: str) -> Dict[str, Any]:
+    """
+    Load one of the bundled .mat files as Z, Xgt (K, n) and Ts (K,).
+
+    Z is (K, m) for single measurements, or a list of K scans (M, m) for the PDA datasets.
+    Ts of the first time step is taken equal to the next when the file has one Ts per interval.
+    The true associations a (1 indexed, 0 when missed) are included when the file has them.
+    """
+    loaded_data = scipy.io.loadmat(filename)
+    Z = loaded_data["Z"]
+    Z = [zk.T for zk in Z.ravel()] if Z.dtype == object else Z.T
+    K = len(Z)
+
+    Ts = np.asarray(loaded_data["Ts"], dtype=float).ravel()
+    if Ts.size == 1:
+        Ts = np.full(K, Ts.item())
+    elif Ts.size == K - 1:
+        Ts = np.concatenate((Ts[:1], Ts))
+
+    data = dict(Z=Z, Xgt=loaded_data["Xgt"].T, Ts=Ts)
+    if "a" in loaded_data:
+        data["a"] = loaded_data["a"].ravel()
+    return data
+
+
+@dataclass
+class FilterObjective:
+    # creates the estimator, eg. an EKF, IMM or PDA, from the parameters
+    make_filter: Callable[[Params], Any]
+    # creates the initial state from the parameters and the data
+    make_init: Callable[[Params, Dict[str, Any]], Any]
+    # the part of the state to calculate NEES for
+    idxs: Sequence[int] = (0, 1, 2, 3)
+    pos_idx: Sequence[int] = (0, 1)
+    vel_idx: Sequence[int] = (2, 3)
+    confidence: float = 0.95
+
+    def __call__(
+        self,
+        params: Params,
+        data: Dict[str, Any],
+        # only run the first steps time steps, None for all
+        steps: Optional[int] = None,
+    ) -> Metrics:
+        """Run the filter of params over data and calculate its consistency and errors."""
+        estimator = self.make_filter(params)
+        K = len(data["Z"][:steps])
+        m = np.shape(data["Z"][0])[-1]
+        try:
+            run = run_estimator(
+                estimator,
+                self.make_init(params, data),
+                data["Z"][:steps],
+                data["Xgt"][:steps],
+                data["Ts"][:steps],
+                idxs=np.asarray(self.idxs),
+                pos_idx=np.asarray(self.pos_idx),
+                vel_idx=np.asarray(self.vel_idx),
+            )
+        except (np.linalg.LinAlgError, AssertionError):
+            # the filter diverged, or failed its checks, eg. a covariance that is not PSD
+            return self.diverged(K, m)
+        NEES = run["NEES"]
+        NIS = run["NIS"][np.isfinite(run["NIS"])]
+        ANEES_lower, ANEES_upper = estats.chi2_average_interval(
+            len(self.idxs), NEES.size, self.confidence
+        )
+        metrics = dict(
+            ANEES=NEES.mean(),
+            ANEES_lower=ANEES_lower,
+            ANEES_upper=ANEES_upper,
+            pos_RMSE=np.sqrt(np.mean(run["pos_err"] ** 2)),
+            vel_RMSE=np.sqrt(np.mean(run["vel_err"] ** 2)),
+        )
+        if NIS.size > 0:
+            ANIS_lower, ANIS_upper = estats.chi2_average_interval(
+                np.shape(data["Z"][0])[-1], NIS.size, self.confidence
+            )
+            metrics.update(ANIS=NIS.mean(), ANIS_lower=ANIS_lower, ANIS_upper=ANIS_upper)
+        return metrics
+
+    def diverged(
+        self,
+        # the number of time steps and the measurement dimension
+        K: int,
+        m: int,
+    ) -> Metrics:
+        """The metrics of a diverged run: infinite, with the bounds of a run of K steps."""
+        ANEES_lower, ANEES_upper = estats.chi2_average_interval(len(self.idxs), K, self.confidence)
+        ANIS_lower, ANIS_upper = estats.chi2_average_interval(m, K, self.confidence)
+        return dict(
+            ANEES=np.inf,
+            ANEES_lower=ANEES_lower,
+            ANEES_upper=ANEES_upper,
+            ANIS=np.inf,
+            ANIS_lower=ANIS_lower,
+            ANIS_upper=ANIS_upper,
+            pos_RMSE=np.inf,
+            vel_RMSE=np.inf,
+        )
+
+
+# %% Successive halving
+def band_distance(value: float, lower: float, upper: float) -> float:
+    """0 inside [lower, upper], otherwise the log of the ratio to the closest bound."""
+    if not np.isfinite(value):
+        return np.inf
+    return max(np.log(lower / value), np.log(value / upper), 0.0)
+
+
+@dataclass
+class ConsistencyScore:
+    # the weights of the terms, lower scores are better
+    ANEES: float = 1.0
+    ANIS: float = 1.0
+    pos_RMSE: float = 0.0
+    vel_RMSE: float = 0.0
+
+    def __call__(self, metrics: Metrics) -> float:
+        """
+        The weighted sum of the band distances of ANEES and ANIS, and the RMSEs.
+
+        A metric without its bounds, or a missing RMSE, scores as the worst, inf.
+        """
+        score = 0.0
+        for key in ("ANEES", "ANIS"):
+            weight = getattr(self, key)
+            if weight != 0 and key in metrics:
+                lower = metrics.get(key + "_lower")
+                upper = metrics.get(key + "_upper")
+                if lower is None or upper is None:
+                    return np.inf
+                score += weight * band_distance(metrics[key], lower, upper)
+        for key in ("pos_RMSE", "vel_RMSE"):
+            weight = getattr(self, key)
+            if weight != 0:
+                score += weight * metrics.get(key, np.inf)
+        return score
+
+
+@dataclass
+class Rung:
+    # the prefix length the trials were run on, None for the whole dataset
+    steps: Optional[int]
+    trials: List[Trial]
+    # the score of every trial, shape=(len(trials),)
+    scores: np.ndarray
+
+    def best(self) -> Trial:
+        return self.trials[int(np.argmin(self.scores))]
+
+
+def successive_halving(
+    # objective(params, data, steps) gives the metrics over the first steps time steps,
+    # eg. a FilterObjective. Must be picklable to run in a pool
+    objective: Callable[..., Metrics],
+    candidates: Iterable[Params],
+    # loads the data, called once in every worker. Must be picklable to run in a pool
+    load_data: Callable[[], Any],
+    # the prefix length of the first rung
+    min_steps: int,
+    # the length of the dataset, the last rung runs on all of it
+    max_steps: int,
+    # the fraction 1 / eta of the candidates kept, and the growth of the prefix, per rung
+    eta: int = 3,
+    # lower is better
+    score: Callable[[Metrics], float] = ConsistencyScore(),
+    # every rung is cached in its own subdirectory, None to not cache
+    cache_dir: Optional[str] = None,
+    max_workers: Optional[int] = None,
+) -> List[Rung]:
+    """Search candidates by successive halving on prefixes of the dataset, returning every rung."""
+    assert eta >= 2, "successive_halving: eta must be at least 2"
+    assert 0 < min_steps, "successive_halving: min_steps must be positive"
+    candidates = list(candidates)
+
+    rungs: List[Rung] = []
+    steps = min_steps
+    while True:
+        last = steps >= max_steps or len(candidates) <= 1
+        rung_steps = None if last else steps
+        trials = search(
+            functools.partial(objective, steps=rung_steps),
+            candidates,
+            load_data,
+            cache_dir=(
+                os.path.join(cache_dir, f"steps_{rung_steps or 'all'}")
+                if cache_dir is not None
+                else None
+            ),
+            max_workers=max_workers,
+        )
+        scores = np.array([score(trial.metrics) for trial in trials])
+        rungs.append(Rung(rung_steps, trials, scores))
+        if last:
+            return rungs
+
+        # a stable sort, so ties keep the candidate order
+        keep = np.argsort(scores, kind="stable")[: max(len(candidates) // eta, 1)]
+        candidates = [candidates[i] for i in keep]
+        steps *= eta
+
+
+# %% Example: task 5 b of run_ekf.py
+def _make_cv_ekf(params: Params):
+    import ekf
+    import dynamicmodels
+    import measurementmodels
+
+    return ekf.EKF(
+        dynamicmodels.WhitenoiseAccelleration(params["sigma_a"]),
+        measurementmodels.CartesianPosition(params["sigma_z"]),
+    )
+
+
+def _make_cv_init(params: Params, data: Dict[str, Any]):
+    from gaussparams import GaussParams
+
+    z0 = data["Z"][0]
+    cov = np.diag([params["sigma_z"] ** 2] * 2 + [10 ** 2] * 2)
+    return GaussParams(np.array([*z0, 0, 0]), cov)
+
+
+def _load_ekf_data() -> Dict[str, Any]:
+    return load_mat_dataset("data_for_ekf.mat")
+
+
+# %% Example: the IMM-PDA of run_imm_pda.py
+def _make_imm_pda(params: Params):
+    import ekf
+    import imm
+    import pda
+    import dynamicmodels
+    import measurementmodels
+
+    measurement_model = measurementmodels.CartesianPosition(params["sigma_z"], state_dim=5)
+    dynamic_models = [
+        dynamicmodels.WhitenoiseAccelleration(params["sigma_a_CV"], n=5),
+        dynamicmodels.ConstantTurnrate(params["sigma_a_CT"], params["sigma_omega"]),
+    ]
+    p_switch = params["p_switch"]
+    PI = np.array([[1 - p_switch, p_switch], [p_switch, 1 - p_switch]])
+    imm_filter = imm.IMM([ekf.EKF(dm, measurement_model) for dm in dynamic_models], PI)
+    return pda.PDA(imm_filter, params["clutter_intensity"], params["PD"], 5)
+
+
+def _make_imm_pda_init(params: Params, data: Dict[str, Any]):
+    from gaussparams import GaussParams
+    from mixturedata import MixtureParameters
+
+    mode_state = GaussParams(np.array([0, 20, 0, 0, 0]), np.diag([5, 5, 3, 3, 1]) ** 2)
+    return MixtureParameters(np.array([0.9, 0.1]), [mode_state] * 2)
+
+
+def _load_imm_pda_data() -> Dict[str, Any]:
+    return load_mat_dataset("data_for_imm_pda.mat")
+
+
+if __name__ == "__main__":
+    # a diverged candidate scores as the worst, and does not stop a search
+    diverged = FilterObjective(_make_cv_ekf, _make_cv_init).diverged(100, 2)
+    assert ConsistencyScore()(diverged) == np.inf, "a diverged candidate must score inf"
+
+    space = dict(
+        sigma_a=np.logspace(np.log10(0.5), np.log10(10), 20).tolist(),
+        sigma_z=np.logspace(np.log10(0.3), np.log10(12), 20).tolist(),
+    )
+    trials = search(
+        FilterObjective(_make_cv_ekf, _make_cv_init),
+        grid(space),
+        _load_ekf_data,
+        cache_dir="tuning_cache/ekf_cv",
+    )
+    for key in ("pos_RMSE", "vel_RMSE"):
+        print(f"best {key}: {best(trials, key)}")
+
+    bounds = dict(
+        sigma_z=(1, 5),
+        sigma_a_CV=(0.05, 2),
+        sigma_a_CT=(0.02, 1),
+        sigma_omega=(0.005, 0.2),
+        p_switch=(0.01, 0.3),
+        PD=(0.6, 0.99),
+        clutter_intensity=(1e-5, 1e-2),
+    )
+    rungs = successive_halving(
+        FilterObjective(_make_imm_pda, _make_imm_pda_init),
+        random_parameters(bounds, 81, seed=0),
+        _load_imm_pda_data,
+        min_steps=12,
+        max_steps=100,
+        score=ConsistencyScore(ANEES=1, pos_RMSE=0.1),
+        cache_dir="tuning_cache/imm_pda",
+    )
+    for rung in rungs:
+        print(f"steps={rung.steps}: {len(rung.trials)} candidates, best score {rung.scores.min():.3f}")
+    print(f"best: {rungs[-1].best()}")
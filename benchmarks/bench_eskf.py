@@ -0,0 +1,134 @@
+"""
+Benchmarks of the ESKF in graded_2.
+
+The micro benchmarks time ESKF.predict and ESKF.update_GNSS_position with and without the debug
+checks. The macro benchmark runs the ESKF over a constant velocity flight with IMU measurements at
+100 Hz and a GNSS position every second, set up as in run_INS_simulated.py. When
+task_simulation.mat is present (it is not bundled) the start of it is run as well.
+"""
+# %% Imports
+from typing import Callable, Dict
+import os
+
+import numpy as np
+import scipy.io
+
+import benchutil
+
+benchutil.use_folder("graded_2")
+from eskf import (  # noqa: E402
+    ESKF,
+    POS_IDX,
+    VEL_IDX,
+    ERR_ATT_IDX,
+    ERR_ACC_BIAS_IDX,
+    ERR_GYRO_BIAS_IDX,
+)
+
+
+# %% Setup, as in run_INS_simulated.py
+def make_eskf(debug: bool = False) -> ESKF:
+    return ESKF(0.5 * 1e-3, 0.5 * 4.36e-5, 4e-3 / 3, 5e-5 * 5 / 3, debug=debug)
+
+
+def init_state():
+    x = np.zeros(16)
+    x[POS_IDX] = np.array([0, 0, -5])
+    x[VEL_IDX] = np.array([20, 0, 0])
+    x[6] = 1
+    P = np.zeros((15, 15))
+    P[POS_IDX ** 2] = 2.5 ** 2 * np.eye(3)
+    P[VEL_IDX ** 2] = 1 ** 2 * np.eye(3)
+    P[ERR_ATT_IDX ** 2] = 0.01 * np.eye(3)
+    P[ERR_ACC_BIAS_IDX ** 2] = 0.03 * np.eye(3)
+    P[ERR_GYRO_BIAS_IDX ** 2] = 0.0005 * np.eye(3)
+    return x, P
+
+
+def run(eskf: ESKF, z_acc, z_gyro, Ts, z_GNSS, GNSS_steps, R_GNSS, lever_arm) -> None:
+    x, P = init_state()
+    GNSSk = 0
+    for k in range(len(z_acc) - 1):
+        if GNSSk < len(GNSS_steps) and k == GNSS_steps[GNSSk]:
+            x, P = eskf.update_GNSS_position(x, P, z_GNSS[GNSSk], R_GNSS, lever_arm)
+            GNSSk += 1
+        x, P = eskf.predict(x, P, z_acc[k + 1], z_gyro[k + 1], Ts[k + 1])
+
+
+def flight(steps: int, rng: np.random.Generator):
+    """IMU and GNSS measurements of a constant velocity flight north at 20 m/s."""
+    Ts = np.full(steps, 0.01)
+    z_acc = np.array([0, 0, -9.81]) + 1e-3 * rng.normal(size=(steps, 3))
+    z_gyro = 4e-5 * rng.normal(size=(steps, 3))
+    GNSS_steps = np.arange(99, steps, 100)
+    z_GNSS = np.array([0, 0, -5]) + np.outer(GNSS_steps * 0.01, [20, 0, 0])
+    z_GNSS += rng.normal(scale=0.3, size=z_GNSS.shape)
+    return z_acc, z_gyro, Ts, z_GNSS, GNSS_steps
+
+
+# %% Benchmarks
+def benchmarks(quick: bool) -> Dict[str, Callable[[], Dict[str, float]]]:
+    repeat = 3 if quick else 5
+    rng = np.random.default_rng(0)
+    eskf = make_eskf()
+    eskf_debug = make_eskf(debug=True)
+
+    x, P = init_state()
+    z_acc, z_gyro = np.array([0.01, -0.02, -9.8]), np.array([1e-4, -2e-4, 3e-4])
+    z_GNSS = np.array([0.5, -0.3, -4.8])
+    R_GNSS = np.diag([0.3, 0.3, 0.5]) ** 2
+    lever_arm = np.array([-0.5, 0, -0.3])
+
+    flight_data = flight(2000 if quick else 10000, rng)
+
+    results = {
+        "ESKF.predict": lambda: benchutil.measure(
+            lambda: eskf.predict(x, P, z_acc, z_gyro, 0.01), repeat
+        ),
+        "ESKF.predict[debug]": lambda: benchutil.measure(
+            lambda: eskf_debug.predict(x, P, z_acc, z_gyro, 0.01), repeat
+        ),
+        "ESKF.update_GNSS_position": lambda: benchutil.measure(
+            lambda: eskf.update_GNSS_position(x, P, z_GNSS, R_GNSS, lever_arm), repeat
+        ),
+        "ESKF.update_GNSS_position[debug]": lambda: benchutil.measure(
+            lambda: eskf_debug.update_GNSS_position(x, P, z_GNSS, R_GNSS, lever_arm), repeat
+        ),
+        "run/ESKF flight": lambda: benchutil.measure(
+            lambda: run(eskf, *flight_data, R_GNSS, lever_arm), repeat, number=1
+        ),
+    }
+
+    if os.path.exists("task_simulation.mat"):
+        loaded_data = scipy.io.loadmat("task_simulation.mat")
+        steps = 2000 if quick else 20000
+        timeIMU = loaded_data["timeIMU"].ravel()[:steps]
+        timeGNSS = loaded_data["timeGNSS"].ravel()
+        GNSS_steps = np.searchsorted(timeIMU, timeGNSS[timeGNSS <= timeIMU[-1]])
+        data = (
+            loaded_data["zAcc"].T[:steps],
+            loaded_data["zGyro"].T[:steps],
+            np.array([0, *np.diff(timeIMU)]),
+            loaded_data["zGNSS"].T,
+            GNSS_steps,
+            R_GNSS,
+            loaded_data["leverarm"].ravel(),
+        )
+        eskf_data = ESKF(
+            0.5 * 1e-3,
+            0.5 * 4.36e-5,
+            4e-3 / 3,
+            5e-5 * 5 / 3,
+            S_a=loaded_data["S_a"],
+            S_g=loaded_data["S_g"],
+            debug=False,
+        )
+        results["run/ESKF task_simulation"] = lambda: benchutil.measure(
+            lambda: run(eskf_data, *data), repeat, number=1
+        )
+
+    return results
+
+
+if __name__ == "__main__":
+    benchutil.group_main(benchmarks)
@@ -0,0 +1,134 @@
+"""
+Benchmarks of the EKF, IMM and PDA in Graded_1.
+
+The micro benchmarks time single predict, update and step calls on a state from the bundled
+datasets, the macro benchmarks run the filters over the whole datasets as the run scripts do.
+"""
+# %% Imports
+from typing import Callable, Dict
+
+import numpy as np
+
+import benchutil
+
+benchutil.use_folder("Graded_1")
+import dynamicmodels  # noqa: E402
+import measurementmodels  # noqa: E402
+import ekf  # noqa: E402
+import imm  # noqa: E402
+import pda  # noqa: E402
+from gaussparams import GaussParams  # noqa: E402
+from mixturedata import MixtureParameters  # noqa: E402
+from tuning import load_mat_dataset  # noqa: E402
+
+
+# %% Filters, as set up in the run scripts
+def make_ekf() -> ekf.EKF:
+    return ekf.EKF(
+        dynamicmodels.WhitenoiseAccelleration(2.6), measurementmodels.CartesianPosition(3.1)
+    )
+
+
+def make_imm(debug: bool = False) -> imm.IMM:
+    measurement_model = measurementmodels.CartesianPosition(1.9, state_dim=5)
+    ekf_filters = [
+        ekf.EKF(dynamicmodels.WhitenoiseAccelleration(0.14, n=5), measurement_model),
+        ekf.EKF(dynamicmodels.ConstantTurnrate(0.06, 0.02), measurement_model),
+    ]
+    return imm.IMM(ekf_filters, np.array([[0.9, 0.1], [0.1, 0.9]]), debug=debug)
+
+
+def init_ekf_state(Z: np.ndarray) -> GaussParams:
+    return GaussParams(np.array([*Z[0], 0, 0]), np.diag([3.1, 3.1, 10, 10]) ** 2)
+
+
+def init_imm_state() -> MixtureParameters:
+    mode_state = GaussParams(np.array([0, 20, 0, 0, 0]), np.diag([5, 5, 3, 3, 1]) ** 2)
+    return MixtureParameters(np.array([0.9, 0.1]), [mode_state] * 2)
+
+
+def run(tracker, state, Z, Ts) -> None:
+    for zk, Tsk in zip(Z, Ts):
+        state = tracker.step(zk, state, Tsk)
+
+
+def warm_state(tracker, state, Z, Ts, steps: int = 10):
+    """The state after the first steps of a dataset, so the micro benchmarks see a typical state."""
+    for zk, Tsk in zip(Z[:steps], Ts[:steps]):
+        state = tracker.step(zk, state, Tsk)
+    return state
+
+
+# %% Benchmarks
+def benchmarks(quick: bool) -> Dict[str, Callable[[], Dict[str, float]]]:
+    repeat = 3 if quick else 5
+    ekf_data = load_mat_dataset("data_for_ekf.mat")
+    imm_data = load_mat_dataset("data_for_imm.mat")
+    pda_data = load_mat_dataset("data_for_pda.mat")
+    imm_pda_data = load_mat_dataset("data_for_imm_pda.mat")
+    K = 200 if quick else None
+
+    ekf_filter = make_ekf()
+    ekf_state = warm_state(ekf_filter, init_ekf_state(ekf_data["Z"]), ekf_data["Z"], ekf_data["Ts"])
+    ekf_predicted = ekf_filter.predict(ekf_state, 0.1)
+    z = ekf_data["Z"][10]
+
+    imm_filter = make_imm()
+    imm_state = warm_state(imm_filter, init_imm_state(), imm_data["Z"], imm_data["Ts"])
+    imm_filter_debug = make_imm(debug=True)
+
+    pda_ekf = pda.PDA(make_ekf(), 1e-3, 0.9, 5)
+    pda_ekf_state = warm_state(
+        pda_ekf, init_ekf_state(pda_data["Xgt"][:, :2]), pda_data["Z"], pda_data["Ts"]
+    )
+    pda_imm = pda.PDA(make_imm(), 1e-4, 0.85, 3)
+    pda_imm_state = warm_state(pda_imm, init_imm_state(), imm_pda_data["Z"], imm_pda_data["Ts"])
+
+    def ekf_run():
+        Z = ekf_data["Z"][:K]
+        run(ekf_filter, init_ekf_state(Z), Z, ekf_data["Ts"])
+
+    def pda_ekf_run():
+        run(
+            pda_ekf,
+            init_ekf_state(pda_data["Xgt"][:, :2]),
+            pda_data["Z"][:K],
+            pda_data["Ts"],
+        )
+
+    return {
+        "EKF.predict": lambda: benchutil.measure(
+            lambda: ekf_filter.predict(ekf_state, 0.1), repeat
+        ),
+        "EKF.update": lambda: benchutil.measure(
+            lambda: ekf_filter.update(z, ekf_predicted), repeat
+        ),
+        "IMM.step": lambda: benchutil.measure(
+            lambda: imm_filter.step(imm_data["Z"][10], imm_state, 0.1), repeat
+        ),
+        "IMM.step[debug]": lambda: benchutil.measure(
+            lambda: imm_filter_debug.step(imm_data["Z"][10], imm_state, 0.1), repeat
+        ),
+        "PDA(EKF).step": lambda: benchutil.measure(
+            lambda: pda_ekf.step(pda_data["Z"][10], pda_ekf_state, 0.1), repeat
+        ),
+        "PDA(IMM).step": lambda: benchutil.measure(
+            lambda: pda_imm.step(imm_pda_data["Z"][10], pda_imm_state, 0.1), repeat
+        ),
+        "run/EKF data_for_ekf": lambda: benchutil.measure(ekf_run, repeat, number=1),
+        "run/IMM data_for_imm": lambda: benchutil.measure(
+            lambda: run(imm_filter, init_imm_state(), imm_data["Z"], imm_data["Ts"]),
+            repeat,
+            number=1,
+        ),
+        "run/PDA(EKF) data_for_pda": lambda: benchutil.measure(pda_ekf_run, repeat, number=1),
+        "run/PDA(IMM) data_for_imm_pda": lambda: benchutil.measure(
+            lambda: run(pda_imm, init_imm_state(), imm_pda_data["Z"], imm_pda_data["Ts"]),
+            repeat,
+            number=1,
+        ),
+    }
+
+
+if __name__ == "__main__":
+    benchutil.group_main(benchmarks)
@@ -0,0 +1,90 @@
+"""
+Benchmarks of the Gaussian mixture moments in Graded_1/mixturereduction.py.
+
+gaussian_mixture_moments is timed against the previous implementation, kept here as reference, for
+single mixtures of growing size and for a batch of mixtures against a loop over the reference. The
+results of the two are checked to agree before any timing.
+"""
+# %% Imports
+from typing import Callable, Dict, Tuple
+
+import numpy as np
+
+import benchutil
+
+benchutil.use_folder("Graded_1")
+import mixturereduction  # noqa: E402
+
+
+# %% The previous implementation, kept as reference
+def gaussian_mixture_moments_reference(
+    w: np.ndarray,  # the mixture weights shape=(N,)
+    x: np.ndarray,  # the mixture means shape(N, n)
+    P: np.ndarray,  # the mixture covariances shape (N, n, n)
+) -> Tuple[np.ndarray, np.ndarray]:
+    xbar = np.average(x, axis=0, weights=w)
+    Pint = np.average(P, axis=0, weights=w)
+    xdiff = x - xbar[None]
+    Pext = np.average(xdiff[:, :, None] * xdiff[:, None, :], axis=0, weights=w)
+    return xbar, Pint + Pext
+
+
+def random_mixture(rng: np.random.Generator, N: int, n: int, batch: Tuple[int, ...] = ()):
+    w = rng.uniform(size=(*batch, N))
+    x = rng.normal(size=(*batch, N, n))
+    A = rng.normal(size=(*batch, N, n, n))
+    P = A @ A.swapaxes(-1, -2) + np.eye(n)
+    return w, x, P
+
+
+def looped_reference(w: np.ndarray, x: np.ndarray, P: np.ndarray):
+    return [gaussian_mixture_moments_reference(*args) for args in zip(w, x, P)]
+
+
+# %% Benchmarks
+def benchmarks(quick: bool) -> Dict[str, Callable[[], Dict[str, float]]]:
+    repeat = 3 if quick else 5
+    rng = np.random.default_rng(0)
+    n = 5
+    B = 100
+    Ns = [2, 10, 100] if quick else [2, 5, 10, 20, 50, 100, 200, 500]
+
+    results = {}
+    for N in Ns:
+        w, x, P = random_mixture(rng, N, n)
+        ref = gaussian_mixture_moments_reference(w, x, P)
+        cur = mixturereduction.gaussian_mixture_moments(w, x, P)
+        assert all(np.allclose(r, c) for r, c in zip(ref, cur)), f"mismatch at N={N}"
+
+        results[f"gaussian_mixture_moments[N={N}]"] = (
+            lambda w=w, x=x, P=P: benchutil.measure(
+                lambda: mixturereduction.gaussian_mixture_moments(w, x, P), repeat
+            )
+        )
+        results[f"reference/gaussian_mixture_moments[N={N}]"] = (
+            lambda w=w, x=x, P=P: benchutil.measure(
+                lambda: gaussian_mixture_moments_reference(w, x, P), repeat
+            )
+        )
+
+    for N in Ns:
+        w, x, P = random_mixture(rng, N, n, (B,))
+        cur = mixturereduction.gaussian_mixture_moments(w, x, P)
+        ref = looped_reference(w, x, P)
+        assert np.allclose(cur[0], [r[0] for r in ref]), f"batched mean mismatch at N={N}"
+        assert np.allclose(cur[1], [r[1] for r in ref]), f"batched cov mismatch at N={N}"
+
+        results[f"gaussian_mixture_moments[B={B}, N={N}]"] = (
+            lambda w=w, x=x, P=P: benchutil.measure(
+                lambda: mixturereduction.gaussian_mixture_moments(w, x, P), repeat
+            )
+        )
+        results[f"reference/looped[B={B}, N={N}]"] = (
+            lambda w=w, x=x, P=P: benchutil.measure(lambda: looped_reference(w, x, P), repeat)
+        )
+
+    return results
+
+
+if __name__ == "__main__":
+    benchutil.group_main(benchmarks)
@@ -0,0 +1,110 @@
+"""
+Benchmarks of the EKF-SLAM in gradedSLAM.
+
+EKFSLAM.predict, EKFSLAM.update and JCBB are timed on synthetic maps of growing landmark counts,
+as their cost grows with the size of the map, with scans of a few of the landmarks. detectTrees is timed on a synthetic laser scan, as
+the Victoria Park laser data is not bundled. The macro benchmark runs the start of
+simulatedSLAM.mat as run_simulated_SLAM.py does, with data association on.
+"""
+# %% Imports
+from typing import Callable, Dict
+
+import numpy as np
+import scipy.io
+
+import benchutil
+
+benchutil.use_folder("gradedSLAM")
+from EKFSLAM import EKFSLAM  # noqa: E402
+from JCBB import JCBB  # noqa: E402
+from vp_utils import detectTrees  # noqa: E402
+
+# as in run_simulated_SLAM.py
+Q = np.diag([0.9, 0.9, np.pi / 85]) * 1e-3
+R = np.diag([0.06 ** 2, 0.02 ** 2])
+ALPHAS = np.array([1e-4, 1e-5])
+
+
+# %% Synthetic data
+def synthetic_map(slam: EKFSLAM, L: int, rng: np.random.Generator, visible: int = 8):
+    """A state with L landmarks around the robot with a dense covariance, and a scan of visible of
+    the landmarks plus a new one, as a scan only sees a few of the landmarks of a large map."""
+    landmarks = rng.uniform(-50, 50, size=(L, 2))
+    eta = np.concatenate(([0, 0, 0.1], landmarks.ravel()))
+    n = eta.size
+    B = rng.normal(size=(n, n))
+    P = np.diag(np.full(n, 0.05)) + 1e-3 * B @ B.T / n
+
+    seen = rng.choice(L, size=min(visible, L), replace=False)
+    new = rng.uniform(-50, 50, size=(1, 2))
+    scanned = np.concatenate(([0, 0, 0.1], landmarks[seen].ravel(), new.ravel()))
+    z = slam.h(scanned).reshape(-1, 2)
+    z += rng.normal(size=z.shape) * np.sqrt(np.diag(R))
+    return eta, P, z[rng.permutation(len(z))]
+
+
+def synthetic_scan(trees: int, rng: np.random.Generator) -> np.ndarray:
+    """A laser scan of 361 ranges in metres with trees in front of an out of range background."""
+    scan = np.full(361, 80.0)
+    for center in rng.choice(np.arange(10, 350), size=trees, replace=False):
+        width = rng.integers(3, 8)
+        distance = rng.uniform(5, 40)
+        beams = np.arange(center - width // 2, center + width // 2 + 1)
+        scan[beams] = distance + 0.1 * np.abs(beams - center)
+    return scan
+
+
+def run_simulated(slam: EKFSLAM, z, odometry, poseGT, N: int) -> None:
+    eta, P = poseGT[0], np.zeros((3, 3))
+    for k in range(N):
+        eta, P, _, _ = slam.update(eta, P, z[k])
+        eta, P = slam.predict(eta, P, odometry[k])
+
+
+# %% Benchmarks
+def benchmarks(quick: bool) -> Dict[str, Callable[[], Dict[str, float]]]:
+    repeat = 3 if quick else 5
+    rng = np.random.default_rng(0)
+    slam = EKFSLAM(Q, R, do_asso=True, alphas=ALPHAS)
+    odo = np.array([0.1, 0.01, 0.005])
+
+    results = {}
+    for L in [10, 50, 100] if quick else [10, 50, 100, 200, 400]:
+        eta, P, z = synthetic_map(slam, L, rng)
+        zpred = slam.h(eta)
+        H = slam.H(eta)
+        S = H @ P @ H.T + np.kron(np.eye(L), R)
+        z_flat = z.ravel()
+
+        # predict works on P in place, so it gets a copy every call
+        results[f"EKFSLAM.predict[L={L}]"] = (
+            lambda eta=eta, P=P: benchutil.measure(
+                lambda: slam.predict(eta, P.copy(), odo), repeat
+            )
+        )
+        results[f"EKFSLAM.update[L={L}]"] = (
+            lambda eta=eta, P=P, z=z: benchutil.measure(lambda: slam.update(eta, P, z), repeat)
+        )
+        results[f"JCBB[L={L}]"] = (
+            lambda z_flat=z_flat, zpred=zpred, S=S: benchutil.measure(
+                lambda: JCBB(z_flat, zpred, S, *ALPHAS), repeat
+            )
+        )
+
+    scan = synthetic_scan(8, rng)
+    results["detectTrees"] = lambda: benchutil.measure(lambda: detectTrees(scan), repeat)
+
+    simSLAM_ws = scipy.io.loadmat("simulatedSLAM")
+    z_sim = [zk.T for zk in simSLAM_ws["z"].ravel()]
+    odometry = simSLAM_ws["odometry"].T
+    poseGT = simSLAM_ws["poseGT"].T
+    N = 100 if quick else 300
+    results[f"run/EKFSLAM simulatedSLAM[N={N}]"] = lambda: benchutil.measure(
+        lambda: run_simulated(slam, z_sim, odometry, poseGT, N), 1 if quick else 3, number=1
+    )
+
+    return results
+
+
+if __name__ == "__main__":
+    benchutil.group_main(benchmarks)
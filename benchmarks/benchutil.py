@@ -0,0 +1,71 @@
+"""
+Timing helpers shared by the benchmark groups.
+
+Every group (bench_filters.py, bench_eskf.py, bench_slam.py, bench_mixturereduction.py) is a
+script that imports the code of one assignment folder, times its benchmarks with measure and prints
+the results as JSON with group_main. The groups run as separate processes from run_benchmarks.py, as the assignment folders
+have modules with the same names (utils, mytypes, ...).
+"""
+# %% Imports
+from typing import Any, Callable, Dict, Optional
+import argparse
+import json
+import os
+import sys
+import timeit
+
+import numpy as np
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+
+def use_folder(folder: str) -> str:
+    """Make the modules of an assignment folder importable and run from it, so the bundled .mat
+    files are found as in the run scripts. Returns the absolute path of the folder."""
+    path = os.path.abspath(os.path.join(ROOT, folder))
+    sys.path.insert(0, path)
+    os.chdir(path)
+    return path
+
+
+def measure(
+    func: Callable[[], Any],
+    repeat: int = 5,
+    # calls per repeat, None to let timeit choose so that a repeat takes at least 0.2 s
+    number: Optional[int] = None,
+) -> Dict[str, float]:
+    """Time func, giving the best and median time per call in seconds over the repeats."""
+    timer = timeit.Timer(func)
+    if number is None:
+        number, _ = timer.autorange()
+    times = np.array(timer.repeat(repeat=repeat, number=number)) / number
+    return dict(best=float(times.min()), median=float(np.median(times)), number=number, repeat=repeat)
+
+
+def group_main(
+    # the benchmarks of the group, given whether to run the quick variants
+    benchmarks: Callable[[bool], Dict[str, Callable[[], Dict[str, float]]]],
+) -> None:
+    """Run the benchmarks of a group and print the results as JSON, or as a table with --table."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--quick", action="store_true", help="smaller sizes and shorter runs")
+    parser.add_argument("--table", action="store_true", help="print a table instead of JSON")
+    parser.add_argument("--filter", default="", help="only run benchmarks containing this")
+    args = parser.parse_args()
+
+    results = {}
+    for name, run in benchmarks(args.quick).items():
+        if args.filter in name:
+            results[name] = run()
+
+    if args.table:
+        print_table(results)
+    else:
+        json.dump(results, sys.stdout)
+
+
+def print_table(results: Dict[str, Dict[str, float]]) -> None:
+    width = max((len(name) for name in results), default=4)
+    print(f"{'name':<{width}} {'best [ms]':>11} {'median [ms]':>12}")
+    for name, result in results.items():
+        print(f"{name:<{width}} {result['best'] * 1e3:11.3f} {result['median'] * 1e3:12.3f}")
@@ -0,0 +1,129 @@
+"""
+Run the benchmark groups, store the results as JSON and compare them to a baseline.
+
+Every group runs in its own process from its assignment folder, see benchutil.py. A benchmark is
+flagged as a regression when its best time is more than threshold slower than in the baseline,
+and the exit code is then 1, so the suite can gate a change.
+
+    python run_benchmarks.py --save-baseline     # on the reference commit
+    python run_benchmarks.py                     # on the change, compared to the baseline
+    python run_benchmarks.py --optimize          # with python -O, skipping the asserts
+
+The baseline is machine specific, so compare only results from the same machine.
+"""
+# %% Imports
+from typing import Any, Dict, List, Tuple
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# group name: the script running it
+GROUPS = {
+    "filters": "bench_filters.py",
+    "eskf": "bench_eskf.py",
+    "slam": "bench_slam.py",
+    "mixturereduction": "bench_mixturereduction.py",
+}
+
+
+def run_group(group: str, quick: bool, optimize: bool, filter: str) -> Dict[str, Any]:
+    """Run a group in a separate process and get its results."""
+    command = [sys.executable, *(["-O"] if optimize else []), os.path.join(HERE, GROUPS[group])]
+    command += ["--filter", filter] + (["--quick"] if quick else [])
+    process = subprocess.run(command, capture_output=True, text=True)
+    if process.returncode != 0:
+        raise RuntimeError(process.stderr.strip().splitlines()[-1] if process.stderr else "failed")
+    # the modules may print, the results are the last line
+    return json.loads(process.stdout.strip().splitlines()[-1])
+
+
+def compare(
+    results: Dict[str, Dict[str, float]],
+    baseline: Dict[str, Dict[str, float]],
+    threshold: float,
+) -> Tuple[List[str], Dict[str, float]]:
+    """The regressed benchmarks and the ratio of the best times to the baseline."""
+    ratios = {
+        name: result["best"] / baseline[name]["best"]
+        for name, result in results.items()
+        if name in baseline
+    }
+    regressions = [name for name, ratio in ratios.items() if ratio > 1 + threshold]
+    return regressions, ratios
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--groups", nargs="+", choices=list(GROUPS), default=list(GROUPS))
+    parser.add_argument("--filter", default="", help="only run benchmarks containing this")
+    parser.add_argument("--quick", action="store_true", help="smaller sizes and shorter runs")
+    parser.add_argument("--optimize", action="store_true", help="run with python -O")
+    parser.add_argument("--output", default=os.path.join(HERE, "results.json"))
+    parser.add_argument("--baseline", default=os.path.join(HERE, "baseline.json"))
+    parser.add_argument("--save-baseline", action="store_true", help="store the results as the baseline")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed relative slowdown")
+    args = parser.parse_args()
+
+    results: Dict[str, Dict[str, float]] = {}
+    errors: Dict[str, str] = {}
+    for group in args.groups:
+        start = time.perf_counter()
+        try:
+            group_results = run_group(group, args.quick, args.optimize, args.filter)
+        except RuntimeError as e:
+            errors[group] = str(e)
+            print(f"{group}: failed: {e}", file=sys.stderr)
+            continue
+        results.update({f"{group}/{name}": result for name, result in group_results.items()})
+        print(f"{group}: {len(group_results)} benchmarks in {time.perf_counter() - start:.1f} s")
+
+    report = dict(
+        machine=dict(
+            platform=platform.platform(),
+            processor=platform.processor(),
+            python=platform.python_version(),
+            numpy=np.__version__,
+        ),
+        quick=args.quick,
+        optimize=args.optimize,
+        results=results,
+        errors=errors,
+    )
+    with open(args.output, "w") as file:
+        json.dump(report, file, indent=1)
+
+    baseline = {}
+    if args.save_baseline:
+        with open(args.baseline, "w") as file:
+            json.dump(report, file, indent=1)
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as file:
+            baseline_report = json.load(file)
+        if (baseline_report["quick"], baseline_report["optimize"]) != (args.quick, args.optimize):
+            print("baseline was run with other --quick or --optimize, not comparing", file=sys.stderr)
+        else:
+            baseline = baseline_report["results"]
+
+    regressions, ratios = compare(results, baseline, args.threshold)
+    width = max((len(name) for name in results), default=4)
+    print(f"\n{'name':<{width}} {'best [ms]':>11} {'median [ms]':>12} {'vs baseline':>12}")
+    for name, result in results.items():
+        ratio = f"{ratios[name]:11.2f}x" if name in ratios else f"{'-':>12}"
+        flag = "  REGRESSION" if name in regressions else ""
+        print(f"{name:<{width}} {result['best'] * 1e3:11.3f} {result['median'] * 1e3:12.3f} {ratio}{flag}")
+
+    if regressions:
+        print(f"\n{len(regressions)} regressions over {args.threshold:.0%}", file=sys.stderr)
+    return 1 if regressions or errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
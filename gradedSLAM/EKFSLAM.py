@@ -5,14 +5,9 @@ import scipy.linalg as la
 from utils import rotmat2d
 from JCBB import JCBB
 import utils
+import profiling
 from numpy import matlib as ml
 
-# import line_profiler
-# import atexit
-
-# profile = line_profiler.LineProfiler()
-# atexit.register(profile.print_stats)
-
 
 class EKFSLAM:
     def __init__(
@@ -110,6 +105,7 @@ class EKFSLAM:
         assert Fu.shape == (3, 3), "EKFSLAM.Fu: wrong shape"
         return Fu
 
+    @profiling.stage("EKFSLAM.predict")
     def predict(
         self, eta: np.ndarray, P: np.ndarray, z_odo: np.ndarray
     ) -> Tuple[np.ndarray, np.ndarray]:
@@ -271,6 +267,7 @@ class EKFSLAM:
         # TODO: You can set some assertions here to make sure that some of the structure in H is correct
         return H
 
+    @profiling.stage("EKFSLAM.add_landmarks")
     def add_landmarks(
         self, eta: np.ndarray, P: np.ndarray, z: np.ndarray
     ) -> Tuple[np.ndarray, np.ndarray]:
@@ -337,6 +334,7 @@ class EKFSLAM:
 
         return etaadded, Padded
 
+    @profiling.stage("EKFSLAM.associate")
     def associate(
         self, z: np.ndarray, zpred: np.ndarray, H: np.ndarray, S: np.ndarray,
     ):  # -> Tuple[*((np.ndarray,) * 5)]:
@@ -391,6 +389,7 @@ class EKFSLAM:
             # should one do something her
             pass
 
+    @profiling.stage("EKFSLAM.update")
     def update(
         self, eta: np.ndarray, P: np.ndarray, z: np.ndarray
     ) -> Tuple[np.ndarray, np.ndarray, float, np.ndarray]:
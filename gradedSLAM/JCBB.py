@@ -1,13 +1,14 @@
 import numpy as np
 from functools import lru_cache
-import profilehooks
 from scipy.stats import chi2
 import scipy.linalg as la
 import utils
+import profiling
 
 chi2isf_cached = lru_cache(maxsize=None)(chi2.isf)
 
 # TODO: make sure a is 0-indexed
+@profiling.stage("JCBB")
 def JCBB(z, zbar, S, alpha1, alpha2):
     assert len(z.shape) == 1, "z must be in one row in JCBB"
     assert z.shape[0] % 2 == 0, "z must be equal in x and y"
@@ -73,7 +74,7 @@ def JCBBrec(z, zbar, S, alpha1, g2, j, a, ic, abest):
     return abest
 
 
-#   @profilehooks.profile(sort="cumulative")
+@profiling.stage("JCBB.individualCompatibility")
 def individualCompatibility(z, zbar, S):
     nz = z.shape[0] // 2
     nz_bar = zbar.shape[0] // 2
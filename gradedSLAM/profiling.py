@@ -0,0 +1,18 @@
+"""
+The stage profiling of Graded_1/profiling.py, which is the one copy of it, see there for its use.
+
+The assignment folders import their modules by flat names, so this loads Graded_1/profiling.py by
+its path and puts it in place of this module. Graded_1 is not put on sys.path, as its modules
+would shadow the modules of this folder with the same names.
+"""
+import importlib.util
+import os
+import sys
+
+_spec = importlib.util.spec_from_file_location(
+    __name__,
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "Graded_1", "profiling.py"),
+)
+_module = importlib.util.module_from_spec(_spec)
+sys.modules[__name__] = _module
+_spec.loader.exec_module(_module)
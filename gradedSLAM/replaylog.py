@@ -0,0 +1,272 @@
+"""
+Record the inputs and outputs of every step of an estimator, and replay them to check that a
+changed estimator still gives the same results.
+
+A log holds the initial state, and for every step the inputs (eg. odometry, detections, Ts) and the
+outputs (eg. eta, P, NIS and the associations). The arrays of a step may have any shape, as the
+state of the SLAM grows with the map. Every array of a name is stored concatenated with its offsets
+and shapes in a compressed .npz file.
+
+replay runs a step function, step(state, inputs) -> (state, outputs), from the initial state over
+the logged inputs. It compares the outputs to the logged ones within tolerances, and reports the
+first step and output that diverge. Integer outputs, like associations, must match exactly.
+
+Record and replay EKFSLAM on simulatedSLAM.mat with
+    python replaylog.py record simulated_slam.npz --steps 200
+    python replaylog.py replay simulated_slam.npz
+"""
+# %% Imports
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+from dataclasses import dataclass, field
+import json
+
+import numpy as np
+
+Arrays = Dict[str, np.ndarray]
+SECTIONS = ("initial", "inputs", "outputs")
+
+
+# %% Recording
+@dataclass
+class Recorder:
+    filename: str
+    # anything needed to set up the estimator again, stored as JSON
+    meta: Dict[str, Any] = field(default_factory=dict)
+
+    _initial: Arrays = field(init=False, repr=False, default_factory=dict)
+    _steps: Dict[str, Dict[str, List[np.ndarray]]] = field(init=False, repr=False)
+
+    def __post_init__(self):
+        self._steps = dict(inputs={}, outputs={})
+
+    def __enter__(self) -> "Recorder":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.save()
+
+    def initial(self, **arrays: Any) -> None:
+        """Record the initial state."""
+        self._initial = {name: np.array(value) for name, value in arrays.items()}
+
+    def step(self, inputs: Dict[str, Any], outputs: Dict[str, Any]) -> None:
+        """Record the inputs and outputs of a step. The arrays are copied, so they may be changed
+        in place afterwards."""
+        for section, arrays in (("inputs", inputs), ("outputs", outputs)):
+            recorded = self._steps[section]
+            if recorded:
+                assert arrays.keys() == recorded.keys(), f"Recorder.step: {section} must have the same names every step"
+            for name, value in arrays.items():
+                recorded.setdefault(name, []).append(np.array(value))
+
+    def save(self) -> None:
+        """Write the log."""
+        data = {"meta": np.array(json.dumps(self.meta))}
+        data.update(_pack("initial", {name: [value] for name, value in self._initial.items()}))
+        for section, arrays in self._steps.items():
+            data.update(_pack(section, arrays))
+        np.savez_compressed(self.filename, **data)
+
+
+def _pack(section: str, arrays: Dict[str, List[np.ndarray]]) -> Arrays:
+    packed = {}
+    for name, values in arrays.items():
+        ndims = {value.ndim for value in values}
+        assert len(ndims) == 1, f"Recorder: {section} {name} must have the same number of dimensions every step"
+        sizes = [value.size for value in values]
+        packed[f"{section}/{name}/values"] = np.concatenate([value.ravel() for value in values])
+        packed[f"{section}/{name}/offsets"] = np.concatenate(([0], np.cumsum(sizes)))
+        packed[f"{section}/{name}/shapes"] = np.array([value.shape for value in values], dtype=int).reshape(len(values), ndims.pop())
+    return packed
+
+
+# %% Reading
+class ReplayLog:
+    """A recorded log, with the arrays of every step unpacked on access."""
+
+    def __init__(self, filename: str) -> None:
+        with np.load(filename) as data:
+            self._data = {key: data[key] for key in data.files}
+        self.meta: Dict[str, Any] = json.loads(self._data["meta"].item())
+        self.names: Dict[str, List[str]] = {section: [] for section in SECTIONS}
+        for key in self._data:
+            if key.endswith("/values"):
+                section, name, _ = key.split("/")
+                self.names[section].append(name)
+
+        offsets = [self._data[f"inputs/{name}/offsets"] for name in self.names["inputs"]]
+        self.steps = len(offsets[0]) - 1 if offsets else 0
+
+    def _get(self, section: str, name: str, k: int) -> np.ndarray:
+        offsets = self._data[f"{section}/{name}/offsets"]
+        shape = self._data[f"{section}/{name}/shapes"][k]
+        return self._data[f"{section}/{name}/values"][offsets[k] : offsets[k + 1]].reshape(shape)
+
+    @property
+    def initial(self) -> Arrays:
+        return {name: self._get("initial", name, 0) for name in self.names["initial"]}
+
+    def inputs(self, k: int) -> Arrays:
+        return {name: self._get("inputs", name, k) for name in self.names["inputs"]}
+
+    def outputs(self, k: int) -> Arrays:
+        return {name: self._get("outputs", name, k) for name in self.names["outputs"]}
+
+
+# %% Replay
+@dataclass
+class Divergence:
+    step: int
+    name: str
+    reason: str
+    max_abs_error: float = np.nan
+    max_rel_error: float = np.nan
+
+
+@dataclass
+class ReplayResult:
+    # the number of steps replayed
+    steps: int
+    # the largest absolute error of every output over the replayed steps
+    max_abs_errors: Dict[str, float]
+    divergence: Optional[Divergence] = None
+
+    @property
+    def ok(self) -> bool:
+        return self.divergence is None
+
+    def __str__(self) -> str:
+        errors = ", ".join(f"{name}: {error:.3g}" for name, error in self.max_abs_errors.items())
+        if self.ok:
+            return f"replayed {self.steps} steps without divergence, max abs errors: {errors}"
+        d = self.divergence
+        return (
+            f"diverged at step {d.step} in {d.name}: {d.reason} "
+            f"(max abs error {d.max_abs_error:.3g}, max rel error {d.max_rel_error:.3g}), "
+            f"max abs errors before: {errors}"
+        )
+
+
+def compare(
+    recorded: np.ndarray, replayed: np.ndarray, rtol: float, atol: float
+) -> Tuple[Optional[str], float, float]:  # the reason it differs or None, max abs and rel error
+    """Compare an output to its recording."""
+    replayed = np.asarray(replayed)
+    if recorded.shape != replayed.shape:
+        return f"shape {replayed.shape}, recorded {recorded.shape}", np.nan, np.nan
+    if recorded.size == 0:
+        return None, 0.0, 0.0
+
+    if recorded.dtype.kind in "biu" or replayed.dtype.kind in "biu":
+        differ = np.count_nonzero(recorded != replayed)
+        error = float(np.max(np.abs(recorded.astype(float) - replayed)))
+        return (f"{differ} elements differ" if differ else None), error, np.nan
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        abs_error = np.abs(recorded - replayed)
+        rel_error = abs_error / np.abs(recorded)
+    max_abs = float(np.nanmax(abs_error)) if np.any(np.isfinite(abs_error)) else 0.0
+    max_rel = float(np.nanmax(np.where(abs_error == 0, 0, rel_error)))
+    close = np.isclose(replayed, recorded, rtol=rtol, atol=atol, equal_nan=True)
+    if not np.all(close):
+        return f"{np.count_nonzero(~close)} elements outside tolerance", max_abs, max_rel
+    return None, max_abs, max_rel
+
+
+def replay(
+    log: ReplayLog,
+    # step(state, inputs) -> (state, outputs), running the estimator one step
+    step: Callable[[Any, Arrays], Tuple[Any, Dict[str, Any]]],
+    state: Any,
+    # tolerances of np.isclose, single or per output name
+    rtol: Union[float, Dict[str, float]] = 1e-6,
+    atol: Union[float, Dict[str, float]] = 1e-9,
+    # replay at most this many steps, None for all
+    steps: Optional[int] = None,
+) -> ReplayResult:
+    """Run step over the logged inputs from state and compare with the logged outputs."""
+    steps = log.steps if steps is None else min(steps, log.steps)
+    max_abs_errors = {name: 0.0 for name in log.names["outputs"]}
+
+    for k in range(steps):
+        state, outputs = step(state, log.inputs(k))
+        for name, recorded in log.outputs(k).items():
+            if name not in outputs:
+                return ReplayResult(k, max_abs_errors, Divergence(k, name, "missing output"))
+            reason, max_abs, max_rel = compare(
+                recorded,
+                outputs[name],
+                rtol[name] if isinstance(rtol, dict) else rtol,
+                atol[name] if isinstance(atol, dict) else atol,
+            )
+            if reason is not None:
+                return ReplayResult(k, max_abs_errors, Divergence(k, name, reason, max_abs, max_rel))
+            max_abs_errors[name] = max(max_abs_errors[name], max_abs)
+
+    return ReplayResult(steps, max_abs_errors)
+
+
+# %% EKFSLAM on simulatedSLAM.mat
+def ekfslam_step(slam) -> Callable[[Any, Arrays], Tuple[Any, Dict[str, Any]]]:
+    """The step of run_simulated_SLAM.py: update with the detections, then predict with the
+    odometry. The outputs are the updated state, NIS and associations."""
+
+    def step(state, inputs):
+        eta, P = state
+        eta, P, NIS, a = slam.update(eta, P, inputs["z"])
+        outputs = dict(eta=eta, P=P.copy(), NIS=NIS, a=a)
+        # predict works on P in place
+        eta, P = slam.predict(eta, P.copy(), inputs["odometry"])
+        return (eta, P), outputs
+
+    return step
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+    from scipy.io import loadmat
+    from EKFSLAM import EKFSLAM
+
+    parser = argparse.ArgumentParser(description="record or replay EKFSLAM on simulatedSLAM.mat")
+    parser.add_argument("mode", choices=["record", "replay"])
+    parser.add_argument("log")
+    parser.add_argument("--steps", type=int, default=None)
+    parser.add_argument("--rtol", type=float, default=1e-6)
+    parser.add_argument("--atol", type=float, default=1e-9)
+    args = parser.parse_args()
+
+    if args.mode == "record":
+        # as in run_simulated_SLAM.py, with data association on
+        meta = dict(
+            Q=(np.diag([0.9, 0.9, np.pi / 85]) * 1e-3).tolist(),
+            R=np.diag([0.06 ** 2, 0.02 ** 2]).tolist(),
+            alphas=[1e-4, 1e-5],
+        )
+        slam = EKFSLAM(np.array(meta["Q"]), np.array(meta["R"]), do_asso=True, alphas=np.array(meta["alphas"]))
+        simSLAM_ws = loadmat("simulatedSLAM")
+        z = [zk.T for zk in simSLAM_ws["z"].ravel()]
+        odometry = simSLAM_ws["odometry"].T
+        poseGT = simSLAM_ws["poseGT"].T
+
+        step = ekfslam_step(slam)
+        state = (poseGT[0], np.zeros((3, 3)))
+        steps = len(z) if args.steps is None else min(args.steps, len(z))
+        with Recorder(args.log, meta) as recorder:
+            recorder.initial(eta=state[0], P=state[1])
+            for k in range(steps):
+                inputs = dict(z=z[k], odometry=odometry[k])
+                state, outputs = step(state, inputs)
+                recorder.step(inputs, outputs)
+        print(f"recorded {steps} steps to {args.log}")
+    else:
+        log = ReplayLog(args.log)
+        slam = EKFSLAM(
+            np.array(log.meta["Q"]), np.array(log.meta["R"]), do_asso=True, alphas=np.array(log.meta["alphas"])
+        )
+        initial = log.initial
+        result = replay(
+            log, ekfslam_step(slam), (initial["eta"], initial["P"]), args.rtol, args.atol, args.steps
+        )
+        print(result)
+        sys.exit(0 if result.ok else 1)
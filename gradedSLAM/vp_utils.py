@@ -1,7 +1,10 @@
 import numpy as np
 
+import profiling
+
 # Shamelessly stolen from here: https://github.com/ramanans1/EKF-SLAM/blob/master/tree_extraction.py
 # Small modifications by Odin Aleksander Severinsen
+@profiling.stage("detectTrees")
 def detectTrees(scan):
 
     M11 = 75
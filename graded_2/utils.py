@@ -12,9 +12,7 @@ def cross_product_matrix(n: ArrayLike, debug: bool = True) -> np.ndarray:
     vector = np.array(n, dtype=float).reshape(3)
 
     S = np.zeros((3, 3))  # TODO: Create the cross product matrix
-    n_1 = n[0]
-    n_2 = n[1]
-    n_3 = n[2]
+    n_1, n_2, n_3 = vector
     #S[0,1] = - n_3
     #S[1,0] = n_3
     #S[0,2] = n_2